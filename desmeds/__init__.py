@@ -1,16 +1,66 @@
+"""
+The submodules and main classes are imported on first use, so that scripts
+that only need e.g. desmeds.files or desmeds.batch do not pay for importing
+meds, galsim and the other dependencies of the makers
+"""
+import importlib
+
 from .defaults import __version__
 
-from . import maker
-from .maker import DESMEDSMaker
-from .desdm_maker import DESMEDSMakerDESDM
+_SUBMODULES = [
+    'batch',
+    'benchmark',
+    'blacklists',
+    'boxsizes',
+    'checkpoint',
+    'coadd',
+    'coaddinfo',
+    'coaddsrc',
+    'defaults',
+    'desdm_maker',
+    'estimate',
+    'files',
+    'genfiles',
+    'instrument',
+    'maker',
+    'multiband',
+    'piffblacklist',
+    'pipeline',
+    'profiling',
+    'runner',
+    'shards',
+    'srctable',
+    'status',
+    'synthetic',
+    'tuning',
+    'util',
+]
+
+# names available at the top level, and the submodule holding each
+_ATTRIBUTES = {
+    'DESMEDSMaker': 'maker',
+    'DESMEDSMakerDESDM': 'desdm_maker',
+    'DESMEDSMultiBandMakerDESDM': 'multiband',
+    'DESMEDSCoadder': 'coadd',
+    'DESMEDSCoaddMaker': 'coadd',
+}
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        # this also sets the submodule as an attribute of the package
+        return importlib.import_module('.' + name, __name__)
+
+    if name in _ATTRIBUTES:
+        module = importlib.import_module('.' + _ATTRIBUTES[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(
+        "module '%s' has no attribute '%s'" % (__name__, name)
+    )
 
-from . import files
-from . import coaddinfo
-from . import coaddsrc
-from . import util
-from . import blacklists
-from . import defaults
-from . import batch
 
-from . import coadd
-from .coadd import DESMEDSCoadder, DESMEDSCoaddMaker
+def __dir__():
+    return sorted(list(globals()) + _SUBMODULES + list(_ATTRIBUTES))
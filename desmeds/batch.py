@@ -3,6 +3,14 @@ import sys
 import os
 
 from . import files
+from . import status
+
+# defaults for packing tile-bands into jobs
+DEFAULT_TARGET_HOURS = 12.0
+DEFAULT_CORES_PER_TASK = 2
+DEFAULT_MAX_CORES = 16
+DEFAULT_TIME_FACTOR = 1.5
+
 
 class Generator(dict):
     def __init__(self,
@@ -11,13 +19,15 @@ class Generator(dict):
                  band,
                  extra=None,
                  system='lsf',
-                 missing=False):
+                 missing=False,
+                 done=None):
 
         self['medsconf']=medsconf
         self['tilename']=tilename
         self['band']=band
         self.system=system
         self.missing=missing
+        self.done=done
         
         if extra is None:
             extra=''
@@ -65,6 +75,17 @@ class Generator(dict):
         else:
             raise ValueError("bad system '%s'" % self.system)
 
+    def _is_done(self):
+        """
+        check if the MEDS file was made, using the set of done tile-bands if
+        it was sent
+        """
+        if self.done is not None:
+            key = (self['tilename'], self['band'])
+            return key in self.done
+        else:
+            return os.path.exists(os.path.expandvars(self['meds_file']))
+
     def _write_script(self):
         """
         write the shell script
@@ -130,7 +151,7 @@ class Generator(dict):
         lsf_file = os.path.expandvars(lsf_file)
 
         subfile=lsf_file+'.submitted'
-        if self.missing and os.path.exists(self['meds_file']):
+        if self.missing and self._is_done():
             if os.path.exists(lsf_file):
                 os.remove(lsf_file)
             if os.path.exists(subfile):
@@ -165,7 +186,7 @@ class Generator(dict):
         )
         wq_file = os.path.expandvars(wq_file)
 
-        if self.missing and os.path.exists(self['meds_file']):
+        if self.missing and self._is_done():
             if os.path.exists(wq_file):
                 os.remove(wq_file)
             wqlog=wq_file+'.wqlog'
@@ -182,6 +203,387 @@ class Generator(dict):
 
         self._write_script()
 
+
+class PackedGenerator(dict):
+    """
+    write lsf jobs for a tileset, packing tile-bands into jobs according to
+    their predicted cost
+
+    Small tile-bands are packed together into jobs that run them one after
+    the other, while expensive ones get their own job with more cores.  The
+    jobs are numbered longest first, so submitting them in order starts the
+    longest ones first.  See pack_tile_bands
+
+    parameters
+    ----------
+    tileset: dict
+        The tileset data, holding the medsconf, tile_ids and bands
+    estimates: list of dicts
+        The cost estimates as written by desmeds-estimate, holding the
+        tilename, band and wall_time_seconds.  Tile-bands with no estimate
+        are given the median time of the others
+    target_hours: float, optional
+        Target wall time for a job in hours.  Default 12
+    cores_per_task: int, optional
+        Cores for a job running tile-bands one at a time.  Default 2
+    max_cores: int, optional
+        Maximum cores for a single expensive tile-band.  Default 16
+    time_factor: float, optional
+        The wall time requested is this factor times the predicted time.
+        Default 1.5
+    missing: bool, optional
+        If True, only pack tile-bands that are not done according to the
+        status database, see status.get_done
+    parallel_fraction: float, optional
+        Fraction of the predicted time spent in work that runs in parallel
+        on the cores of the job, see pack_tile_bands.  Only coadding runs
+        in parallel, in the worker processes chosen by desmeds-tune-job, so
+        this must be zero unless the config is for coadding.  Default 0
+    """
+    def __init__(self,
+                 tileset,
+                 estimates,
+                 target_hours=DEFAULT_TARGET_HOURS,
+                 cores_per_task=DEFAULT_CORES_PER_TASK,
+                 max_cores=DEFAULT_MAX_CORES,
+                 time_factor=DEFAULT_TIME_FACTOR,
+                 missing=False,
+                 parallel_fraction=0.0):
+
+        self.update(tileset)
+        self.estimates = estimates
+        self.target_hours = target_hours
+        self.cores_per_task = cores_per_task
+        self.max_cores = max_cores
+        self.time_factor = time_factor
+        self.missing = missing
+        self.parallel_fraction = parallel_fraction
+
+    def write(self):
+        """
+        write the shell scripts for each tile-band and the lsf files for
+        the packed jobs
+        """
+
+        if self.missing:
+            existing = status.get_done(self['medsconf'])
+        else:
+            existing = set()
+
+        generators = []
+        for tilename in self['tile_ids']:
+            for band in self['bands']:
+                if (tilename, band) in existing:
+                    continue
+
+                generator = Generator(
+                    self['medsconf'],
+                    tilename,
+                    band,
+                    missing=self.missing,
+                )
+                generators.append(generator)
+
+        if self.parallel_fraction > 0 and len(generators) > 0:
+            if 'coadd' not in generators[0].config:
+                raise ValueError("only coadding runs in parallel, "
+                                 "parallel_fraction must be 0")
+
+        costs = self._get_costs(generators)
+        packs = pack_tile_bands(
+            costs,
+            self.target_hours*3600,
+            cores_per_task=self.cores_per_task,
+            max_cores=self.max_cores,
+            parallel_fraction=self.parallel_fraction,
+        )
+
+        self._remove_old_packs()
+
+        print("packed %d tile-bands into %d jobs" % (len(costs), len(packs)))
+        for ipack, pack in enumerate(packs):
+            self._write_pack(ipack, pack, generators)
+
+    def _get_costs(self, generators):
+        """
+        get the list of (index, wall time) for the generators
+        """
+        import numpy as np
+
+        times = {}
+        for est in self.estimates:
+            times[(est['tilename'], est['band'])] = est['wall_time_seconds']
+
+        if len(times) > 0:
+            default_time = float(np.median(list(times.values())))
+        else:
+            default_time = 1.0
+
+        costs = []
+        for i, generator in enumerate(generators):
+            key = (generator['tilename'], generator['band'])
+            if key not in times:
+                print("no estimate for %s %s, using "
+                      "%g seconds" % (key + (default_time,)))
+            costs.append((i, times.get(key, default_time)))
+
+        return costs
+
+    def _remove_old_packs(self):
+        """
+        remove packs left from a previous call, which may have been numbered
+        differently
+        """
+        import glob
+
+        lsf_file = files.get_meds_pack_lsf_file(
+            self['medsconf'], 0, missing=self.missing,
+        )
+        pattern = os.path.expandvars(lsf_file).replace('pack00000', 'pack*')
+        for f in glob.glob(pattern):
+            os.remove(f)
+
+    def _write_pack(self, ipack, pack, generators):
+        """
+        write the lsf file for a packed job, and the scripts for the
+        tile-bands in it
+        """
+        lsf_file = files.get_meds_pack_lsf_file(
+            self['medsconf'], ipack, missing=self.missing,
+        )
+        lsf_file = os.path.expandvars(lsf_file)
+        make_dirs(lsf_file)
+
+        commands = []
+        for i in pack['jobs']:
+            generator = generators[i]
+            generator._write_script()
+            commands.append(_lsf_pack_command_template % generator)
+
+        minutes = int(pack['wall_time_seconds']*self.time_factor/60.0) + 1
+        text = _lsf_pack_template % {
+            'medsconf': self['medsconf'],
+            'ipack': ipack,
+            'file_front': os.path.basename(lsf_file.replace('.lsf', '')),
+            'ncores': pack['ncores'],
+            'walltime': '%d:%02d' % (minutes // 60, minutes % 60),
+            'commands': '\n'.join(commands),
+        }
+
+        print("    writing lsf script:", lsf_file)
+        with open(lsf_file, 'w') as fobj:
+            fobj.write(text)
+
+
+class ArrayGenerator(dict):
+    """
+    write a single lsf array job making the MEDS files for a tileset
+
+    An index file maps each array index to a tilename and band, and a
+    single driver script makes the MEDS file for the tile-band of an
+    index, so only three files are written however many tile-bands there
+    are
+
+    parameters
+    ----------
+    tileset: dict
+        The tileset data, holding the medsconf, tile_ids and bands
+    missing: bool, optional
+        If True, only include tile-bands that are not done according to the
+        status database, see status.get_done
+    """
+    def __init__(self, tileset, missing=False):
+        self.update(tileset)
+        self.missing = missing
+
+        self.config = files.read_meds_config(self['medsconf'])
+
+        self['lsf_file'] = os.path.expandvars(
+            files.get_meds_array_lsf_file(self['medsconf'], missing=missing)
+        )
+        self['index_file'] = os.path.expandvars(
+            files.get_meds_array_index_file(self['medsconf'], missing=missing)
+        )
+        self['script_file'] = os.path.expandvars(
+            files.get_meds_array_script(self['medsconf'])
+        )
+
+    def get_jobs(self):
+        """
+        get the list of (tilename, band) in the array
+        """
+        if self.missing:
+            existing = status.get_done(self['medsconf'])
+        else:
+            existing = set()
+
+        jobs = []
+        for tilename in self['tile_ids']:
+            for band in self['bands']:
+                if (tilename, band) not in existing:
+                    jobs.append((tilename, band))
+        return jobs
+
+    def write(self):
+        """
+        write the index file, driver script and lsf array job
+        """
+        jobs = self.get_jobs()
+
+        subfile = self['lsf_file'] + '.submitted'
+        for f in [self['lsf_file'], subfile]:
+            if os.path.exists(f):
+                os.remove(f)
+
+        if len(jobs) == 0:
+            print("    no tile-bands to process")
+            return
+
+        make_dirs(self['lsf_file'])
+
+        self._write_index(jobs)
+        self._write_driver()
+
+        self['njobs'] = len(jobs)
+        self['file_front'] = os.path.basename(
+            self['lsf_file'].replace('.lsf', '')
+        )
+
+        print("    writing lsf array script for %d tile-bands: "
+              "%s" % (len(jobs), self['lsf_file']))
+        with open(self['lsf_file'], 'w') as fobj:
+            fobj.write(_lsf_array_template % self)
+
+    def _write_index(self, jobs):
+        """
+        write the index, with a line for each tile-band holding the array
+        index, tilename, band, seed and log file
+        """
+        print("    writing index:", self['index_file'])
+        with open(self['index_file'], 'w') as fobj:
+            for i, (tilename, band) in enumerate(jobs):
+                seed = make_seed({
+                    'medsconf': self['medsconf'],
+                    'tilename': tilename,
+                    'band': band,
+                })
+                log_file = files.get_meds_log_file(
+                    self['medsconf'], tilename, band,
+                )
+                fobj.write('%d %s %s %d %s\n' % (
+                    i+1, tilename, band, seed, log_file,
+                ))
+
+    def _write_driver(self):
+        """
+        write the script run for each array index
+        """
+        if 'coadd' in self.config:
+            self['threads'] = 2
+            self['tune_args'] = '--coadd '
+            self['extra_args'] = (
+                '--coadd --seed=${seed} --workers=${DESMEDS_WORKERS:-1} '
+            )
+        else:
+            self['threads'] = 4
+            self['tune_args'] = ''
+            self['extra_args'] = ''
+
+        print("    writing driver script:", self['script_file'])
+        with open(self['script_file'], 'w') as fobj:
+            fobj.write(_array_driver_template % self)
+
+
+def pack_tile_bands(costs,
+                    target_seconds,
+                    cores_per_task=DEFAULT_CORES_PER_TASK,
+                    max_cores=DEFAULT_MAX_CORES,
+                    parallel_fraction=0.0):
+    """
+    pack tile-bands into jobs by their predicted wall time
+
+    Tile-bands predicted to take longer than the target get a job of their
+    own.  If part of the work runs in parallel, cores are added to these
+    jobs in multiples of cores_per_task up to max_cores, and only that part
+    of the time is assumed to scale inversely with the cores.  The rest are
+    packed into jobs with cores_per_task cores using first fit decreasing,
+    so that each job runs its tile-bands one after the other within the
+    target time
+
+    parameters
+    ----------
+    costs: sequence
+        (id, wall time in seconds) for each tile-band
+    target_seconds: float
+        Target wall time for a job
+    cores_per_task: int, optional
+        Cores for a job running tile-bands one at a time.  Default 2
+    max_cores: int, optional
+        Maximum cores for a job.  Default 16
+    parallel_fraction: float, optional
+        Fraction of the wall time spent in work that runs in parallel on
+        the cores of the job.  Default 0, for which the expensive jobs get
+        cores_per_task cores and their full predicted time
+
+    returns
+    -------
+    packs: list of dicts
+        Each has the 'jobs' ids, in the order to run, 'ncores' and the
+        predicted 'wall_time_seconds'.  The packs are sorted longest first
+    """
+    if target_seconds <= 0:
+        raise ValueError("target_seconds must be positive, "
+                         "got %g" % target_seconds)
+
+    if parallel_fraction < 0 or parallel_fraction > 1:
+        raise ValueError("parallel_fraction must be in [0, 1], "
+                         "got %g" % parallel_fraction)
+
+    max_cores = max(max_cores, cores_per_task)
+
+    costs = sorted(costs, key=lambda c: c[1], reverse=True)
+
+    packs = []
+    small = []
+    for id, seconds in costs:
+        if seconds > target_seconds:
+            if parallel_fraction > 0:
+                nmult = int(-(-seconds // target_seconds))
+                ncores = min(nmult*cores_per_task, max_cores)
+            else:
+                ncores = cores_per_task
+
+            speedup = float(cores_per_task)/ncores
+            packs.append({
+                'jobs': [id],
+                'ncores': ncores,
+                'wall_time_seconds': seconds*(
+                    1 - parallel_fraction + parallel_fraction*speedup
+                ),
+            })
+        else:
+            small.append((id, seconds))
+
+    # first fit decreasing
+    bins = []
+    for id, seconds in small:
+        for pack in bins:
+            if pack['wall_time_seconds'] + seconds <= target_seconds:
+                pack['jobs'].append(id)
+                pack['wall_time_seconds'] += seconds
+                break
+        else:
+            bins.append({
+                'jobs': [id],
+                'ncores': cores_per_task,
+                'wall_time_seconds': seconds,
+            })
+
+    packs += bins
+    packs.sort(key=lambda p: p['wall_time_seconds'], reverse=True)
+    return packs
+
+
 def make_dirs(*args):
 
     for f in args:
@@ -216,6 +618,84 @@ mv -fv "${tmp_log}" "${log_file}" 1>&2
 rm -rv $TMPDIR
 """
 
+_lsf_pack_template=r"""#!/bin/bash
+#BSUB -J "meds-%(medsconf)s-pack%(ipack)05d"
+#BSUB -oo ./%(file_front)s.oe
+#BSUB -n %(ncores)d
+#BSUB -R span[hosts=1]
+#BSUB -R "linux64 && rhel60 && (scratch > 20) && (!deft)"
+#BSUB -W %(walltime)s
+
+export OMP_NUM_THREADS=%(ncores)d
+export DESMEDS_NCORES=%(ncores)d
+
+%(commands)s
+"""
+
+_lsf_pack_command_template=r"""(
+    export TMPDIR=/scratch/$USER/$LSB_JOBID-$LSB_JOBINDEX/meds-%(tilename)s-%(band)s
+
+    mkdir -pv $TMPDIR
+
+    log_file=%(log_file)s
+    tmp_log=$(basename $log_file)
+    tmp_log="$TMPDIR/$tmp_log"
+
+    bash %(script_file)s &> ${tmp_log}
+
+    mv -fv "${tmp_log}" "${log_file}" 1>&2
+
+    rm -rv $TMPDIR
+)
+"""
+
+_lsf_array_template=r"""#!/bin/bash
+#BSUB -J "meds-%(medsconf)s[1-%(njobs)d]"
+#BSUB -oo ./%(file_front)s-%%I.oe
+#BSUB -n 2
+#BSUB -R span[hosts=1]
+#BSUB -R "linux64 && rhel60 && (scratch > 20) && (!deft)"
+#BSUB -W 48:00
+
+export TMPDIR=/scratch/$USER/$LSB_JOBID-$LSB_JOBINDEX
+
+mkdir -pv $TMPDIR
+
+bash %(script_file)s $LSB_JOBINDEX %(index_file)s
+
+rm -rv $TMPDIR
+"""
+
+# run by each array job, with the array index and index file as arguments
+_array_driver_template=r"""#!/bin/bash
+
+index=$1
+index_file=$2
+
+line=$(awk -v i="$index" '$1 == i {print; exit}' "$index_file")
+if [[ -z "$line" ]]; then
+    echo "index $index not found in $index_file" 1>&2
+    exit 1
+fi
+
+read index tilename band seed log_file <<< "$line"
+mkdir -p $(dirname "$log_file")
+
+tmp_log="$TMPDIR/$(basename $log_file)"
+
+eval $(desmeds-tune-job %(tune_args)s%(medsconf)s ${tilename} ${band} 2> ${tmp_log})
+export OMP_NUM_THREADS=${OMP_NUM_THREADS:-%(threads)d}
+
+python -u $(which desmeds-make-meds) \
+    --tmpdir=$TMPDIR \
+    --psf-load-threads=${DESMEDS_PSF_LOAD_THREADS:-1} \
+    %(extra_args)s%(medsconf)s ${tilename} ${band} &>> ${tmp_log}
+status=$?
+
+mv -fv "${tmp_log}" "${log_file}" 1>&2
+
+exit $status
+"""
 
 _wq_make_meds_template=r"""
 command: |
@@ -242,20 +722,24 @@ mode: bynode
 # N: 4
 """
 
+# the threads are chosen by desmeds-tune-job, falling back to fixed values
 _script_template=r"""#!/bin/bash
 
-export OMP_NUM_THREADS=4
+eval $(desmeds-tune-job %(medsconf)s %(tilename)s %(band)s)
+export OMP_NUM_THREADS=${OMP_NUM_THREADS:-4}
 
 mkdir -p $TMPDIR
 
 python -u $(which desmeds-make-meds) \
     --tmpdir=$TMPDIR \
+    --psf-load-threads=${DESMEDS_PSF_LOAD_THREADS:-1} \
     %(medsconf)s %(tilename)s %(band)s
 """
 
 _coadd_script_template=r"""#!/bin/bash
 
-export OMP_NUM_THREADS=2
+eval $(desmeds-tune-job --coadd %(medsconf)s %(tilename)s %(band)s)
+export OMP_NUM_THREADS=${OMP_NUM_THREADS:-2}
 
 mkdir -p $TMPDIR
 
@@ -263,6 +747,8 @@ python -u $(which desmeds-make-meds) \
     --tmpdir=$TMPDIR \
     --coadd \
     --seed=%(seed)d \
+    --psf-load-threads=${DESMEDS_PSF_LOAD_THREADS:-1} \
+    --workers=${DESMEDS_WORKERS:-1} \
     %(medsconf)s %(tilename)s %(band)s
 """
 
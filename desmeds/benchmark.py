@@ -0,0 +1,201 @@
+"""
+benchmarks for making MEDS files from synthetic tiles
+
+The tiles are generated with the synthetic module and the MEDS files are
+made with DESMEDSMakerDESDM, end to end, with analytic stand-ins for the
+psfex and piff models.  No DES data or database access are needed.
+
+Each MEDS file is made in a separate process so that the peak memory is
+measured for that file alone
+"""
+from __future__ import print_function
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+from . import synthetic
+from .desdm_maker import DESMEDSMakerDESDM
+
+
+class SyntheticMEDSMaker(DESMEDSMakerDESDM):
+    """
+    DESMEDSMakerDESDM that loads the Gaussian psf stand-ins written for a
+    synthetic tile in place of psfex and piff models
+    """
+    def _load_one_psfex(self, f):
+        """
+        load a single Gaussian psf
+        """
+        return synthetic.GaussianPSF(f)
+
+    def _load_one_piff(self, f, conf, ccdnum=None, band=None):
+        """
+        load a single Gaussian psf with the PIFFWrapper interface
+        """
+        return synthetic.GaussianPiffPSF(
+            f,
+            stamp_size=conf['stamp_size'],
+            ccdnum=ccdnum,
+        )
+
+
+def run_benchmarks(nobjs, nepochs, dir=None, keep=False, **kw):
+    """
+    run a benchmark for each combination of number of objects and epochs
+
+    parameters
+    ----------
+    nobjs: sequence
+        The numbers of objects
+    nepochs: sequence
+        The numbers of epochs
+    dir: string, optional
+        Directory for the tiles, default a temporary directory
+    keep: bool, optional
+        If True, keep the tiles and MEDS files, default False
+    **kw:
+        Extra keywords for run_benchmark
+
+    returns
+    -------
+    results: list of dicts
+        As returned by run_benchmark
+    """
+    remove_dir = False
+    if dir is None:
+        dir = tempfile.mkdtemp(prefix='desmeds-benchmark-')
+        remove_dir = not keep
+
+    results = []
+    for nobj in nobjs:
+        for nepoch in nepochs:
+            tile_dir = os.path.join(
+                dir, 'nobj%08d-nepoch%04d' % (nobj, nepoch),
+            )
+            res = run_benchmark(tile_dir, nobj, nepoch, **kw)
+            print_result(res)
+            results.append(res)
+
+            if not keep:
+                shutil.rmtree(tile_dir, ignore_errors=True)
+
+    if remove_dir:
+        shutil.rmtree(dir, ignore_errors=True)
+
+    return results
+
+
+def run_benchmark(dir,
+                  nobj,
+                  nepoch,
+                  psf_type='psfex',
+                  compress=False,
+                  seed=None,
+                  **kw):
+    """
+    generate a synthetic tile and make the MEDS file for it
+
+    parameters
+    ----------
+    dir: string
+        Directory for the tile
+    nobj: int
+        Number of objects
+    nepoch: int
+        Number of single epoch images
+    psf_type: string, optional
+        'psfex' or 'piff', default 'psfex'
+    compress: bool, optional
+        If True, write a .fits.fz file, which requires fpack.  Default
+        False
+    seed: int, optional
+        Seed for generating the tile
+    **kw:
+        Extra keywords for synthetic.make_tile
+
+    returns
+    -------
+    result: dict
+        The parameters, number of cutouts, total wall time, objects and
+        cutouts per second, peak memory and the stages as recorded by the
+        maker instrumentation
+    """
+    fileconf = synthetic.make_tile(
+        dir,
+        nobj=nobj,
+        nepoch=nepoch,
+        psf_type=psf_type,
+        compress=compress,
+        seed=seed,
+        **kw
+    )
+    medsconf = synthetic.get_medsconf(psf_type=psf_type)
+
+    # a new process so the peak memory is for making the file alone
+    pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+    try:
+        res = pool.apply(make_meds, (medsconf, fileconf))
+    finally:
+        pool.close()
+        pool.join()
+
+    res.update({
+        'nobj': nobj,
+        'nepoch': nepoch,
+        'psf_type': psf_type,
+        'compress': compress,
+    })
+    return res
+
+
+def make_meds(medsconf, fileconf):
+    """
+    make the MEDS file for a synthetic tile and measure the throughput
+
+    returns
+    -------
+    result: dict
+        The number of cutouts, file size, total wall time, objects and
+        cutouts per second, peak memory and the stages as recorded by the
+        maker instrumentation
+    """
+    import fitsio
+
+    tm0 = time.time()
+    maker = SyntheticMEDSMaker(medsconf, fileconf)
+    maker.go()
+    wall_time = time.time() - tm0
+
+    obj_data = fitsio.read(fileconf['meds_url'], ext='object_data')
+    nobj = obj_data.size
+    ncutout = int(obj_data['ncutout'].sum())
+
+    summary = maker.instrument.get_summary()
+
+    return {
+        'ncutout': ncutout,
+        'file_bytes': os.path.getsize(fileconf['meds_url']),
+        'wall_time_seconds': wall_time,
+        'objects_per_second': nobj/wall_time,
+        'cutouts_per_second': ncutout/wall_time,
+        'peak_rss_bytes': summary['total']['peak_rss_bytes'],
+        'host': summary['host'],
+        'stages': summary['stages'],
+    }
+
+
+def print_result(result):
+    """
+    print a one line summary of the result
+    """
+    print(
+        'nobj: %(nobj)d nepoch: %(nepoch)d ncutout: %(ncutout)d '
+        'time: %(wall_time_seconds).1f s '
+        'objects/s: %(objects_per_second).1f '
+        'cutouts/s: %(cutouts_per_second).1f '
+        'peak rss: %(peak_rss_mb).1f MB' % dict(
+            result, peak_rss_mb=result['peak_rss_bytes']/1.0e6,
+        )
+    )
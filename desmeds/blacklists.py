@@ -1,107 +1,338 @@
+"""
+exposure-ccd blacklists
+
+All of the blacklists are held in a BlacklistEngine, as one sorted array of
+bigind = expnum + ccd*10**7 with the flag bits of the lists holding each
+entry.  The engine is cached in a binary file, keyed by the modification
+times and sizes of the text files, so the text files are only parsed when
+they change.  See files.get_blacklist_cache_file
+"""
 from __future__ import print_function
 import os
-import sys
 import numpy as np
 
-# desdb is not needed in all scenarios
-try:
-    import desdb
-except ImportError:
-    pass
+from . import files
+from .srctable import add_columns
 
+# Eli's flags go to 2**9
+EXP_BLACKLISTS = [
+    ('ghost-sv', 'ghost-scatter-sv-uniq.txt', 2**10),
+    ('ghost-y1', 'ghost-scatter-y1-uniq.txt', 2**11),
+    ('noise-y1', 'noise-y1-uniq.txt', 2**12),
+    ('streak-sv', 'streak-sv-uniq.txt', 2**13),
+    ('streak-y1', 'streak-y1-uniq.txt', 2**14),
+]
+
+# this bit is never set in the source flags; corrupted sources are removed
+CORRUPTED_FLAG = 2**30
+CORRUPTED_BLACKLIST = ('corrupted-y1', 'corrupted-y1.txt', CORRUPTED_FLAG)
+
+EXP_FLAGS = sum(flag for _, _, flag in EXP_BLACKLISTS)
+
+# the engine for this process, loaded on first use
+_ENGINE = None
 
-def read_blacklist(fname):
-    import esutil as eu
-    dt=[('expnum','i8'),
-        ('ccd','i8')]
 
-    #print("reading:",fname)
-    with eu.recfile.Recfile(fname, 'r', delim=' ', dtype=dt) as fobj:
-        data=fobj.read()
+def read_blacklist(fname):
     """
-    dt=[('expnum','i8'),
-        ('ccd','i8')]    
-    data = np.genfromtxt(fname,dtype=dt)
+    read a blacklist text file holding expnum ccd on each line
     """
+    dt = [('expnum', 'i8'),
+          ('ccd', 'i8')]
+
+    data = np.loadtxt(fname, dtype=dt, ndmin=1)
     return data
 
+
 def read_blacklist_as_dict(fname):
-    data=read_blacklist(fname)
+    data = read_blacklist(fname)
 
-    bigind=make_bigind(data['expnum'], data['ccd'])
-    d={}
-    for i in xrange(data.size):
+    bigind = make_bigind(data['expnum'], data['ccd'])
+    d = {}
+    for i in range(data.size):
         d[bigind[i]] = data[i]
 
     return d
 
-def get_corrupted_blacklist():
-    subdirs=['EXTRA','blacklists']
-    dir=desdb.files.get_dir_generic(subdirs)
 
-    fname=os.path.join(dir, 'corrupted-y1.txt')
-    return read_blacklist_as_dict(fname)
+class BlacklistEngine(object):
+    """
+    a set of blacklists, held as a sorted array of unique bigind with the
+    or of the flags from each list holding it
 
-def get_exp_blacklists():
-    subdirs=['EXTRA','blacklists']
-    dir=desdb.files.get_dir_generic(subdirs)
+    parameters
+    ----------
+    bigind: array
+        The sorted, unique bigind
+    flags: array
+        The flags for each bigind
+    names: dict, optional
+        Names for the flag bits, used when printing
+    """
+    def __init__(self, bigind, flags, names=None):
+        self.bigind = np.asarray(bigind, dtype='i8')
+        self.flags = np.asarray(flags, dtype='i8')
+
+        if names is None:
+            names = {}
+        self.names = names
+
+    @classmethod
+    def from_files(cls, blacklists, dir=None):
+        """
+        build the engine from text files
+
+        parameters
+        ----------
+        blacklists: list
+            (name, filename, flag) for each list
+        dir: string, optional
+            Directory holding the files, default files.get_blacklist_dir()
+        """
+        if dir is None:
+            dir = files.get_blacklist_dir()
+
+        bigind_list = []
+        flag_list = []
+        names = {}
+        for name, fname, flag in blacklists:
+            data = read_blacklist(os.path.join(dir, fname))
+            bigind_list.append(make_bigind(data['expnum'], data['ccd']))
+            flag_list.append(np.full(data.size, flag, dtype='i8'))
+            names[flag] = name
+
+        if len(bigind_list) > 0:
+            all_bigind = np.concatenate(bigind_list)
+            all_flags = np.concatenate(flag_list)
+        else:
+            all_bigind = np.zeros(0, dtype='i8')
+            all_flags = np.zeros(0, dtype='i8')
+
+        bigind, rev = np.unique(all_bigind, return_inverse=True)
+        flags = np.zeros(bigind.size, dtype='i8')
+        np.bitwise_or.at(flags, rev, all_flags)
+
+        return cls(bigind, flags, names=names)
+
+    @classmethod
+    def load(cls, blacklists, dir=None, cache_file=None):
+        """
+        load the engine from the cache file if it is up to date with the
+        text files, otherwise build it and write the cache
+
+        parameters
+        ----------
+        blacklists: list
+            (name, filename, flag) for each list
+        dir: string, optional
+            Directory holding the files, default files.get_blacklist_dir()
+        cache_file: string, optional
+            The binary cache, default files.get_blacklist_cache_file()
+        """
+        if dir is None:
+            dir = files.get_blacklist_dir()
+        if cache_file is None:
+            cache_file = files.get_blacklist_cache_file()
+
+        key = _get_cache_key(blacklists, dir)
+
+        engine = _read_cache(cache_file, key)
+        if engine is None:
+            engine = cls.from_files(blacklists, dir=dir)
+            engine.write_cache(cache_file, key)
+
+        return engine
+
+    def get_flags(self, bigind):
+        """
+        get the flags for each bigind, zero for those in no list
+        """
+        bigind = np.asarray(bigind, dtype='i8')
+        flags = np.zeros(bigind.size, dtype='i8')
+        if self.bigind.size == 0:
+            return flags
+
+        ind = np.searchsorted(self.bigind, bigind)
+        ind.clip(max=self.bigind.size-1, out=ind)
+
+        w, = np.where(self.bigind[ind] == bigind)
+        flags[w] = self.flags[ind[w]]
+        return flags
+
+    def print_counts(self, flags, mask=None):
+        """
+        print the number of entries found in each list
+        """
+        for flag in sorted(self.names):
+            if mask is not None and (flag & mask) == 0:
+                continue
+
+            nfound = ((flags & flag) != 0).sum()
+            if nfound > 0:
+                print("    found %d in blacklist: %s" % (
+                    nfound, self.names[flag],
+                ))
+
+    def write_cache(self, cache_file, key):
+        """
+        write the engine to the binary cache file, with the key used to
+        check it is up to date
+        """
+        flag_bits = np.array(sorted(self.names), dtype='i8')
+        flag_names = np.array([self.names[f] for f in flag_bits], dtype='U')
+
+        tmp_file = cache_file + '.tmp-%d' % os.getpid()
+        try:
+            files.makedir_fromfile(cache_file)
+            with open(tmp_file, 'wb') as fobj:
+                np.savez(
+                    fobj,
+                    key=np.array(key, dtype='U'),
+                    bigind=self.bigind,
+                    flags=self.flags,
+                    flag_bits=flag_bits,
+                    flag_names=flag_names,
+                )
+            os.replace(tmp_file, cache_file)
+        except (IOError, OSError) as err:
+            # the cache is only an optimization
+            print("could not write blacklist "
+                  "cache %s: %s" % (cache_file, err))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
 
-    # Eli's flags go to 2**9
 
-    #print("reading blackists")
-    ldict={}
-    fname=os.path.join(dir, 'ghost-scatter-sv-uniq.txt')
-    ldict['ghost-sv'] = {'blacklist':read_blacklist_as_dict(fname),
-                         'flag': 2**10}
+def get_engine():
+    """
+    get the engine holding the exposure and corrupted blacklists, loaded
+    once per process
+    """
+    global _ENGINE
 
-    fname=os.path.join(dir, 'ghost-scatter-y1-uniq.txt')
-    ldict['ghost-y1'] = {'blacklist':read_blacklist_as_dict(fname),
-                         'flag': 2**11}
+    if _ENGINE is None:
+        _ENGINE = BlacklistEngine.load(
+            EXP_BLACKLISTS + [CORRUPTED_BLACKLIST],
+        )
+    return _ENGINE
 
-    fname=os.path.join(dir, 'noise-y1-uniq.txt')
-    ldict['noise-y1'] = {'blacklist':read_blacklist_as_dict(fname),
-                         'flag': 2**12}
 
-    fname=os.path.join(dir, 'streak-sv-uniq.txt')
-    ldict['streak-sv'] = {'blacklist':read_blacklist_as_dict(fname),
-                         'flag': 2**13}
+def get_corrupted_blacklist():
+    fname = os.path.join(files.get_blacklist_dir(), CORRUPTED_BLACKLIST[1])
+    return read_blacklist_as_dict(fname)
 
-    fname=os.path.join(dir, 'streak-y1-uniq.txt')
-    ldict['streak-y1'] = {'blacklist':read_blacklist_as_dict(fname),
-                         'flag': 2**14}
+
+def get_exp_blacklists():
+    dir = files.get_blacklist_dir()
+
+    ldict = {}
+    for name, fname, flag in EXP_BLACKLISTS:
+        ldict[name] = {
+            'blacklist': read_blacklist_as_dict(os.path.join(dir, fname)),
+            'flag': flag,
+        }
 
     return ldict
 
-def remove_corrupted(srclist):
-    blacklist = get_corrupted_blacklist()
 
-    new_srclist=[]
-    for s in srclist:
-        if s['bigind'] not in blacklist:
-            new_srclist.append( s )
-        else:
-            print("    found in corrupted blacklist")
+def remove_corrupted(srctable, engine=None):
+    """
+    remove sources found in the corrupted blacklist
+
+    parameters
+    ----------
+    srctable: numpy structured array
+        The source table, with bigind present
+    engine: BlacklistEngine, optional
+        Default from get_engine()
+
+    returns
+    -------
+    the sources not in the corrupted list
+    """
+    if engine is None:
+        engine = get_engine()
+
+    flags = engine.get_flags(srctable['bigind'])
+    bad = (flags & CORRUPTED_FLAG) != 0
+    if bad.any():
+        print("    found %d in corrupted blacklist" % bad.sum())
+
+    new_srctable = srctable[~bad]
 
     print("kept %d/%d after "
-          "removing corrupted" % (len(new_srclist),len(srclist)))
-    return new_srclist
+          "removing corrupted" % (new_srctable.size, srctable.size))
+    return new_srctable
+
 
-def add_blacklist_flags(srclist):
+def add_blacklist_flags(srctable, engine=None):
     """
-    bigind and flags must be present already
+    bigind and flags must be present already; the flags
+    are modified in place
+
+    parameters
+    ----------
+    srctable: numpy structured array
+        The source table
+    engine: BlacklistEngine, optional
+        Default from get_engine()
     """
-    blacklists = get_exp_blacklists()
-    for s in srclist:
-        for bname,blist in blacklists.iteritems():
-            if s['bigind'] in blist['blacklist']:
-                print("    found in blacklist:",bname)
-                s['flags'] |= blist['flag']
+    if engine is None:
+        engine = get_engine()
+
+    flags = engine.get_flags(srctable['bigind']) & EXP_FLAGS
+    engine.print_counts(flags, mask=EXP_FLAGS)
+
+    srctable['flags'] |= flags.astype(srctable['flags'].dtype)
+
+
+def add_bigind(srctable):
+    """
+    get a new source table with the bigind column added.  The expname
+    is of the form DECam_00123456
+    """
+    expstr = np.char.partition(srctable['expname'].astype('U'), '_')[:, 2]
+    expstr = np.char.partition(expstr, '_')[:, 0]
+    expnum = expstr.astype('i8')
+
+    bigind = make_bigind(expnum, srctable['ccd'].astype('i8'))
+    return add_columns(srctable, {'bigind': bigind})
 
-def add_bigind(srclist):
-    for s in srclist:
-        expname=s['expname']
-        expnum=int( expname.split('_')[1] )
-        s['bigind'] = make_bigind(expnum, s['ccd'])
 
 def make_bigind(expnum, ccdnum):
     return expnum + ccdnum*10**7
+
+
+def _get_cache_key(blacklists, dir):
+    """
+    the key identifying the blacklist files and their versions
+    """
+    key = []
+    for name, fname, flag in blacklists:
+        path = os.path.join(dir, fname)
+        st = os.stat(path)
+        key.append('%s %s %d %d %d' % (
+            name, os.path.abspath(path), flag, st.st_mtime_ns, st.st_size,
+        ))
+    return key
+
+
+def _read_cache(cache_file, key):
+    """
+    read the engine from the cache, or return None if it is missing or out
+    of date
+    """
+    if not os.path.exists(cache_file):
+        return None
+
+    try:
+        with np.load(cache_file) as data:
+            if data['key'].tolist() != key:
+                return None
+
+            names = dict(zip(
+                data['flag_bits'].tolist(), data['flag_names'].tolist(),
+            ))
+            return BlacklistEngine(data['bigind'], data['flags'], names=names)
+    except Exception as err:
+        print("could not read blacklist cache %s: %s" % (cache_file, err))
+        return None
@@ -0,0 +1,154 @@
+"""
+pixel budget policy for the cutout box sizes
+
+The box sizes are normally chosen for each object independently, which means
+tiles near bright stars or galaxy clusters can produce MEDS files much larger
+than typical.  With a budget, the boxes of the largest, lowest priority
+objects are stepped down through the allowed sizes until the total number of
+pixels is under the budget.
+
+The budget is on the coadd cutout pixels, sum(box_size**2), counting one
+cutout per object.  The number of epochs each object falls on is not known
+when the box sizes are chosen, so the pixels in the single epoch cutouts are
+not budgeted; they scale with the coadd pixels for a given depth.
+
+The budget is set in the meds config, e.g.
+
+    box_size_budget:
+        # maximum of the sum over objects of box_size**2
+        max_pixels: 2.0e8
+
+        # or the maximum mean box_size**2, the coadd pixels per object
+        max_coadd_pixels_per_object: 4096
+
+        # catalog column giving the priority; objects with larger values
+        # are shrunk last.  If not sent all objects have equal priority
+        priority_name: flux_auto
+
+If both max_pixels and max_coadd_pixels_per_object are sent, the smaller of
+the two resulting totals is used.
+"""
+from __future__ import print_function
+import numpy as np
+
+
+def get_max_pixels(budget, nobj):
+    """
+    get the maximum total coadd pixels, sum(box_size**2), for the budget
+
+    parameters
+    ----------
+    budget: dict
+        The box_size_budget config
+    nobj: int
+        Number of objects
+    """
+    if 'max_pixels_per_object' in budget:
+        raise ValueError("max_pixels_per_object is now called "
+                         "max_coadd_pixels_per_object")
+
+    max_pixels = None
+
+    if budget.get('max_pixels') is not None:
+        max_pixels = float(budget['max_pixels'])
+
+    if budget.get('max_coadd_pixels_per_object') is not None:
+        tmax = nobj*float(budget['max_coadd_pixels_per_object'])
+        if max_pixels is None or tmax < max_pixels:
+            max_pixels = tmax
+
+    if max_pixels is None:
+        raise ValueError("box_size_budget must contain max_pixels "
+                         "or max_coadd_pixels_per_object")
+
+    return max_pixels
+
+
+def apply_pixel_budget(box_size, sizes, max_pixels, priority=None):
+    """
+    shrink boxes until the total number of coadd pixels, sum(box_size**2),
+    is at most max_pixels
+
+    At each step the objects with the largest box are candidates; among
+    those the lowest priority objects are stepped down to the next smaller
+    allowed size first, and only as many as needed.  The budget may not be
+    reachable if all boxes are at the smallest allowed size
+
+    parameters
+    ----------
+    box_size: array
+        The box sizes, which must each be one of the allowed sizes
+    sizes: sequence
+        The allowed box sizes
+    max_pixels: number
+        The budget for sum(box_size**2)
+    priority: array, optional
+        Priority for each object; objects with larger values are shrunk
+        last.  Ties are broken by order in the catalog, with later objects
+        shrunk first
+
+    returns
+    -------
+    new_box_size: array
+        The new box sizes
+    """
+    sizes = np.unique(np.array(sizes, dtype='i8'))
+    new_box_size = np.array(box_size, dtype='i8', copy=True)
+
+    if priority is None:
+        priority = np.zeros(new_box_size.size)
+
+    # stable ordering from lowest to highest priority, with later
+    # objects first for ties
+    order = np.lexsort((-np.arange(new_box_size.size), priority))
+
+    total = (new_box_size**2).sum()
+
+    isize = sizes.size-1
+    while total > max_pixels and isize > 0:
+        size = sizes[isize]
+        next_size = sizes[isize-1]
+
+        w = order[new_box_size[order] == size]
+        nshrink = 0
+        if w.size > 0:
+            saving = size**2 - next_size**2
+            excess = total - max_pixels
+            nshrink = min(w.size, int(np.ceil(excess/saving)))
+
+            new_box_size[w[:nshrink]] = next_size
+            total -= nshrink*saving
+
+        if nshrink == w.size:
+            isize -= 1
+
+    return new_box_size
+
+
+def make_report(number, priority, orig_box_size, box_size):
+    """
+    make a report of the objects for which the box size was reduced
+
+    returns
+    -------
+    report: array
+        With fields number, priority, orig_box_size, box_size
+    """
+    if priority is None:
+        priority = np.zeros(box_size.size)
+
+    w, = np.where(box_size != orig_box_size)
+
+    dt = [
+        ('number', 'i8'),
+        ('priority', 'f8'),
+        ('orig_box_size', 'i4'),
+        ('box_size', 'i4'),
+    ]
+    report = np.zeros(w.size, dtype=dt)
+    report['number'] = number[w]
+    report['priority'] = priority[w]
+    report['orig_box_size'] = orig_box_size[w]
+    report['box_size'] = box_size[w]
+
+    return report
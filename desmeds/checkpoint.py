@@ -0,0 +1,172 @@
+"""
+checkpointing for writing MEDS files in chunks of objects
+
+Each chunk of objects is written to its own MEDS file next to the final
+output, and completed chunks are recorded in a yaml sidecar file.  If the
+job is killed, a restart validates the completed chunks and writes only the
+remaining ones.  The chunks are then merged into the final file.
+"""
+from __future__ import print_function
+import os
+import hashlib
+import numpy as np
+import yaml
+
+from . import files
+from . import shards
+
+
+class ChunkCheckpoint(object):
+    """
+    track the chunks of a MEDS file written so far
+
+    parameters
+    ----------
+    fname: string
+        The final MEDS file.  The chunk files and sidecar are written in the
+        same directory, so they survive if the job is killed
+    ids: array
+        The ids of the objects in the file, in order.  These are used to
+        check that a previous checkpoint was made for the same objects
+    chunksize: int
+        Number of objects in each chunk
+    """
+    def __init__(self, fname, ids, chunksize):
+        self.fname = fname
+        self.ids = np.asarray(ids)
+        self.chunksize = int(chunksize)
+
+        self.ranges = shards.get_chunk_ranges(self.ids.size, self.chunksize)
+        self.chunk_files = [
+            shards.get_chunk_file(fname, i) for i in range(len(self.ranges))
+        ]
+        self.sidecar = files.get_meds_sidecar_file(
+            fname, 'checkpoint', ext='yaml',
+        )
+
+        self.completed = self._load()
+
+    def get_todo(self):
+        """
+        get the chunks remaining to be written
+
+        returns
+        -------
+        list of (ichunk, (start, end), chunk_file) tuples
+        """
+        return [
+            (i, self.ranges[i], self.chunk_files[i])
+            for i in range(len(self.ranges))
+            if i not in self.completed
+        ]
+
+    def set_completed(self, ichunk):
+        """
+        record that the chunk was written
+        """
+        self.completed.append(ichunk)
+        self._write()
+
+    def merge(self, output_file):
+        """
+        merge the chunks into the output file, which must be uncompressed
+        """
+        assert len(self.get_todo()) == 0, 'not all chunks are complete'
+        shards.merge_meds_files(self.chunk_files, output_file)
+
+    def clean(self):
+        """
+        remove the chunk files and sidecar
+        """
+        shards.remove_shard_files(self.chunk_files + [self.sidecar])
+
+    def _get_ids_hash(self):
+        return hashlib.md5(self.ids.tobytes()).hexdigest()
+
+    def _write(self):
+        """
+        write the sidecar; a temporary file is used so that the sidecar is
+        always complete
+        """
+        data = {
+            'nobj': int(self.ids.size),
+            'chunksize': self.chunksize,
+            'ids_hash': self._get_ids_hash(),
+            'completed': sorted(int(i) for i in self.completed),
+        }
+
+        tmp_file = self.sidecar + '.tmp'
+        with open(tmp_file, 'w') as fobj:
+            yaml.dump(data, fobj)
+
+        os.rename(tmp_file, self.sidecar)
+
+    def _load(self):
+        """
+        load the list of completed chunks from the sidecar, keeping only
+        those that pass validation
+        """
+        if not os.path.exists(self.sidecar):
+            return []
+
+        print('reading checkpoint:', self.sidecar)
+        with open(self.sidecar) as fobj:
+            data = yaml.safe_load(fobj)
+
+        if (data['nobj'] != self.ids.size
+                or data['chunksize'] != self.chunksize
+                or data['ids_hash'] != self._get_ids_hash()):
+            print('    checkpoint does not match the objects, starting over')
+            self.clean()
+            return []
+
+        completed = []
+        for ichunk in data['completed']:
+            if self._validate_chunk(ichunk):
+                completed.append(ichunk)
+            else:
+                print('    chunk %d is not valid, will rewrite' % ichunk)
+
+        print('    %d/%d chunks already complete' % (len(completed),
+                                                   len(self.ranges)))
+        return completed
+
+    def _validate_chunk(self, ichunk):
+        """
+        check the chunk file can be read, holds the expected objects, and
+        has all of the image cutouts
+        """
+        import fitsio
+
+        fname = self.chunk_files[ichunk]
+        if not os.path.exists(fname):
+            return False
+
+        start, end = self.ranges[ichunk]
+
+        try:
+            with fitsio.FITS(fname) as fits:
+                obj_data = fits[shards.OBJECT_DATA_EXT].read()
+
+                if 'id' in obj_data.dtype.names:
+                    if not np.array_equal(obj_data['id'],
+                                          self.ids[start:end]):
+                        return False
+                elif obj_data.size != end-start:
+                    return False
+
+                npix = shards._get_cutout_npix(obj_data)
+                image_exts, _ = shards._get_ext_names(fits)
+                for extname in image_exts:
+                    if extname == shards.PSF_EXT:
+                        continue
+
+                    dims = fits[extname].get_dims()
+                    if npix > 0 and int(np.prod(dims)) != npix:
+                        return False
+
+        except (IOError, OSError, ValueError) as err:
+            print('    error reading chunk:', err)
+            return False
+
+        return True
@@ -1,8 +1,11 @@
 from __future__ import print_function
 import numpy as np
 import os
+from collections import OrderedDict
 import meds
 from . import util
+from . import checkpoint
+from . import shards
 try:
     xrange
 except:
@@ -13,32 +16,71 @@ from .files import (
     StagedOutFile,
 )
 
+# default maximum number of psf images held in the coadder cache
+DEFAULT_PSF_CACHE_SIZE = 10000
+
 class DESMEDSCoaddMaker(meds.MEDSCoaddMaker):
-    def write(self, fname, obj_range=None):
+    def write(self, fname, obj_range=None, chunksize=None):
         """
         write the data using the MEDSMaker
+
+        parameters
+        ----------
+        fname: string
+            The output file
+        obj_range: sequence, optional
+            The first and last object to process, inclusive
+        chunksize: int, optional
+            If sent, the objects are written in chunks of this size, with
+            progress recorded in a checkpoint file next to the output.  If
+            the job is killed, running again continues from the last
+            completed chunk
         """
 
+        ckpt = None
+        if chunksize is not None:
+            ckpt = self._get_checkpoint(fname, obj_range, chunksize)
+
         print("writing MEDS file:",fname)
 
         if self.tmpdir is not None:
             with StagedOutFile(fname,tmpdir=self.tmpdir) as sf:
-                self._dowrite(sf.path, obj_range=obj_range)
+                self._dowrite(sf.path, obj_range=obj_range, ckpt=ckpt)
+        else:
+            self._dowrite(fname, obj_range=obj_range, ckpt=ckpt)
+
+        if ckpt is not None:
+            ckpt.clean()
+
+    def _get_checkpoint(self, fname, obj_range, chunksize):
+        """
+        the checkpoint covers the objects in obj_range
+        """
+        first, last = self._get_first_last(obj_range)
+        return checkpoint.ChunkCheckpoint(
+            fname,
+            self.m['id'][first:last+1],
+            chunksize,
+        )
+
+    def _get_first_last(self, obj_range):
+        if obj_range is None:
+            return 0, self.m.size-1
         else:
-            self._dowrite(fname, obj_range=obj_range)
+            return obj_range[0], obj_range[1]
 
-    def _dowrite(self, path, obj_range=None):
+    def _dowrite(self, path, obj_range=None, ckpt=None):
         if path[-8:] == '.fits.fz':
-            self._write_and_fpack(path, obj_range=obj_range)
+            self._write_and_fpack(path, obj_range=obj_range, ckpt=ckpt)
         else:
-            self._write(path, obj_range=obj_range)
+            self._write(path, obj_range=obj_range, ckpt=ckpt)
 
-    def _write_and_fpack(self, fname, obj_range=None):
+    def _write_and_fpack(self, fname, obj_range=None, ckpt=None):
         local_fitsname = fname.replace('.fits.fz','.fits')
         assert local_fitsname != fname
 
         with TempFile(local_fitsname) as tfile:
-            self._write(tfile.path, obj_range=obj_range)
+            self._write(tfile.path, obj_range=obj_range, ckpt=ckpt)
 
             # this will fpack to the proper path, which
             # will then be staged out if tmpdir is not None
@@ -46,42 +88,85 @@ class DESMEDSCoaddMaker(meds.MEDSCoaddMaker):
             # an exception raised
             util.fpack_file(tfile.path)
 
-    def _write(self, fname, obj_range=None):
+    def _write(self, fname, obj_range=None, ckpt=None):
+        if ckpt is not None:
+            self._write_chunks(ckpt, obj_range)
+            ckpt.merge(fname)
+        else:
+            self._write_range(fname, obj_range=obj_range)
+
+    def _write_range(self, fname, obj_range=None):
+        """
+        write the objects in obj_range using the MEDSMaker, with the psf
+        layout sized for those objects only
+        """
+        self._obj_range = obj_range
+        self._set_psf_layout()
+
         super(DESMEDSCoaddMaker,self).write(
             fname,
             obj_range=obj_range,
         )
 
+    def _write_chunks(self, ckpt, obj_range):
+        """
+        write the chunks not yet completed, recording each in the
+        checkpoint
+        """
+        first, _ = self._get_first_last(obj_range)
+
+        for ichunk, (start, end), chunk_file in ckpt.get_todo():
+            print("writing objects [%d, %d) to chunk: %s" % (
+                first+start, first+end, chunk_file,
+            ))
+            if os.path.exists(chunk_file):
+                os.remove(chunk_file)
+
+            self._write_range(
+                chunk_file,
+                obj_range=[first+start, first+end-1],
+            )
+
+            ckpt.set_completed(ichunk)
+
     def _set_psf_layout(self):
+        """
+        set the total number of psf pixels, using the largest psf of
+        the epochs for each object.  The psf shapes depend only on the
+        file, so they are taken from the registry in the coadder rather
+        than drawing a psf for each object and epoch
+
+        Only the objects in the range being written are counted, so the
+        psf extension of a chunk or shard is sized for its own objects
+        """
         print("setting psf layout")
 
         # to fool the maker; need to make psf type
         # more natural
         self.psf_data=1
 
-        max_box_size=0
-
         m=self.m
 
-        self.total_psf_pixels=0
-        for iobj in xrange(m.size):
+        first, last = self._get_first_last(getattr(self, '_obj_range', None))
+        ncutout = m['ncutout'][first:last+1]
+        file_id = m['file_id'][first:last+1].reshape(ncutout.size, -1)
 
-            # get the max of the epochs
-            ncutout=m['ncutout'][iobj]
-            if ncutout > 1:
-                tsizemax=0
-                for icut in xrange(1,m['ncutout'][iobj]):
-                    file_id=m['file_id'][iobj, icut]
+        # the coadd is the first cutout
+        icut = np.arange(file_id.shape[1])
+        use = (icut >= 1) & (icut < ncutout[:, np.newaxis])
+        file_id = np.where(use, file_id, 0)
 
-                    pim, pcen = self.coadder._get_psf_im(
-                        file_id,
-                        500,
-                        500,
-                    )
-                    tsizemax = max(tsizemax, pim.size)
-                    max_box_size = max(max_box_size, pim.shape[0])
+        # only the psfs of the files used in the range are loaded
+        shapes = self.coadder.get_psf_shapes(file_ids=file_id[use])
+        npix = shapes[:, 0]*shapes[:, 1]
 
-                self.total_psf_pixels += tsizemax
+        if use.any():
+            max_box_size = shapes[file_id[use], 0].max()
+        else:
+            max_box_size = 0
+
+        psf_pixels = np.where(use, npix[file_id], 0)
+        self.total_psf_pixels = int(psf_pixels.max(axis=1).sum())
 
         print("max box size:",max_box_size)
         self.total_psf_pixels = int(1.1*self.total_psf_pixels)
@@ -89,7 +174,28 @@ class DESMEDSCoaddMaker(meds.MEDSCoaddMaker):
 class DESMEDSCoadder(meds.MEDSCoadder):
     """
     implement DES specific stuff for postage stamp coadding
+
+    The random number generator is reseeded for each object from the seed
+    and the object index, so the results for an object do not depend on
+    which other objects are coadded, or in which process
+
+    The psfs can be psfex or piff models.  Color dependent piff models are
+    drawn with the psf_color of the object, if present in the object data
     """
+    def __init__(self, config, m, psfmap, seed, *args, **kwargs):
+        super(DESMEDSCoadder, self).__init__(
+            config, m, psfmap, seed, *args, **kwargs
+        )
+        self.seed = seed
+
+    def get_coadd(self, iobj, *args, **kwargs):
+        """
+        coadd the epochs for the object, after reseeding the random
+        number generator for this object
+        """
+        self.rng.seed([self.seed, iobj])
+        self._iobj = iobj
+        return super(DESMEDSCoadder, self).get_coadd(iobj, *args, **kwargs)
 
     '''
     def _set_target_jacobian(self):
@@ -126,38 +232,181 @@ class DESMEDSCoadder(meds.MEDSCoadder):
             dvdcol=-0.263,
         )
 
-    def _get_psf_im(self, file_id, row, col):
-        ii=self.m.get_image_info()
-        path=ii['image_path'][file_id]
-        key = extract_nullwt_key(path)
+    def get_psf_shapes(self, file_ids=None):
+        """
+        get the shape of the psf images for each file in the image info,
+        from get_rec_shape.  The shapes are computed once for each file,
+        and are [0, 0] for files with no psf, such as the coadd
+
+        parameters
+        ----------
+        file_ids: array, optional
+            Compute the shapes for these files only, so that only the psf
+            models they use are loaded.  Default all files
+
+        returns
+        -------
+        shapes: array
+            Array of shape [nfile, 2].  Entries for files not requested,
+            and not computed in an earlier call, are [0, 0]
+        """
+        keys = self._get_file_psf_keys()
+
+        if not hasattr(self, '_psf_shapes'):
+            self._psf_shapes = np.zeros((len(keys), 2), dtype='i8')
+            self._psf_shapes_done = np.zeros(len(keys), dtype=bool)
+
+        if file_ids is None:
+            file_ids = np.arange(len(keys))
+        else:
+            file_ids = np.unique(file_ids)
+
+        for file_id in file_ids[~self._psf_shapes_done[file_ids]]:
+            key = keys[file_id]
+            if key is not None:
+                self._psf_shapes[file_id] = (
+                    self.psfmap[key].get_rec_shape(500, 500)
+                )
+            self._psf_shapes_done[file_id] = True
+
+        return self._psf_shapes
+
+    def _get_file_psf_keys(self):
+        """
+        get the psf map key for each file in the image info, None for
+        files with no psf in the map.  The keys rather than the psfs are
+        kept, so a lazy psf map can release models it is not using
+        """
+        if not hasattr(self, '_file_psf_keys'):
+            ii=self.m.get_image_info()
+
+            self._file_psf_keys = []
+            for path in ii['image_path']:
+                try:
+                    key = extract_nullwt_key(path)
+                except IndexError:
+                    # not a single epoch file name, e.g. the coadd
+                    key = None
+
+                if key not in self.psfmap:
+                    key = None
+
+                self._file_psf_keys.append(key)
+
+        return self._file_psf_keys
+
+    def _get_psf_im(self, file_id, row, col, color=None):
+        key = self._get_file_psf_keys()[file_id]
+        if key is None:
+            ii=self.m.get_image_info()
+            raise KeyError(
+                "no psf for %s" % makestr(ii['image_path'][file_id])
+            )
 
         p = self.psfmap[key]
-        pim = p.get_rec(row, col)
+        if color is not None:
+            pim = p.get_rec(row, col, color=color)
+        else:
+            pim = p.get_rec(row, col)
 
         pcen = p.get_center(row, col)
 
         return pim, pcen
 
+    def _get_psf_color(self, file_id):
+        """
+        get the psf color of the object being coadded, or None if the psf
+        for the file does not use colors or there is no psf_color in the
+        object data
+        """
+        iobj = getattr(self, '_iobj', None)
+        if iobj is None:
+            return None
+
+        key = self._get_file_psf_keys()[file_id]
+        if key is None:
+            return None
+
+        if getattr(self.psfmap[key], 'color_name', None) is None:
+            return None
+
+        if not hasattr(self, '_psf_colors'):
+            cat = self.m.get_cat()
+            if 'psf_color' in cat.dtype.names:
+                self._psf_colors = cat['psf_color']
+            else:
+                self._psf_colors = None
+
+        if self._psf_colors is None:
+            return None
+        else:
+            return float(self._psf_colors[iobj])
+
+    def _check_psf_type(self):
+        """
+        the psf config is either a single config or holds the single epoch
+        config in 'se'
+        """
+        psf_conf = self['psf']
+        if 'se' in psf_conf:
+            psf_conf = psf_conf['se']
+
+        assert psf_conf['type'] in ('psfex', 'piff'), \
+            "only psfex or piff supported"
+
+    def _get_psf_im_cached(self, file_id, row, col, color=None):
+        """
+        get the psf image and center, caching by file, position and color.
+        This is used when the psfs are not dithered, in which case the
+        positions are integer pixels and repeat often
+
+        The least recently used images are dropped once the cache holds
+        psf_cache_size images
+        """
+        if not hasattr(self, '_psf_cache'):
+            self._psf_cache = OrderedDict()
+
+        cache = self._psf_cache
+        key = (file_id, row, col, color)
+
+        if key in cache:
+            cache.move_to_end(key)
+        else:
+            cache[key] = self._get_psf_im(file_id, row, col, color=color)
+
+            max_size = self.get('psf_cache_size', DEFAULT_PSF_CACHE_SIZE)
+            while len(cache) > max_size:
+                cache.popitem(last=False)
+
+        # copies so the cached versions cannot be modified
+        pim, pcen = cache[key]
+        return pim.copy(), np.array(pcen, copy=True)
+
     def _get_psf_obs_fake(self, obs, file_id, meta, row, col):
         """
-        psfex specific code here
+        psfex or piff, with the PIFFWrapper providing the psfex interface
 
         for psfex we need to add 0.5 to get an offset
         that is the same as used for the object
         """
         import ngmix
-        assert self['psf']['type']=='psfex',"only psfex for now"
+        self._check_psf_type()
 
         pmeta={}
+        color = self._get_psf_color(file_id)
 
         if self['dither_psfs']:
             rowget=row+0.5
             colget=col+0.5
+            pim, pcen = self._get_psf_im(file_id, rowget, colget, color=color)
         else:
             #print("not dithering psfs")
             rowget=int(row)
             colget=int(col)
-        pim, pcen = self._get_psf_im(file_id, rowget, colget)
+            pim, pcen = self._get_psf_im_cached(
+                file_id, rowget, colget, color=color,
+            )
+
         psf_weight=np.zeros(pim.shape) + 1.0/0.001**2
 
         ccen=(np.array(pim.shape)-1.0)/2.0
@@ -202,24 +451,29 @@ class DESMEDSCoadder(meds.MEDSCoadder):
 
     def _get_psf_obs(self, obs, file_id, meta, row, col):
         """
-        psfex specific code here
+        psfex or piff, with the PIFFWrapper providing the psfex interface
 
         for psfex we need to add 0.5 to get an offset
         that is the same as used for the object
         """
         import ngmix
-        assert self['psf']['type']=='psfex',"only psfex for now"
+        self._check_psf_type()
 
         pmeta={}
+        color = self._get_psf_color(file_id)
 
         if self['dither_psfs']:
             rowget=row+0.5
             colget=col+0.5
+            pim, pcen = self._get_psf_im(file_id, rowget, colget, color=color)
         else:
             #print("not dithering psfs")
             rowget=int(row)
             colget=int(col)
-        pim, pcen = self._get_psf_im(file_id, rowget, colget)
+            pim, pcen = self._get_psf_im_cached(
+                file_id, rowget, colget, color=color,
+            )
+
         ccen=(np.array(pim.shape)-1.0)/2.0
 
         # for psfex we assume the jacobian is the same, not
@@ -243,6 +497,141 @@ class DESMEDSCoadder(meds.MEDSCoadder):
         )
         return psf_obs
 
+# set in the parent process before forking to coadd in parallel
+_COADD_ARGS = None
+
+
+def write_parallel(config,
+                   meds_file,
+                   psfmap,
+                   seed,
+                   fname,
+                   nworkers,
+                   obj_range=None,
+                   tmpdir=None,
+                   make_plots=False):
+    """
+    coadd the objects using parallel processes, each with its own
+    DESMEDSCoadder, and merge the results into a single file
+
+    The objects are split into one contiguous range per process, each
+    written to its own shard file next to the output and then merged.  The
+    psf extension of each shard is sized for the objects in its range
+
+    parameters
+    ----------
+    config: dict
+        The meds config
+    meds_file: string
+        The MEDS file to coadd
+    psfmap: mapping
+        The psf map, e.g. from util.load_psfmap; inherited by the
+        processes
+    seed: int
+        Seed for the random number generator; each object gets its own
+        generator seeded from this
+    fname: string
+        The output file
+    nworkers: int
+        Number of processes
+    obj_range: sequence, optional
+        The first and last object to process, inclusive
+    tmpdir: string, optional
+        Temporary directory for writing the file
+    make_plots: bool, optional
+        If True, make plots of each epoch and the coadd
+    """
+    import fitsio
+
+    global _COADD_ARGS
+
+    if obj_range is None:
+        with fitsio.FITS(meds_file) as fits:
+            nobj = fits[shards.OBJECT_DATA_EXT].get_nrows()
+        first, last = 0, nobj-1
+    else:
+        first, last = obj_range[0], obj_range[1]
+
+    print("writing MEDS file:",fname)
+
+    _COADD_ARGS = {
+        'config': config,
+        'meds_file': meds_file,
+        'psfmap': psfmap,
+        'seed': seed,
+        'first': first,
+        'last': last,
+        'nworkers': nworkers,
+        'make_plots': make_plots,
+    }
+
+    try:
+        with StagedOutFile(fname,tmpdir=tmpdir) as sf:
+            if sf.path[-8:] == '.fits.fz':
+                local_fitsname = sf.path.replace('.fits.fz','.fits')
+
+                with TempFile(local_fitsname) as tfile:
+                    _write_shards(tfile.path)
+                    util.fpack_file(tfile.path)
+            else:
+                _write_shards(sf.path)
+    finally:
+        _COADD_ARGS = None
+
+
+def _write_shards(fname):
+    """
+    write the shards in parallel and merge them into the uncompressed
+    file
+    """
+    import multiprocessing
+
+    args = _COADD_ARGS
+    ranges = shards.get_shard_ranges(
+        args['last'] - args['first'] + 1,
+        args['nworkers'],
+    )
+    shard_files = [
+        shards.get_shard_file(fname, i) for i in range(len(ranges))
+    ]
+    print("coadding with %d processes" % len(ranges))
+
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(processes=len(ranges)) as pool:
+            pool.starmap(_write_shard, zip(ranges, shard_files))
+
+        shards.merge_meds_files(shard_files, fname)
+    finally:
+        shards.remove_shard_files(shard_files)
+
+
+def _write_shard(obj_range, fname):
+    """
+    coadd the objects in the range [start, end), relative to the first
+    object, into the shard file
+    """
+    args = _COADD_ARGS
+
+    start = args['first'] + obj_range[0]
+    end = args['first'] + obj_range[1]
+    print("coadding objects [%d, %d) to shard: %s" % (start, end, fname))
+
+    # each process opens the MEDS file itself, rather than sharing the
+    # file handle of the parent
+    meds_obj = meds.MEDS(args['meds_file'])
+
+    coadder = DESMEDSCoadder(
+        args['config'],
+        meds_obj,
+        args['psfmap'],
+        args['seed'],
+        make_plots=args['make_plots'],
+    )
+    maker = DESMEDSCoaddMaker(args['config'], coadder)
+    maker.write(fname, obj_range=[start, end-1])
+
+
 def extract_nullwt_key(path):
     """
     expecting D00239652_i_c14_r2362p01_immasked_nullwt.fits
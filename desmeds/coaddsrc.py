@@ -7,6 +7,7 @@ import numpy
 import fitsio
 
 from . import files
+from . import srctable
 from .coaddinfo import Coadd
 
 class CoaddSrc(Coadd):
@@ -19,39 +20,44 @@ class CoaddSrc(Coadd):
 
     def get_info(self):
         """
-        get info for the specified tilename and band
+        get info for the specified tilename and band, as a list of dicts
+        """
+        return srctable.table_to_srclist(self.get_table())
+
+    def get_table(self):
+        """
+        get info for the specified tilename and band, as a source table
+        with one row per source image; see srctable.py
         """
 
-        if hasattr(self,'_info_list'):
-            info_list=self._info_list
+        if hasattr(self,'_table'):
+            table=self._table
         else:
-            info_list = self._do_query()
+            table = self._do_query()
 
-            # sort the list to make code stable
-            info_list = self._sort_list(info_list)
+            # sort the table to make code stable
+            table = self._sort_table(table)
 
             # add full path info
-            self._add_full_paths(info_list)
+            table = self._add_full_paths(table)
 
-            self._info_list=info_list
+            self._table=table
 
-        return info_list
+        return table
 
-    def _sort_list(self, info_list):
+    def _sort_table(self, table):
         """
-        sort the list to make class stable against random return order
+        sort the table to make class stable against random return order
         from the database
         """
 
         # build hashes and sort
         hashes = []
-        for i in range(len(info_list)):
-            hash_str = "%s%s" % (
-                info_list[i]['expnum'],
-                info_list[i]['ccdnum'])
+        for expnum, ccdnum in zip(table['expnum'], table['ccdnum']):
+            hash_str = "%s%s" % (expnum, ccdnum)
             hashes.append(hashlib.md5(hash_str.encode('utf-8')).hexdigest())
         inds = numpy.argsort(hashes)
-        return [info_list[i] for i in inds]
+        return table[inds]
 
     def _do_query(self):
         """
@@ -70,29 +76,15 @@ class CoaddSrc(Coadd):
         curs = conn.cursor()
         curs.execute(query)
 
-        info_list=[]
-
-        for row in curs:
-            tile,expnum,ccdnum,path,fname,comp,band,pai,magzp = row
-            info = {
-                'tilename':tile,
-                'expnum':expnum,
-                'ccdnum':ccdnum,
-                'filename':fname,
-                'compression':comp,
-                'path':path,
-                'band':band,
-                'pfw_attempt_id':pai,
-                'magzp': magzp,
-            }
-            info_list.append(info)
+        rows = curs.fetchall()
+        table = self._rows_to_table(rows)
 
         if (
             'Y6' in self['campaign']
             and "piff_campaign" in self
             and self["piff_campaign"] is not None
         ):
-            imgs = ["'%s'" % info['filename'] for info in info_list]
+            imgs = ["'%s'" % fname for fname in table['filename']]
             query = _QUERY_COADD_SRC_PIFF_FILES_Y6 % dict(
                 piff_campaign=self['piff_campaign'],
                 imgs=",".join(imgs)
@@ -107,57 +99,118 @@ class CoaddSrc(Coadd):
                 im, piff, path, band, expnum, ccdnum = row
                 piff_map[(im, band, expnum, ccdnum)] = (path, piff)
 
-            cut = 0
-            new_info_list = []
-            for info in info_list:
-                key = (info['filename'], info['band'], info['expnum'], info['ccdnum'])
-                if key in piff_map:
-                    info['piff_path'] = os.path.join(piff_map[key][0], piff_map[key][1])
-                    new_info_list.append(info)
-                else:
-                    cut += 1
-
-            print("cut %d SE source for missing piff files" % cut)
-            info_list = new_info_list
-
-        return info_list
+            keys = zip(
+                table['filename'].tolist(),
+                table['band'].tolist(),
+                table['expnum'].tolist(),
+                table['ccdnum'].tolist(),
+            )
+            piff_paths = [
+                os.path.join(*piff_map[key]) if key in piff_map else ''
+                for key in keys
+            ]
+            piff_paths = numpy.array(piff_paths, dtype='U')
+            keep = piff_paths != ''
+
+            print("cut %d SE source for missing piff files" % (~keep).sum())
+            table = srctable.add_columns(
+                table[keep],
+                {'piff_path': piff_paths[keep]},
+            )
 
+        return table
 
-    def _add_full_paths(self, info_list):
+    def _rows_to_table(self, rows):
+        """
+        convert the rows returned by the source query into a table
+        """
+        names = [
+            ('tilename', 'U'),
+            ('expnum', 'i8'),
+            ('ccdnum', 'i8'),
+            ('path', 'U'),
+            ('filename', 'U'),
+            ('compression', 'U'),
+            ('band', 'U'),
+            ('pfw_attempt_id', 'i8'),
+            ('magzp', 'f8'),
+        ]
+
+        columns = {}
+        for i, (name, dtype) in enumerate(names):
+            columns[name] = numpy.array([row[i] for row in rows], dtype=dtype)
+
+        return srctable.make_src_table(columns)
+
+    def _add_full_paths(self, table):
         """
         seg maps have .fz for finalcut
         """
 
+        filenames = table['filename']
+        comp = table['compression']
+
+        columns = {}
+        columns['image_path'] = _join_paths(
+            self._get_dir_column(table, 'image'),
+            numpy.char.add(filenames, comp),
+        )
+
+        columns['bkg_path'] = _join_paths(
+            self._get_dir_column(table, 'bkg'),
+            numpy.char.add(
+                numpy.char.replace(filenames, 'immasked.fits', 'bkg.fits'),
+                comp,
+            ),
+        )
+
+        columns['seg_path'] = _join_paths(
+            self._get_dir_column(table, 'seg'),
+            numpy.char.add(
+                numpy.char.replace(filenames, 'immasked.fits', 'segmap.fits'),
+                comp,
+            ),
+        )
+
+        columns['psf_path'] = _join_paths(
+            self._get_dir_column(table, 'psf'),
+            numpy.char.replace(filenames, 'immasked.fits', 'psfexcat.psf'),
+        )
 
-        for info in info_list:
+        if "piff_campaign" in self and self["piff_campaign"] is not None:
+            columns['piff_path'] = _join_paths(
+                self._get_dir_column(table, 'piff'),
+                srctable.basenames(table['piff_path']),
+            )
 
-            dirdict=self._get_all_dirs(info)
+        return srctable.add_columns(table, columns)
 
-            info['image_path'] = os.path.join(
-                dirdict['image']['local_dir'],
-                info['filename']+info['compression'],
-            )
+    def _get_dir_column(self, table, type):
+        """
+        get the local directory of the given type for each source
 
-            info['bkg_path'] = os.path.join(
-                dirdict['bkg']['local_dir'],
-                info['filename'].replace('immasked.fits','bkg.fits')+info['compression'],
-            )
+        Many sources share a path, so the directories are only
+        determined once for each unique path
+        """
+        if type == 'piff':
+            paths = numpy.char.rpartition(table['piff_path'], '/')[..., 0]
+        else:
+            paths = table['path']
 
-            info['seg_path'] = os.path.join(
-                dirdict['seg']['local_dir'],
-                info['filename'].replace('immasked.fits','segmap.fits')+info['compression'],
-            )
+        if paths.size == 0:
+            return numpy.zeros(0, dtype='U1')
 
-            info['psf_path'] = os.path.join(
-                dirdict['psf']['local_dir'],
-                info['filename'].replace('immasked.fits','psfexcat.psf')
-            )
+        upaths, rev = numpy.unique(paths, return_inverse=True)
 
-            if "piff_campaign" in self and self["piff_campaign"] is not None:
-                info['piff_path'] = os.path.join(
-                    dirdict['piff']['local_dir'],
-                    os.path.basename(info['piff_path']),
-                )
+        if type == 'image':
+            dirs = [self._get_dirs(path)['local_dir'] for path in upaths]
+        else:
+            dirs = [
+                self._get_dirs(path, type=type)['local_dir']
+                for path in upaths
+            ]
+
+        return numpy.array(dirs, dtype='U')[rev]
 
     def _get_all_dirs(self, info):
         dirs={}
@@ -224,6 +277,18 @@ class CoaddSrc(Coadd):
         raise NotImplementedError("use Coadd to remove")
 
 
+def _join_paths(dirs, names):
+    """
+    vectorized os.path.join for arrays of directories and file names
+    """
+    dirs = numpy.where(
+        numpy.char.endswith(dirs, '/'),
+        dirs,
+        numpy.char.add(dirs, '/'),
+    )
+    return numpy.char.add(dirs, names)
+
+
 #select imagename, mag_zero from ZEROPOINT where IMAGENAME='D00504555_z_c41_r2378p01_immasked.fits' and source='FGCM' and version='v2.0';
 
 _QUERY_COADD_SRC="""
@@ -62,6 +62,9 @@ default_config = {
     'min_box_size': 32,
     'max_box_size': 256,
 
+    # optional budget for the total pixels in the boxes, see boxsizes.py
+    'box_size_budget': None,
+
     # astrometry gets refined during coaddition
     'use_astro_refine': True,
 
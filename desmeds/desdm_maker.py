@@ -6,15 +6,15 @@ import numpy
 from numpy import zeros, sqrt, log
 import subprocess
 import shutil
+import json
 import yaml
 
 import fitsio
-import galsim
 import esutil as eu
 
-import meds
-
 from . import util
+from . import srctable
+from . import checkpoint
 
 from . import files
 from .defaults import default_config
@@ -27,6 +27,20 @@ from .maker import DESMEDSMaker
 
 fwhm_fac = 2*sqrt(2*log(2))
 
+# object data fields taken from the reference band when building the
+# object data for a band from the shared data; all other fields are
+# filled from the catalog for the band
+SHARED_OBJ_DATA_FIELDS = [
+    'id',
+    'number',
+    'box_size',
+    'ra',
+    'dec',
+    'input_row',
+    'input_col',
+    'wcs_color',
+]
+
 
 class DESMEDSMakerDESDM(DESMEDSMaker):
     """
@@ -34,8 +48,9 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
     all inputs are explicit rather than relying on database
     queries
 
-    No "stubby" meds file is created, because DESDM does
-    not allow pipelines
+    By default no "stubby" meds file is created, because DESDM does
+    not allow pipelines.  One can be written with write_stubby and
+    used later by sending stubby= on construction
 
     parameters
     ----------
@@ -57,15 +72,30 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
                 path to the bkg file list
             meds_url: string
                 path to the output meds file
+    tmpdir: string, optional
+        Temporary directory for writing the file
+    shared: dict, optional
+        Object data shared between bands, as produced by
+        multiband.ObjectDataBuilder.  If sent, the coadd catalog and object
+        map are not read; only the columns for fields not in
+        SHARED_OBJ_DATA_FIELDS, such as the photometry, are read from the
+        catalog for this band
+    stubby: string, optional
+        Path to a stubby file written by write_stubby.  If sent, the inputs
+        for the MEDSMaker are read from this file and only the psfs are
+        loaded, so no catalogs, file lists or headers are read
     """
     def __init__(self,
                  medsconf,
                  fileconf,
-                 tmpdir=None):
+                 tmpdir=None,
+                 shared=None,
+                 stubby=None):
 
         self.medsconf = medsconf
         self.fileconf = fileconf
         self.tmpdir = tmpdir
+        self.shared = shared
 
         self._load_config(medsconf)
         self._load_file_config(fileconf)
@@ -75,29 +105,138 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
         # not relevant for this version
         self.DESDATA = 'rootless'
 
+        if stubby is not None:
+            self._load_stubby(stubby)
+            return
+
         self._load_coadd_info()
-        self._read_coadd_cat()
-        self._build_image_data()
-        self._build_meta_data()
-        self._build_object_data()
+        if self.shared is None:
+            with self._stage('catalog_read'):
+                self._read_coadd_cat()
+        with self._stage('image_info'):
+            self._build_image_data()
+        with self._stage('meta_data'):
+            self._build_meta_data()
+        with self._stage('object_data'):
+            if self.shared is None:
+                self._build_object_data()
+            else:
+                self._build_object_data_from_shared()
 
-    def go(self, fname=None):
+    def write_stubby(self, fname=None):
         """
-        write the data using the MEDSMaker
+        write the inputs for the MEDSMaker to a "stubby" file, from which
+        the MEDS file can later be made without access to the catalogs,
+        file lists or image headers; only the psf files are needed
+
+        parameters
+        ----------
+        fname: string, optional
+            The stubby file name, default is next to the meds_url from the
+            file config
         """
+        if fname is None:
+            fname = files.get_desdm_stubby_file(self.file_dict['meds_url'])
 
-        maker = meds.MEDSMaker(
-            self.obj_data,
-            self.image_info,
-            config=self,
-            meta_data=self.meta_data,
-            psf_data=self.psf_data,
-            psf_info=self.psf_info,
-        )
+        print("writing stubby file:", util.munge_meds_dir(fname))
+
+        with StagedOutFile(fname, tmpdir=self.tmpdir) as sf:
+            with fitsio.FITS(sf.path, 'rw', clobber=True) as fits:
+                fits.write(self.obj_data, extname='object_data')
+                fits.write(self.image_info, extname='image_info')
+                fits.write(self.meta_data, extname='metadata')
+
+                if self.psf_files is not None:
+                    fits.write(self.psf_files, extname='psf_files')
+                if self.psf_info is not None:
+                    fits.write(self.psf_info, extname='psf_info')
+
+                report = getattr(self, 'box_size_report', None)
+                if report is not None:
+                    fits.write(report, extname='box_size_report')
+
+    def _load_stubby(self, fname):
+        """
+        load the inputs for the MEDSMaker from a stubby file.  The psfs it
+        references are loaded by go, see _load_psfs
+        """
+        print("reading stubby file:", util.munge_meds_dir(fname))
+
+        with self._stage('stubby_read'), fitsio.FITS(fname) as fits:
+            self.obj_data = fits['object_data'].read()
+            self.image_info = fits['image_info'].read()
+            self.meta_data = fits['metadata'].read()
+
+            self.psf_files = None
+            self.psf_info = None
+            self.box_size_report = None
+
+            if 'psf_files' in fits:
+                self.psf_files = fits['psf_files'].read()
+            if 'psf_info' in fits:
+                self.psf_info = fits['psf_info'].read()
+            if 'box_size_report' in fits:
+                self.box_size_report = fits['box_size_report'].read()
+
+        self.psf_data = None
+
+    def _load_psfs(self):
+        """
+        load the psfs listed in psf_files, setting the refined astrometry
+        for the piff psfs from the image info
+
+        This is deferred until the MEDS file is written, so that writing
+        only the stubby file does not load any psfs
+        """
+        if self.psf_files is None:
+            self.psf_data = None
+            return
+
+        with self._stage('psf_load'):
+            self.psf_data = self._load_psf_data(self.psf_files)
+
+        for i, file_id in enumerate(self.psf_files['wcs_file_id']):
+            if file_id >= 0 and hasattr(self.psf_data[i], "set_wcs"):
+                wcs_header = json.loads(self.image_info['wcs'][file_id])
+                self.psf_data[i].set_wcs(MyWCS(wcs_header))
+
+    def go(self, fname=None, nshards=1, chunksize=None):
+        """
+        write the data using the MEDSMaker
+
+        parameters
+        ----------
+        fname: string, optional
+            The output file name, default is the meds_url from the file
+            config
+        nshards: int, optional
+            If greater than one, the objects are split into this many
+            disjoint ranges, which are written in parallel processes and
+            then merged into a single file.  Default 1
+        chunksize: int, optional
+            If sent, the objects are written in chunks of this size, with
+            progress recorded in a checkpoint file next to the output.  If
+            the job is killed, running again continues from the last
+            completed chunk.  Cannot be used with nshards > 1
+        """
 
         if fname is None:
             fname = self.file_dict['meds_url']
 
+        if self.psf_data is None:
+            self._load_psfs()
+
+        ckpt = None
+        if chunksize is not None:
+            if nshards > 1:
+                raise ValueError("chunksize cannot be used with nshards > 1")
+
+            ckpt = checkpoint.ChunkCheckpoint(
+                fname,
+                self.obj_data['id'],
+                chunksize,
+            )
+
         print("writing MEDS file:", util.munge_meds_dir(fname))
 
         # this will do nothing if tmpdir is None; sf.path will
@@ -105,28 +244,115 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
 
         if self.tmpdir is not None:
             with StagedOutFile(fname, tmpdir=self.tmpdir) as sf:
-                if sf.path[-8:] == '.fits.fz':
-                    self._write_and_fpack(maker, sf.path)
-                else:
-                    maker.write(sf.path)
+                self._write_meds(sf.path, nshards=nshards, ckpt=ckpt)
+                with self._stage('stage_out'):
+                    sf.stage_out()
         else:
-            if fname[-8:] == '.fits.fz':
-                self._write_and_fpack(maker, fname)
-            else:
+            self._write_meds(fname, nshards=nshards, ckpt=ckpt)
+
+        if ckpt is not None:
+            ckpt.clean()
+
+        self._write_box_size_report(fname)
+        self._write_instrumentation(fname)
+
+    def _get_meds_maker(self, obj_data=None):
+        """
+        get a MEDSMaker for all or a subset of the objects
+        """
+        import meds
+
+        if obj_data is None:
+            obj_data = self.obj_data
+
+        return meds.MEDSMaker(
+            obj_data,
+            self.image_info,
+            config=self,
+            meta_data=self.meta_data,
+            psf_data=self.psf_data,
+            psf_info=self.psf_info,
+        )
+
+    def _write_meds(self, fname, nshards=1, ckpt=None):
+        """
+        write the file, compressing if the name ends in .fits.fz
+        """
+        if fname[-8:] == '.fits.fz':
+            self._write_and_fpack(fname, nshards=nshards, ckpt=ckpt)
+        else:
+            self._write_uncompressed(fname, nshards=nshards, ckpt=ckpt)
+
+    def _write_uncompressed(self, fname, nshards=1, ckpt=None):
+        if ckpt is not None:
+            self._write_chunks(ckpt)
+            with self._stage('merge'):
+                ckpt.merge(fname)
+        elif nshards > 1:
+            self._write_sharded(fname, nshards)
+        else:
+            with self._stage('meds_write'):
+                maker = self._get_meds_maker()
                 maker.write(fname)
 
+    def _write_chunks(self, ckpt):
+        """
+        write the chunks not yet completed, recording each in the
+        checkpoint
+        """
+        for ichunk, (start, end), chunk_file in ckpt.get_todo():
+            print("writing objects [%d, %d) to chunk: %s" % (
+                start, end, chunk_file,
+            ))
+            if os.path.exists(chunk_file):
+                os.remove(chunk_file)
+
+            with self._stage('meds_write', chunk=ichunk):
+                maker = self._get_meds_maker(
+                    obj_data=self.obj_data[start:end],
+                )
+                maker.write(chunk_file)
+
+            ckpt.set_completed(ichunk)
+
+    def _write_sharded(self, fname, nshards):
+        """
+        write the objects in shards using parallel processes, and merge
+        them into the final file
+        """
+        import multiprocessing
+        from . import shards
+
+        ranges = shards.get_shard_ranges(self.obj_data.size, nshards)
+        shard_files = [
+            shards.get_shard_file(fname, i) for i in range(len(ranges))
+        ]
+        print("writing %d shards" % len(ranges))
+
+        # the psf objects are not generally picklable, so we fork and
+        # let the child processes inherit the maker
+        global _SHARD_MAKER
+        _SHARD_MAKER = self
+
+        try:
+            ctx = multiprocessing.get_context('fork')
+            with self._stage('meds_write', nshards=len(ranges)):
+                with ctx.Pool(processes=len(ranges)) as pool:
+                    pool.starmap(_write_shard, zip(ranges, shard_files))
+
+            with self._stage('merge'):
+                shards.merge_meds_files(shard_files, fname)
+        finally:
+            _SHARD_MAKER = None
+            shards.remove_shard_files(shard_files)
+
     def _get_image_id_len(self, srclist):
         """
         for y3 using string ids
         """
         image_id_len = len(self.cf['image_id'])
 
-        for s in srclist:
-            tlen = len(s['id'])
-            if tlen > image_id_len:
-                image_id_len = tlen
-
-        return image_id_len
+        return max(image_id_len, srctable.get_max_str_len(srclist, ['id']))
 
     def _load_coadd_info(self):
         """
@@ -150,23 +376,28 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
         # probably from from header MAGZERO
         cf['magzp'] = fd['coadd_magzp']
 
-        cf['srclist'] = self._load_srclist()
-        for i in range(len(cf['srclist'])):
-            ccdnum = (
-                os.path.basename(cf['srclist'][i]['red_image'])
-                .split("_")[2][1:]
-            )
-            band = (
-                os.path.basename(cf['srclist'][i]['red_image'])
-                .split("_")[1]
-            )
-            cf['srclist'][i]['ccdnum'] = int(ccdnum)
-            cf['srclist'][i]['band'] = band
+        with self._stage('srclist_load'):
+            srclist = self._load_srclist()
+        _, bandstr, ccdstr = srctable.get_exp_band_ccd(srclist['red_image'])
+        if srclist.size > 0:
+            ccdnum = np.char.lstrip(ccdstr, 'c').astype('i4')
+        else:
+            ccdnum = np.zeros(0, dtype='i4')
+
+        cf['srclist'] = srctable.add_columns(
+            srclist,
+            {'ccdnum': ccdnum, 'band': bandstr},
+        )
 
         if 'psf_flist' in fd or 'piff_flist' in fd:
-            self.psf_data = self._load_psf_data(cf)
+            self.psf_info = self._load_psf_info()
+            self.psf_files = self._get_psf_files(cf)
         else:
-            self.psf_data = None
+            self.psf_info = None
+            self.psf_files = None
+
+        # the psfs are loaded by go, see _load_psfs
+        self.psf_data = None
 
         # In this case, we can use refband==input band, since
         # not using a db query or anything
@@ -175,26 +406,36 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
 
         if (
             self["use_astro_refine"]
-            and len(self.psf_data) > 0
+            and self.psf_files is not None
             and cf["srclist"][0]["wcs_header"] is not None
         ):
             print("using atsro refine with Piff PSF solution", flush=True)
-            for i in range(len(self.psf_data)):
-                if not hasattr(self.psf_data[i], "set_wcs"):
+
+            # the last match wins, as for a linear search
+            expstr, bandstr, ccdstr = srctable.get_exp_band_ccd(
+                cf["srclist"]["red_image"],
+            )
+            locs = {}
+            for j, key in enumerate(zip(expstr, bandstr, ccdstr)):
+                locs[key] = j
+
+            # only piff psfs take the refined astrometry; the first psf is
+            # for the coadd
+            paths = self.psf_files['path'].astype('U')
+            for i, path in enumerate(paths):
+                conf = self['psf']['coadd'] if i == 0 else self['psf']['se']
+                if conf['type'] != 'piff':
                     continue
-                fname = os.path.basename(self.psf_data[i]["filename"])
-                exp_band_ccd = "_".join(fname.split("_")[:3])
-                loc = None
-                for j in range(len(cf["srclist"])):
-                    if os.path.basename(
-                        cf["srclist"][j]["red_image"]
-                    ).startswith(exp_band_ccd):
-                        loc = j
+
+                fname = os.path.basename(path)
+                key = tuple(fname.split("_")[:3])
+                loc = locs.get(key)
                 assert loc is not None, (
                     "Could not find image for Piff PSF file %s!" % fname
                 )
-                wcs = MyWCS(cf["srclist"][loc]["wcs_header"])
-                self.psf_data[i].set_wcs(wcs)
+
+                # the image_info row holding the wcs, see _load_psfs
+                self.psf_files['wcs_file_id'][i] = loc + 1
 
     """
     def _get_wcs(self, file_id):
@@ -226,6 +467,68 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
         q = numpy.argsort(self.coadd_cat['number'])
         self.coadd_cat = self.coadd_cat[q]
 
+    def _build_object_data_from_shared(self):
+        """
+        copy the object data shared between bands, adding the photometry
+        and psf colors for this band
+
+        Only the ids, positions and box sizes in SHARED_OBJ_DATA_FIELDS are
+        taken from the reference band.  The other fields are filled from
+        the catalog for this band, as _build_object_data would
+        """
+        print('building object data from shared data for refband',
+              self.shared['refband'])
+
+        self.obj_data = self.shared['obj_data'].copy()
+
+        # the box sizes come from the reference band
+        self.box_size_report = self.shared.get('box_size_report', None)
+
+        fname = expandvars(self.file_dict['coadd_cat_url'])
+        print('reading coadd cat photometry:', util.munge_meds_dir(fname))
+        cat = fitsio.read(
+            fname,
+            columns=self._get_band_catalog_field_names(fname),
+            lower=True,
+        )
+        q = numpy.argsort(cat['number'])
+        cat = cat[q]
+
+        mess = "coadd cat for band %s does not match refband %s" % (
+            self.file_dict['band'], self.shared['refband'],
+        )
+        assert numpy.array_equal(cat['number'], self.obj_data['number']), mess
+
+        copy_names = [
+            name for name in cat.dtype.names
+            if (name in self.obj_data.dtype.names
+                and name not in SHARED_OBJ_DATA_FIELDS)
+        ]
+        for name in copy_names:
+            self.obj_data[name] = cat[name]
+
+        self._copy_catalog_fields(cat)
+
+        iddata = self._get_coadd_objects_ids()
+        self.obj_data['psf_color'] = iddata['psf_color']
+
+    def _get_band_catalog_field_names(self, fname):
+        """
+        names of the catalog columns read for a band when building from
+        the shared data: those copied by _copy_catalog_fields and those
+        matching object data fields, as copied by _build_object_data
+        """
+        names = self._get_catalog_field_names()
+
+        with fitsio.FITS(fname) as fits:
+            colnames = [n.lower() for n in fits[1].get_colnames()]
+
+        for name in colnames:
+            if name in self.obj_data.dtype.names and name not in names:
+                names.append(name)
+
+        return names
+
     def _get_srclist(self):
         """
         mock up the interface for the Coadd class
@@ -236,7 +539,7 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
         """
         get all the necessary information for each source image
         """
-        # this is a list of dicts
+        # this is a source table, see srctable.py
         srclist = self._load_source_image_info()
         nepoch = len(srclist)
 
@@ -283,70 +586,127 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
                         "list has %d elements" % (len(piff_flist), nepoch)
                     )
 
-            for i, src in enumerate(srclist):
-                src['red_bkg'] = bkg_info[i]
-                src['red_seg'] = seg_info[i]
+            columns = {
+                'red_bkg': np.array(bkg_info, dtype='U'),
+                'red_seg': np.array(seg_info, dtype='U'),
+            }
+            if 'psf_flist' in fd:
+                columns['red_psf'] = np.array(psf_flist, dtype='U')
+            if 'piff_flist' in fd:
+                columns['red_psf_piff'] = np.array(piff_flist, dtype='U')
 
-                if 'psf_flist' in fd:
-                    src['red_psf'] = psf_flist[i]
-                if 'piff_flist' in fd:
-                    src['red_psf_piff'] = piff_flist[i]
+            srclist = srctable.add_columns(srclist, columns)
 
             self._verify_src_info(srclist)
 
         return srclist
 
-    def _load_psf_data(self, cf):
+    def _load_psf_info(self):
         """
-        load all psfs into a list
+        load the psf info table, if one was sent in the file config
         """
-
-        print('loading psf data')
-
-        assert 'coadd_psf_url' in self.file_dict, \
-            'you must set both coadd_psf_url and psf_flist or piff_flist'
-
-        assert 'psf' in self, 'you must have a psf entry when loading psfs'
-
         if 'psf_info' in self.file_dict:
             print(
                 'loading psf info from:',
                 util.munge_meds_dir((self.file_dict['psf_info']))
             )
-            self.psf_info = fitsio.read(
+            psf_info = fitsio.read(
                 self.file_dict['psf_info'], lower=True
             )
-            assert 'filename' in self.psf_info.dtype.names
+            assert 'filename' in psf_info.dtype.names
         else:
-            self.psf_info = None
+            psf_info = None
 
-        psf_data = []
+        return psf_info
 
-        psf = self._load_one_psf(cf['psf_url'], self['psf']['coadd'])
-        psf_data.append(psf)
+    def _get_psf_files(self, cf):
+        """
+        get the psf file for each image, the coadd first followed by the
+        single epoch images.  The ccdnum and band are -1 and '' for the
+        coadd
+        """
+        assert 'coadd_psf_url' in self.file_dict, \
+            'you must set both coadd_psf_url and psf_flist or piff_flist'
+
+        assert 'psf' in self, 'you must have a psf entry when loading psfs'
 
+        srclist = cf['srclist']
         if self['psf']['se']['type'] == "piff":
-            flist = [src['red_psf_piff'] for src in cf['srclist']]
+            flist = srclist['red_psf_piff']
         else:
-            flist = [src['red_psf'] for src in cf['srclist']]
-        ccdnums = [src['ccdnum'] for src in cf['srclist']]
-        bands = [src['band'] for src in cf['srclist']]
+            flist = srclist['red_psf']
+
+        paths = np.concatenate([[cf['psf_url']], flist]).astype('U')
+
+        dt = [
+            ('path', 'U%d' % max(paths.itemsize//4, 1)),
+            ('ccdnum', 'i4'),
+            ('band', 'U%d' % max(srclist['band'].itemsize//4, 1)),
+            ('wcs_file_id', 'i4'),
+        ]
+        psf_files = np.zeros(paths.size, dtype=dt)
+        psf_files['path'] = paths
+        psf_files['ccdnum'][0] = -1
+        psf_files['ccdnum'][1:] = srclist['ccdnum']
+        psf_files['band'][1:] = srclist['band']
+        psf_files['wcs_file_id'] = -1
+
+        return psf_files
 
-        for f, ccdnum, band in zip(flist, ccdnums, bands):
-            if self.psf_info is not None:
+    def _load_psf_data(self, psf_files):
+        """
+        load all psfs into a list
+
+        The single epoch psfs are loaded in parallel using psf_load_threads
+        threads (default 1)
+
+        parameters
+        ----------
+        psf_files: array
+            As returned by _get_psf_files
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        print('loading psf data')
+
+        psf_data = []
+
+        paths = psf_files['path'].astype('U').tolist()
+        psf = self._load_one_psf(paths[0], self['psf']['coadd'])
+        psf_data.append(psf)
+
+        flist = paths[1:]
+        ccdnums = psf_files['ccdnum'][1:].tolist()
+        bands = psf_files['band'][1:].astype('U').tolist()
+
+        if self.psf_info is not None:
+            for f in flist:
                 assert os.path.basename(f) in self.psf_info['filename']
 
-            if self['psf']['se'].get("use_color", False):
-                psf = self._load_one_psf(
-                    f, self['psf']['se'], ccdnum=ccdnum, band=band
+        nthreads = self.get('psf_load_threads', 1)
+        if nthreads > 1:
+            print("loading %d psfs with %d threads" % (len(flist), nthreads))
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                psf_data += list(
+                    executor.map(self._load_one_se_psf, flist, ccdnums, bands)
                 )
-            else:
-                psf = self._load_one_psf(f, self['psf']['se'])
-
-            psf_data.append(psf)
+        else:
+            for f, ccdnum, band in zip(flist, ccdnums, bands):
+                psf_data.append(self._load_one_se_psf(f, ccdnum, band))
 
         return psf_data
 
+    def _load_one_se_psf(self, f, ccdnum, band):
+        """
+        load a single epoch psf, with the ccd and band if colors are used
+        """
+        if self['psf']['se'].get("use_color", False):
+            return self._load_one_psf(
+                f, self['psf']['se'], ccdnum=ccdnum, band=band
+            )
+        else:
+            return self._load_one_psf(f, self['psf']['se'])
+
     def _load_one_psf(self, f, conf, ccdnum=None, band=None):
         """
         load a psf of the given type
@@ -372,10 +732,7 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
         """
         print('loading piff data:', util.munge_meds_dir(f))
         if band is not None:
-            if band in ["g", "r", "i"]:
-                color_name = "GI_COLOR"
-            else:
-                color_name = "IZ_COLOR"
+            color_name = util.get_piff_color_name(band)
         else:
             color_name = None
         print(
@@ -400,25 +757,24 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
         D00502664_r_c36_r2378p01_bkg.fits.fz
         D00502664_r_c36_r2378p01_segmap.fits.fz
         """
-        for src in srclist:
-            rs = basename(src['red_image']).split('_')
-            bs = basename(src['red_bkg']).split('_')
-            ss = basename(src['red_seg']).split('_')
+        rs = srctable.get_exp_band_ccd(srclist['red_image'])
+        bs = srctable.get_exp_band_ccd(srclist['red_bkg'])
+        ss = srctable.get_exp_band_ccd(srclist['red_seg'])
 
-            assert rs[0] == bs[0], "exp ids don't match"
-            assert rs[0] == ss[0], "exp ids don't match"
+        assert np.all(rs[0] == bs[0]), "exp ids don't match"
+        assert np.all(rs[0] == ss[0]), "exp ids don't match"
 
-            assert rs[1] == bs[1], "bands don't match"
-            assert rs[1] == ss[1], "bands don't match"
+        assert np.all(rs[1] == bs[1]), "bands don't match"
+        assert np.all(rs[1] == ss[1]), "bands don't match"
 
-            assert rs[2] == bs[2], "ccds don't match"
-            assert rs[2] == ss[2], "ccds don't match"
+        assert np.all(rs[2] == bs[2]), "ccds don't match"
+        assert np.all(rs[2] == ss[2]), "ccds don't match"
 
-            if 'psf_flist' in self.file_dict:
-                ps = basename(src['red_psf']).split('_')
-                assert rs[0] == ps[0], "psf exp ids don't match"
-                assert rs[1] == ps[1], "psf bands don't match"
-                assert rs[2] == ps[2], "psf ccds don't match"
+        if 'psf_flist' in self.file_dict:
+            ps = srctable.get_exp_band_ccd(srclist['red_psf'])
+            assert np.all(rs[0] == ps[0]), "psf exp ids don't match"
+            assert np.all(rs[1] == ps[1]), "psf bands don't match"
+            assert np.all(rs[2] == ps[2]), "psf ccds don't match"
 
     def _read_generic_flist(self, key):
         """
@@ -461,7 +817,7 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
         # for coadd-only this should be set to False
         have_se_images = self.file_dict.get('have_se_images', True)
         if not have_se_images:
-            res = []
+            res = self._get_empty_src_table()
 
         elif 'finalcut_flist' in self.file_dict:
             assert self['source_type'] == 'finalcut', \
@@ -476,6 +832,36 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
 
         return res
 
+    def _get_empty_src_table(self):
+        """
+        source table with no entries, for coadd-only MEDS files
+        """
+        return srctable.make_src_table({
+            'id': np.zeros(0, dtype='U1'),
+            'flags': np.zeros(0, dtype='i4'),
+            'red_image': np.zeros(0, dtype='U1'),
+            'magzp': np.zeros(0, dtype='f8'),
+            'wcs_header': srctable.object_array([]),
+        })
+
+    def _make_src_table(self, paths, magzps, wcs_headers):
+        """
+        make the source table from the image paths, zero points and wcs
+        headers
+        """
+        if len(paths) == 0:
+            return self._get_empty_src_table()
+
+        paths = np.array(paths, dtype='U')
+
+        return srctable.make_src_table({
+            'id': srctable.get_filenames_as_ids(paths),
+            'flags': np.zeros(paths.size, dtype='i4'),
+            'red_image': paths,
+            'magzp': np.array(magzps, dtype='f8'),
+            'wcs_header': srctable.object_array(wcs_headers),
+        })
+
     def _load_src_info_fromfile(self, finalcut_flist):
         finalcut_flist = expandvars(finalcut_flist)
 
@@ -484,7 +870,9 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
             util.munge_meds_dir(finalcut_flist)
         )
         # print('using ohead files for the wcs')
-        src_info = []
+        paths = []
+        magzps = []
+        wcs_headers = []
 
         with open(finalcut_flist) as fobj:
             for line in fobj:
@@ -504,18 +892,11 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
                 else:
                     wcs_hdr = None
 
-                sid = self._get_filename_as_id(red_path)
-                entry = {
-                    'id': sid,
-                    'flags': 0,
-                    'red_image': red_path,
-                    'magzp': magzp,
-                    'wcs_header': wcs_hdr,
-                }
+                paths.append(red_path)
+                magzps.append(magzp)
+                wcs_headers.append(wcs_hdr)
 
-                src_info.append(entry)
-
-        return src_info
+        return self._make_src_table(paths, magzps, wcs_headers)
 
     def _load_source_image_info_fromdb(self):
         """
@@ -542,14 +923,14 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
         else:
             entry = 'image_path'
 
-        red_info = []
+        paths = []
+        magzps = []
+        wcs_headers = []
 
         for s in ci['src_info']:
 
             path = expandvars(s[entry])
 
-            sid = self._get_filename_as_id(path)
-
             # now mock up the structure of the Coadd.srclist
 
             if self['use_astro_refine']:
@@ -560,18 +941,12 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
             else:
                 wcs_hdr = fitsio.read_header(path, ext=self['se_image_ext'])
 
-            wcs_hdr = util.fitsio_header_to_dict(wcs_hdr)
-            s = {
-                'id': sid,
-                'flags': 0,  # assume no problems!
-                'red_image': path,
-                'magzp': s['magzp'],
-                'wcs_header': wcs_hdr,
-            }
+            paths.append(path)
+            magzps.append(s['magzp'])
+            wcs_headers.append(util.fitsio_header_to_dict(wcs_hdr))
 
-            red_info.append(s)
-
-        return red_info
+        # flags are zero: assume no problems!
+        return self._make_src_table(paths, magzps, wcs_headers)
 
     def _get_coadd_objects_ids(self):
         """
@@ -585,14 +960,11 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
             ('psf_color', 'f4'),
         ]
 
-        nobj = self.coadd_cat.size
+        idmap = self._read_coadd_object_map()
+        nobj = idmap.size
 
         iddata = zeros(nobj, dtype=dt)
 
-        fname = expandvars(self.file_dict['coadd_object_map'])
-        print('reading id map:', util.munge_meds_dir(fname))
-        idmap = fitsio.read(fname, lower=True)
-
         s = numpy.argsort(idmap['object_number'])
 
         iddata['object_number'] = idmap['object_number'][s]
@@ -621,6 +993,19 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
 
         return iddata
 
+    def _read_coadd_object_map(self):
+        """
+        read the map from object number to id and colors, or get it
+        from the shared data
+        """
+        if self.shared is not None:
+            return self.shared['idmap']
+
+        fname = expandvars(self.file_dict['coadd_object_map'])
+        print('reading id map:', util.munge_meds_dir(fname))
+        self.idmap = fitsio.read(fname, lower=True)
+        return self.idmap
+
     def _get_portable_url(self, file_dict, name):
         """
         We don't have DESDATA defined when DESDM is running
@@ -629,6 +1014,14 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
 
         return file_dict[name]
 
+    def _get_portable_urls(self, srclist, name):
+        """
+        We don't have DESDATA defined when DESDM is running
+        the code, so just return the paths
+        """
+
+        return srclist[name]
+
     def _load_config(self, medsconf):
         """
         load the default config, then load the input config
@@ -664,19 +1057,37 @@ class DESMEDSMakerDESDM(DESMEDSMaker):
 
         self.file_dict = fd
 
-    def _write_and_fpack(self, maker, fname):
+    def _write_and_fpack(self, fname, nshards=1, ckpt=None):
         local_fitsname = fname.replace('.fits.fz', '.fits')
 
         with TempFile(local_fitsname) as tfile:
-            maker.write(tfile.path)
+            self._write_uncompressed(tfile.path, nshards=nshards, ckpt=ckpt)
 
             # this will fpack to the proper path, which
             # will then be staged out if tmpdir is not None
             # if the name is wrong, the staging will fail and
             # an exception raised
-            util.fpack_file(
-                tfile.path, fpack_kwargs=self.get("fpack_kwargs", "")
-            )
+            with self._stage('compress'):
+                util.fpack_file(
+                    tfile.path, fpack_kwargs=self.get("fpack_kwargs", "")
+                )
+
+
+# set in the parent process before forking to write shards
+_SHARD_MAKER = None
+
+
+def _write_shard(obj_range, fname):
+    """
+    write the objects in the range [start, end) to the shard file
+    """
+    start, end = obj_range
+    print("writing objects [%d, %d) to shard: %s" % (start, end, fname))
+
+    maker = _SHARD_MAKER._get_meds_maker(
+        obj_data=_SHARD_MAKER.obj_data[start:end],
+    )
+    maker.write(fname)
 
 
 class Preparator(dict):
@@ -999,6 +1410,19 @@ class Preparator(dict):
             )
 
     def _copy_psfs(self, info):
+        """
+        stage the psf files into the psf dir and write the psfmap
+
+        The staging is controlled by the psf_stage_mode config entry,
+        which can be 'copy' (the default) or 'hardlink'.  Hard links that
+        fail, e.g. because the files are on different file systems, fall
+        back to a copy.  All copies are done in parallel using
+        psf_copy_threads threads (default 4)
+
+        Symbolic links are not supported: the psfs are in the source dir,
+        which clean() removes, while the psf dir and psfmap are kept for
+        later coadding or --noprep runs
+        """
 
         psf_dir = expandvars(self['psf_dir'])
 
@@ -1006,39 +1430,97 @@ class Preparator(dict):
             print("making directory:", psf_dir)
             os.makedirs(psf_dir)
 
-        psfmap_file = expandvars(self['psfmap_file'])
+        psfmap = self._get_psfmap_index(info, psf_dir)
 
+        psfmap_file = expandvars(self['psfmap_file'])
         print("writing psfmap:", psfmap_file)
         with open(psfmap_file, 'w') as psfmap_fobj:
-            print("copying psf files")
+            for entry in psfmap:
+                ttup = entry['expnum'], entry['ccdnum'], entry['ofile']
+                psfmap_fobj.write("%s %s %s\n" % ttup)
 
-            psfs = self._get_psf_list(info)
-            for psf_file in psfs:
+        self._stage_psfs(psfmap)
 
-                psf_file = expandvars(psf_file)
+    def _get_psfmap_index(self, info, psf_dir):
+        """
+        build the psfmap in memory, one entry per psf file
+        """
+        psfmap = []
 
-                bname = basename(psf_file)
-                ofile = os.path.join(psf_dir, bname)
+        psfs = self._get_psf_list(info)
+        for psf_file in psfs:
 
-                fs = bname.split('_')
-                if 'DES' in fs[0]:
-                    # this is the coadd psf, so fake it
-                    expnum = -9999
-                    ccdnum = -9999
+            psf_file = expandvars(psf_file)
 
-                else:
-                    # single epoch psf
-                    expnum = fs[0][1:]
-                    ccdnum = fs[2][1:]
+            bname = basename(psf_file)
+            ofile = os.path.join(psf_dir, bname)
 
-                ttup = expnum, ccdnum, ofile
-                psfmap_fobj.write("%s %s %s\n" % ttup)
+            fs = bname.split('_')
+            if 'DES' in fs[0]:
+                # this is the coadd psf, so fake it
+                expnum = -9999
+                ccdnum = -9999
 
-                if os.path.exists(ofile):
-                    continue
+            else:
+                # single epoch psf
+                expnum = fs[0][1:]
+                ccdnum = fs[2][1:]
+
+            psfmap.append({
+                'expnum': expnum,
+                'ccdnum': ccdnum,
+                'psf_file': psf_file,
+                'ofile': ofile,
+            })
 
-                print("copying: %s -> %s" % (psf_file, ofile))
-                shutil.copy(psf_file, ofile)
+        return psfmap
+
+    def _stage_psfs(self, psfmap):
+        """
+        link or copy the psf files listed in the psfmap
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        mode = self.get('psf_stage_mode', 'copy')
+        if mode not in ('copy', 'hardlink'):
+            raise ValueError("psf_stage_mode should be 'copy' or "
+                             "'hardlink', got '%s'" % mode)
+
+        print("staging psf files with mode:", mode)
+
+        to_copy = []
+        for entry in psfmap:
+            psf_file, ofile = entry['psf_file'], entry['ofile']
+
+            # links from older versions point into the removed sources
+            if os.path.islink(ofile):
+                os.remove(ofile)
+
+            if os.path.exists(ofile):
+                continue
+
+            if mode == 'hardlink':
+                try:
+                    os.link(psf_file, ofile)
+                except OSError as err:
+                    print("could not link %s: %s" % (psf_file, err))
+                    to_copy.append((psf_file, ofile))
+            else:
+                to_copy.append((psf_file, ofile))
+
+        if len(to_copy) > 0:
+            nthreads = self.get('psf_copy_threads', 4)
+            print("copying %d psf files with %d "
+                  "threads" % (len(to_copy), nthreads))
+
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                futures = [
+                    executor.submit(_copy_one_file, psf_file, ofile)
+                    for psf_file, ofile in to_copy
+                ]
+                # re-raise any errors
+                for future in futures:
+                    future.result()
 
     def _get_psf_list(self, info):
         psfs = []
@@ -1050,6 +1532,17 @@ class Preparator(dict):
         return psfs
 
 
+def _copy_one_file(src, dst):
+    """
+    copy to a temporary name and then rename, so a partial copy
+    is never mistaken for a complete one
+    """
+    print("copying: %s -> %s" % (src, dst))
+    tmp_dst = dst + '.tmp'
+    shutil.copy(src, tmp_dst)
+    os.rename(tmp_dst, dst)
+
+
 _NULLWT_TEMPLATE = r"""
 coadd_nwgint                  \
    -i "%(image_path)s"        \
@@ -1100,6 +1593,7 @@ class PIFFWrapper(dict):
 
         image is normalized
         """
+        import galsim
 
         if self.color_name is not None:
             kwargs = {
@@ -0,0 +1,338 @@
+"""
+estimate the cost of making a MEDS file before running the job
+
+The number of cutouts is predicted from the coadd catalog, the box sizes
+and the footprints of the single epoch images given by their WCS.  From
+these the pixel counts and output sizes follow directly, while the peak
+memory and wall time are predicted using a simple linear model whose
+coefficients can be calibrated from past runs.
+"""
+from __future__ import print_function
+import numpy as np
+
+from . import util
+from .desdm_maker import DESMEDSMakerDESDM
+
+# the coefficients of the cost model.  These are rough values, and
+# should be replaced by a calibration fit to past runs; see fit_calibration
+DEFAULT_CALIBRATION = {
+    # wall time = base + per_epoch*nepoch + per_cutout*ncutout
+    #             + per_mpix*image_pixels/1e6
+    'seconds_base': 60.0,
+    'seconds_per_epoch': 2.0,
+    'seconds_per_cutout': 1.0e-3,
+    'seconds_per_mpix': 0.1,
+
+    # peak memory = base + per_epoch*nepoch + se_image_bytes,
+    # where se_image_bytes is for reading all planes of the largest
+    # single epoch image
+    'memory_base_bytes': 500.0e6,
+    'memory_per_epoch_bytes': 5.0e6,
+
+    # compressed size relative to uncompressed
+    'compression_ratio': 0.4,
+}
+
+# bytes per pixel in the cutout and psf extensions
+BYTES_PER_PIXEL = 4
+
+# approximate bytes in the object_data table per object-epoch
+BYTES_PER_OBJECT_EPOCH = 64
+
+# default psf stamp size when it is not set in the psf config
+DEFAULT_PSF_SIZE = 25
+
+# image, weight, bmask, background and seg are read for each epoch
+NPLANES_PER_EPOCH = 5
+
+
+class MEDSCostEstimator(DESMEDSMakerDESDM):
+    """
+    predict the size and cost of a MEDS file for a tile-band
+
+    Only the coadd catalog, coadd object map, coadd header and single epoch
+    headers are read; no psfs or image pixels are loaded
+
+    parameters
+    ----------
+    medsconf: string or dict
+        The meds config; see DESMEDSMakerDESDM
+    fileconf: string or dict
+        The file config; see DESMEDSMakerDESDM
+    calibration: dict, optional
+        Coefficients of the cost model, default DEFAULT_CALIBRATION.  Any
+        entries not sent are taken from the default
+    """
+    def __init__(self, medsconf, fileconf, calibration=None):
+
+        self.medsconf = medsconf
+        self.fileconf = fileconf
+
+        self.calibration = {}
+        self.calibration.update(DEFAULT_CALIBRATION)
+        if calibration is not None:
+            self.calibration.update(calibration)
+
+        self._load_config(medsconf)
+        self._load_file_config(fileconf)
+
+        self._set_extra_config('none', self.file_dict['band'])
+
+        # not relevant for this version
+        self.DESDATA = 'rootless'
+
+        # the ra,dec are calculated using the coadd for this band
+        self.cf_refband = {'image_url': self.file_dict['coadd_image_url']}
+
+        self._read_coadd_cat()
+
+    def get_estimate(self):
+        """
+        get the estimate for this tile-band
+
+        returns
+        -------
+        estimate: dict
+            The predicted counts, sizes, memory and time, holding only
+            python types for writing as JSON
+        """
+        box_size = self._get_box_sizes().astype('i8')
+        ra, dec = self._get_radec()
+
+        srclist = self._load_source_image_info()
+        nepoch = len(srclist)
+
+        # the coadd is always the first cutout
+        ncutout = np.ones(box_size.size, dtype='i8')
+        se_image_pixels = 0
+        for i in range(nepoch):
+            wcs, nrow, ncol = self._get_se_wcs_and_shape(srclist[i])
+            ncutout += self._get_in_image(wcs, nrow, ncol, ra, dec)
+            se_image_pixels = max(se_image_pixels, nrow*ncol)
+
+        ncutout_tot = int(ncutout.sum())
+        image_pixels = int((box_size**2 * ncutout).sum())
+        psf_pixels = self._get_psf_pixels(ncutout)
+
+        ntypes = len(self['cutout_types'])
+        max_cutouts = int(ncutout.max()) if ncutout.size > 0 else 1
+        table_bytes = box_size.size*max_cutouts*BYTES_PER_OBJECT_EPOCH
+        uncompressed_bytes = (
+            BYTES_PER_PIXEL*(image_pixels*ntypes + psf_pixels)
+            + table_bytes
+        )
+
+        se_image_bytes = se_image_pixels*BYTES_PER_PIXEL*NPLANES_PER_EPOCH
+
+        estimate = {
+            'tilename': self.file_dict.get('tilename', None),
+            'band': self.file_dict['band'],
+            'meds_url': self.file_dict.get('meds_url', None),
+            'nobj': int(box_size.size),
+            'nepoch': int(nepoch),
+            'ncutout': ncutout_tot,
+            'max_cutouts': max_cutouts,
+            'image_pixels': image_pixels,
+            'psf_pixels': int(psf_pixels),
+            'se_image_bytes': int(se_image_bytes),
+            'uncompressed_bytes': int(uncompressed_bytes),
+        }
+        estimate.update(
+            predict_from_counts(estimate, self.calibration)
+        )
+        return estimate
+
+    def _get_radec(self):
+        """
+        get the ra, dec of each object from the coadd wcs and the wcs
+        colors, as the maker does
+        """
+        cat = self.coadd_cat
+        pos = self._make_wcs_positions(
+            cat[self['row_name']],
+            cat[self['col_name']],
+        )
+
+        iddata = self._get_coadd_objects_ids()
+        iddata = iddata[np.argsort(iddata['object_number'])]
+        mess = "coadd object map does not match the catalog"
+        assert np.array_equal(cat['number'], iddata['object_number']), mess
+
+        return self._get_coadd_radec(pos, color=iddata['wcs_color'])
+
+    def _get_se_wcs_and_shape(self, src):
+        """
+        get the wcs for the single epoch image, along with its shape
+        """
+        import fitsio
+        import esutil as eu
+
+        hdr = fitsio.read_header(src['red_image'], ext=self['se_image_ext'])
+        if 'ZNAXIS1' in hdr:
+            ncol, nrow = hdr['ZNAXIS1'], hdr['ZNAXIS2']
+        else:
+            ncol, nrow = hdr['NAXIS1'], hdr['NAXIS2']
+
+        if src['wcs_header'] is not None:
+            wcs = eu.wcsutil.WCS(src['wcs_header'])
+        else:
+            wcs = eu.wcsutil.WCS(hdr)
+
+        return wcs, int(nrow), int(ncol)
+
+    def _get_in_image(self, wcs, nrow, ncol, ra, dec):
+        """
+        get a 0/1 array, 1 for objects with their center in the image
+        """
+        col, row = wcs.sky2image(ra, dec)
+        row = row - self['position_offset']
+        col = col - self['position_offset']
+
+        return (
+            (row >= 0) & (row < nrow) & (col >= 0) & (col < ncol)
+        ).astype('i8')
+
+    def _get_psf_pixels(self, ncutout):
+        """
+        number of pixels in the psf stamps
+        """
+        if not self.file_dict.get('coadd_psf_url'):
+            return 0
+
+        coadd_size = self['psf']['coadd'].get('stamp_size', DEFAULT_PSF_SIZE)
+        se_size = self['psf']['se'].get('stamp_size', DEFAULT_PSF_SIZE)
+
+        return int(
+            ncutout.size*coadd_size**2 + (ncutout-1).sum()*se_size**2
+        )
+
+
+def predict_from_counts(counts, calibration=None):
+    """
+    predict the compressed size, peak memory and wall time from the
+    counts in an estimate
+
+    parameters
+    ----------
+    counts: dict
+        Must contain nepoch, ncutout, image_pixels, se_image_bytes and
+        uncompressed_bytes
+    calibration: dict, optional
+        Coefficients of the cost model, default DEFAULT_CALIBRATION
+
+    returns
+    -------
+    dict with compressed_bytes, peak_memory_bytes, wall_time_seconds
+    """
+    cal = {}
+    cal.update(DEFAULT_CALIBRATION)
+    if calibration is not None:
+        cal.update(calibration)
+
+    wall_time = (
+        cal['seconds_base']
+        + cal['seconds_per_epoch']*counts['nepoch']
+        + cal['seconds_per_cutout']*counts['ncutout']
+        + cal['seconds_per_mpix']*counts['image_pixels']/1.0e6
+    )
+    peak_memory = (
+        cal['memory_base_bytes']
+        + cal['memory_per_epoch_bytes']*counts['nepoch']
+        + counts['se_image_bytes']
+    )
+    compressed = cal['compression_ratio']*counts['uncompressed_bytes']
+
+    return {
+        'compressed_bytes': int(compressed),
+        'peak_memory_bytes': int(peak_memory),
+        'wall_time_seconds': float(wall_time),
+    }
+
+
+def fit_calibration(records):
+    """
+    fit the cost model to past runs
+
+    parameters
+    ----------
+    records: list of dicts
+        Each is an estimate, as returned by MEDSCostEstimator.get_estimate,
+        with the measured values added as actual_wall_time_seconds,
+        actual_peak_memory_bytes and actual_compressed_bytes.  At least
+        four records are needed to fit the wall time
+
+    returns
+    -------
+    calibration: dict
+        Holding python floats for writing as yaml or JSON
+    """
+    nrec = len(records)
+    if nrec < 4:
+        raise ValueError("need at least 4 records to calibrate, "
+                         "got %d" % nrec)
+
+    def getcol(name):
+        return np.array([rec[name] for rec in records], dtype='f8')
+
+    nepoch = getcol('nepoch')
+    ones = np.ones(nrec)
+
+    A = np.vstack([
+        ones,
+        nepoch,
+        getcol('ncutout'),
+        getcol('image_pixels')/1.0e6,
+    ]).T
+    tcoeffs, _, _, _ = np.linalg.lstsq(
+        A, getcol('actual_wall_time_seconds'), rcond=None,
+    )
+    tcoeffs = tcoeffs.clip(min=0)
+
+    A = np.vstack([ones, nepoch]).T
+    mem = getcol('actual_peak_memory_bytes') - getcol('se_image_bytes')
+    mcoeffs, _, _, _ = np.linalg.lstsq(A, mem, rcond=None)
+    mcoeffs = mcoeffs.clip(min=0)
+
+    ratio = (
+        getcol('actual_compressed_bytes').sum()
+        / getcol('uncompressed_bytes').sum()
+    )
+
+    calibration = {
+        'seconds_base': float(tcoeffs[0]),
+        'seconds_per_epoch': float(tcoeffs[1]),
+        'seconds_per_cutout': float(tcoeffs[2]),
+        'seconds_per_mpix': float(tcoeffs[3]),
+        'memory_base_bytes': float(mcoeffs[0]),
+        'memory_per_epoch_bytes': float(mcoeffs[1]),
+        'compression_ratio': float(ratio),
+    }
+
+    print('fit calibration from %d runs' % nrec)
+    for key in sorted(calibration):
+        print('    %s: %g' % (key, calibration[key]))
+
+    return calibration
+
+
+def print_estimate(estimate):
+    """
+    print a human readable summary of the estimate
+    """
+    print('%s %s' % (estimate['tilename'], estimate['band']))
+    print('    nobj: %d nepoch: %d ncutout: %d' % (
+        estimate['nobj'], estimate['nepoch'], estimate['ncutout'],
+    ))
+    print('    image pixels: %d psf pixels: %d' % (
+        estimate['image_pixels'], estimate['psf_pixels'],
+    ))
+    print('    size: %.2f GB uncompressed, %.2f GB compressed' % (
+        estimate['uncompressed_bytes']/1.0e9,
+        estimate['compressed_bytes']/1.0e9,
+    ))
+    print('    peak memory: %.2f GB  wall time: %.1f minutes' % (
+        estimate['peak_memory_bytes']/1.0e9,
+        estimate['wall_time_seconds']/60.0,
+    ))
+    if estimate['meds_url'] is not None:
+        print('    output:', util.munge_meds_dir(estimate['meds_url']))
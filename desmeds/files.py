@@ -94,6 +94,26 @@ def get_zp_cache_file(campaign):
 '''
 
 
+def get_blacklist_dir():
+    """
+    the directory holding the exposure-ccd blacklists,
+    $DESDATA/EXTRA/blacklists
+    """
+    return os.path.join(get_desdata(), 'EXTRA', 'blacklists')
+
+
+def get_blacklist_cache_file():
+    """
+    the binary cache of the blacklists, in $DESMEDS_CACHE_DIR, default
+    ~/.cache/desmeds
+    """
+    dir = os.environ.get(
+        'DESMEDS_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'desmeds'),
+    )
+    return os.path.join(dir, 'blacklists.npz')
+
+
 def get_meds_config_file(medsconf):
     """
     get the MEDS config file path
@@ -370,10 +390,72 @@ def get_meds_script_dir(medsconf):
     return os.path.join(bdir, medsconf, 'scripts')
 
 
+def get_status_file(medsconf):
+    """
+    get the sqlite database holding the status of the tile-band jobs for a
+    meds config
+
+    parameters
+    ----------
+    medsconf: string
+        A name for the meds version or config.  e.g. '013'
+        or 'y1a1-v01'
+    """
+
+    bdir = get_meds_base()
+    fname = '%s-status.db' % medsconf
+    return os.path.join(bdir, medsconf, fname)
+
+
 #
 # file paths
 #
 
+def find_meds_files(medsconf, ext='fits.fz'):
+    """
+    find the MEDS files that exist for a meds config, in a single scan of
+    the meds directory
+
+    parameters
+    ----------
+    medsconf: string
+        A name for the meds version or config.  e.g. '013'
+        or 'y3a1-v01'
+    ext: string, optional
+        Extension of the MEDS files, default 'fits.fz'
+
+    returns
+    -------
+    set of (tilename, band)
+    """
+
+    dir = os.path.expandvars(os.path.join(get_meds_base(), medsconf))
+    end = '_meds-%s.%s' % (medsconf, ext)
+
+    found = set()
+    if not os.path.exists(dir):
+        return found
+
+    for tile_entry in os.scandir(dir):
+        if not tile_entry.is_dir():
+            continue
+
+        for entry in os.scandir(tile_entry.path):
+            name = entry.name
+            if not name.endswith(end):
+                continue
+
+            front = name[:-len(end)]
+            if '_' not in front:
+                continue
+
+            tilename, band = front.rsplit('_', 1)
+            if tilename == tile_entry.name:
+                found.add((tilename, band))
+
+    return found
+
+
 def get_meds_file(medsconf, tilename, band, ext='fits.fz'):
     """
     get the meds file for the input coadd run, band
@@ -543,6 +625,52 @@ def get_meds_stubby_file(medsconf, tilename, band):
                                      ext)
 
 
+def get_meds_sidecar_file(meds_file, type, ext='fits'):
+    """
+    get the path to a file that sits next to the meds file, e.g. for
+    type 'boxsize-report'
+
+        DES0000+0000_r_meds-y6.fits.fz -> DES0000+0000_r_meds-y6-boxsize-report.fits
+
+    parameters
+    ----------
+    meds_file: string
+        Path to the meds file
+    type: string
+        The type of file, e.g. 'boxsize-report'
+    ext: string, optional
+        The extension, default 'fits'
+    """
+    fname = meds_file.replace('.fits.fz', '.fits')
+    front = fname.replace('.fits', '')
+    return '%s-%s.%s' % (front, type, ext)
+
+
+def get_box_size_report_file(meds_file):
+    """
+    get the box size report file, which sits next to the meds file
+
+    parameters
+    ----------
+    meds_file: string
+        Path to the meds file
+    """
+    return get_meds_sidecar_file(meds_file, 'boxsize-report')
+
+
+def get_desdm_stubby_file(meds_file):
+    """
+    get the stubby file for the DESDM maker, which holds the inputs for
+    the MEDSMaker and sits next to the meds file
+
+    parameters
+    ----------
+    meds_file: string
+        Path to the meds file
+    """
+    return get_meds_sidecar_file(meds_file, 'stubby')
+
+
 def get_meds_stats_file(medsconf, tilename, band):
     """
     get the meds stats file for the input coadd run, band
@@ -724,6 +852,79 @@ def get_meds_lsf_file(medsconf, tilename, band, missing=False):
     return get_meds_script_file_generic(medsconf, tilename, band, type, ext)
 
 
+def get_meds_pack_lsf_file(medsconf, ipack, missing=False):
+    """
+    get the lsf file for a job running a pack of tile-bands
+
+    parameters
+    ----------
+    medsconf: string
+        A name for the meds version or config, e.g. 'y3a1-v02'
+    ipack: int
+        Index of the pack
+    """
+
+    type = 'make-meds'
+    if missing:
+        type += '-missing'
+
+    dir = get_meds_script_dir(medsconf)
+    fname = 'pack%05d-%s.lsf' % (ipack, type)
+    return os.path.join(dir, fname)
+
+
+def get_meds_array_lsf_file(medsconf, missing=False):
+    """
+    get the lsf file for the array job making all the MEDS files for a
+    meds config
+
+    parameters
+    ----------
+    medsconf: string
+        A name for the meds version or config, e.g. 'y3a1-v02'
+    missing: bool, optional
+        If True, the file for the array of missing MEDS files
+    """
+    return _get_meds_array_file(medsconf, 'lsf', missing=missing)
+
+
+def get_meds_array_index_file(medsconf, missing=False):
+    """
+    get the file mapping array job index to tilename and band
+
+    parameters
+    ----------
+    medsconf: string
+        A name for the meds version or config, e.g. 'y3a1-v02'
+    missing: bool, optional
+        If True, the index for the array of missing MEDS files
+    """
+    return _get_meds_array_file(medsconf, 'dat', type='index', missing=missing)
+
+
+def get_meds_array_script(medsconf):
+    """
+    get the driver script run by each element of the array job
+
+    parameters
+    ----------
+    medsconf: string
+        A name for the meds version or config, e.g. 'y3a1-v02'
+    """
+    return _get_meds_array_file(medsconf, 'sh')
+
+
+def _get_meds_array_file(medsconf, ext, type=None, missing=False):
+    front = 'array-make-meds'
+    if missing:
+        front += '-missing'
+    if type is not None:
+        front += '-' + type
+
+    dir = get_meds_script_dir(medsconf)
+    return os.path.join(dir, '%s.%s' % (front, ext))
+
+
 def get_meds_log_file(medsconf, tilename, band):
     """
     get the meds file for the input coadd run, band
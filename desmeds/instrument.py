@@ -0,0 +1,182 @@
+"""
+timing and resource instrumentation for the stages of making a MEDS file
+
+For each stage the wall time, cpu time (for this process and for child
+processes such as fpack), peak resident memory and bytes read and written
+are recorded.  The results can be written to a JSON file next to the MEDS
+file.
+
+The I/O counts are taken from /proc/self/io, and are not available on all
+systems, in which case they are set to None
+"""
+from __future__ import print_function
+import os
+import time
+import json
+import socket
+from contextlib import contextmanager
+
+IO_FILE = '/proc/self/io'
+
+# names in /proc/self/io and the names we use; the char counts include
+# reads and writes satisfied by the page cache
+IO_KEYS = {
+    'rchar': 'bytes_read',
+    'wchar': 'bytes_written',
+    'read_bytes': 'storage_bytes_read',
+    'write_bytes': 'storage_bytes_written',
+}
+
+
+# functions called with the stage name at the end of each stage
+_STAGE_HOOKS = []
+
+
+def add_stage_hook(hook):
+    """
+    add a function to be called with the stage name at the end of each
+    stage, e.g. for taking memory snapshots
+    """
+    _STAGE_HOOKS.append(hook)
+
+
+def remove_stage_hook(hook):
+    """
+    remove a function added with add_stage_hook
+    """
+    if hook in _STAGE_HOOKS:
+        _STAGE_HOOKS.remove(hook)
+
+
+class Instrumentation(object):
+    """
+    record resource usage for a sequence of stages
+
+    usage
+    -----
+    inst = Instrumentation()
+    with inst.stage('catalog_read'):
+        cat = fitsio.read(fname)
+
+    inst.write(fname)
+    """
+    def __init__(self):
+        self.stages = []
+        self._start = _get_usage()
+
+    @contextmanager
+    def stage(self, name, **extra):
+        """
+        context to record the resources used by a stage
+
+        parameters
+        ----------
+        name: string
+            Name for the stage
+        **extra:
+            Extra information to record for the stage, e.g. a chunk
+            number
+        """
+        start = _get_usage()
+        try:
+            yield
+        finally:
+            end = _get_usage()
+
+            stage = {'name': name}
+            stage.update(extra)
+            stage.update(_get_diff(start, end))
+            self.stages.append(stage)
+
+            print('stage %s: %.1f seconds wall, %.1f seconds cpu' % (
+                name, stage['wall_time_seconds'], stage['cpu_time_seconds'],
+            ))
+
+            for hook in _STAGE_HOOKS:
+                hook(name)
+
+    def get_summary(self):
+        """
+        get the stages along with the totals
+
+        returns
+        -------
+        summary: dict
+            With entries 'host', 'stages' and 'total'
+        """
+        return {
+            'host': socket.gethostname(),
+            'stages': self.stages,
+            'total': _get_diff(self._start, _get_usage()),
+        }
+
+    def write(self, fname):
+        """
+        write the summary to a JSON file
+        """
+        print('writing instrumentation:', fname)
+        with open(fname, 'w') as fobj:
+            json.dump(self.get_summary(), fobj, indent=1)
+
+
+def _get_usage():
+    """
+    get the current resource usage
+    """
+    import resource
+
+    times = os.times()
+    usage = {
+        'wall': time.time(),
+        'cpu': times[0] + times[1],
+        'child_cpu': times[2] + times[3],
+        # ru_maxrss is in kilobytes on linux
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024,
+        'child_maxrss': (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*1024
+        ),
+    }
+    usage.update(_read_io())
+    return usage
+
+
+def _read_io():
+    """
+    read the I/O counters for this process
+    """
+    io = {key: None for key in IO_KEYS}
+
+    try:
+        with open(IO_FILE) as fobj:
+            for line in fobj:
+                key, value = line.split(':')
+                if key in io:
+                    io[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+
+    return io
+
+
+def _get_diff(start, end):
+    """
+    get the resources used between the start and end
+    """
+    diff = {
+        'wall_time_seconds': end['wall'] - start['wall'],
+        'cpu_time_seconds': end['cpu'] - start['cpu'],
+        'child_cpu_time_seconds': end['child_cpu'] - start['child_cpu'],
+
+        # this is the peak over the life of the process up to the end
+        # of the stage
+        'peak_rss_bytes': end['maxrss'],
+        'child_peak_rss_bytes': end['child_maxrss'],
+    }
+
+    for key, name in IO_KEYS.items():
+        if start[key] is None or end[key] is None:
+            diff[name] = None
+        else:
+            diff[name] = end[key] - start[key]
+
+    return diff
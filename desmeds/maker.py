@@ -21,13 +21,10 @@ import yaml
 import fitsio
 import esutil as eu
 
-import meds
-from meds.util import \
-    make_wcs_positions, \
-    get_meds_input_struct, \
-    get_image_info_struct
-
 from . import blacklists
+from . import boxsizes
+from . import instrument
+from . import srctable
 from . import util
 
 from . import files
@@ -95,17 +92,54 @@ class DESMEDSMaker(dict):
         """
 
         if self.do_inputs:
-            self._query_coadd_info()
-            self._read_coadd_cat()
-            self._build_image_data()
-            self._build_meta_data()
-            self._build_object_data()
-            self._write_stubby_meds()
+            with self._stage('srclist_load'):
+                self._query_coadd_info()
+            with self._stage('catalog_read'):
+                self._read_coadd_cat()
+            with self._stage('image_info'):
+                self._build_image_data()
+            with self._stage('meta_data'):
+                self._build_meta_data()
+            with self._stage('object_data'):
+                self._build_object_data()
+            with self._stage('stubby_write'):
+                self._write_stubby_meds()
+            self._write_box_size_report(
+                self._get_meds_filename('compressed-final'),
+            )
 
         if self.do_meds:
-            self._load_stubby_meds()
+            with self._stage('stubby_read'):
+                self._load_stubby_meds()
             self._write_meds_file()  # does second pass to write data
 
+        self._write_instrumentation(
+            self._get_meds_filename('compressed-final'),
+        )
+
+    def _stage(self, name, **extra):
+        """
+        get a context to record the time and resources used by a stage of
+        making the file; see instrument.Instrumentation
+        """
+        if not hasattr(self, 'instrument'):
+            self.instrument = instrument.Instrumentation()
+
+        return self.instrument.stage(name, **extra)
+
+    def _write_instrumentation(self, meds_file):
+        """
+        write the time and resources used by each stage to a JSON file
+        next to the MEDS file
+        """
+        if not hasattr(self, 'instrument'):
+            return
+
+        fname = files.get_meds_sidecar_file(
+            meds_file, 'instrumentation', ext='json',
+        )
+        self.instrument.write(fname)
+
     def _read_coadd_cat(self):
         """
         read the DESDM coadd catalog, sorting by the number field (which
@@ -191,14 +225,16 @@ class DESMEDSMaker(dict):
         image_info['magzp'][ind] = self.cf['magzp']
         image_info['scale'][ind] = self._get_scale(self.cf['magzp'])
 
-        ind = 1
-        for s in srclist:
-            impath=self._get_portable_url(s,'red_image')
-            skypath=self._get_portable_url(s,'red_bkg')
-            segpath=self._get_portable_url(s,'red_seg')
+        if len(srclist) > 0:
+            # the single epoch sources are in rows 1 onward
+            ind = slice(1, None)
+
+            impath=self._get_portable_urls(srclist,'red_image')
+            skypath=self._get_portable_urls(srclist,'red_bkg')
+            segpath=self._get_portable_urls(srclist,'red_seg')
 
-            image_info['image_id'][ind] = s['id']
-            image_info['image_flags'][ind] = s['flags']
+            image_info['image_id'][ind] = srclist['id']
+            image_info['image_flags'][ind] = srclist['flags']
 
             # for DES, image, weight, bmask all in same file
             image_info['image_path'][ind]  = impath
@@ -217,9 +253,8 @@ class DESMEDSMaker(dict):
             image_info['seg_ext'][ind] = self['se_seg_ext']
 
             image_info['wcs'][ind] = wcs_json[ind]
-            image_info['magzp'][ind] = s['magzp']
-            image_info['scale'][ind] = self._get_scale(s['magzp'])
-            ind += 1
+            image_info['magzp'][ind] = srclist['magzp']
+            image_info['scale'][ind] = self._get_scale(srclist['magzp'])
 
         self.image_info = image_info
 
@@ -265,21 +300,20 @@ class DESMEDSMaker(dict):
             len(self._get_portable_url(self.cf,'image_url')),
             len(self._get_portable_url(self.cf,'seg_url')),
         )
-        for s in srclist:
-            slen = max(
-                slen,
-                len( self._get_portable_url(s,'red_image') ),
-                len( self._get_portable_url(s,'red_bkg') ),
-                len( self._get_portable_url(s,'red_seg') ),
-            )
+        for name in ['red_image', 'red_bkg', 'red_seg']:
+            if len(srclist) > 0:
+                paths = self._get_portable_urls(srclist, name)
+                slen = max(slen, numpy.char.str_len(paths).max())
 
-        return slen
+        return int(slen)
 
     def _get_image_info_struct(self,srclist,wcs_json):
         """
         build the data type for the image info structure. We use
         the maximum string size rather than variable length strings
         """
+        from meds.util import get_image_info_struct
+
         #sfmt = 'S%d' % slen
 
         slen = self._get_path_dtype_len(srclist)
@@ -308,24 +342,29 @@ class DESMEDSMaker(dict):
                                        ext=self['coadd_image_ext'])
         wcs_json = []
         wcs_json.append(json.dumps(util.fitsio_header_to_dict(coadd_wcs)))
-        for s in srclist:
-            if s['wcs_header'] is None:
-                d = {}
+        for wcs_header in srclist['wcs_header']:
+            if wcs_header is None:
+                d = '{}'
             else:
-                d = json.dumps(util.fitsio_header_to_dict(s['wcs_header']))
+                d = json.dumps(util.fitsio_header_to_dict(wcs_header))
 
             wcs_json.append(d)
 
-        return wcs_json
+        return numpy.array(wcs_json)
 
     def _get_srclist(self):
         """
         set the srclist, checking possibly for redone astrometry.
         also check against blacklist
         """
-        srclist = self.cf.srclist
+        names = ['id', 'expname', 'ccd', 'red_image', 'red_bkg',
+                 'red_seg', 'magzp']
+        if self['use_astro_refine']:
+            names.append('astro_refine')
+
+        srclist = srctable.srclist_to_table(self.cf.srclist, names=names)
 
-        blacklists.add_bigind(srclist)
+        srclist = blacklists.add_bigind(srclist)
 
         srclist = blacklists.remove_corrupted(srclist)
 
@@ -333,12 +372,15 @@ class DESMEDSMaker(dict):
             raise RuntimeError("all src were in the corrupted list")
 
         # do blacklists
-        for s in srclist:
-            s['flags'] = 0
+        srclist = srctable.add_columns(
+            srclist,
+            {'flags': numpy.zeros(srclist.size, dtype='i4')},
+        )
 
         blacklists.add_blacklist_flags(srclist)
 
         # read astrom header
+        wcs_headers = []
         for s in srclist:
             img_hdr = fitsio.read_header(s['red_image'],
                                          ext=self['se_image_ext'])
@@ -348,7 +390,12 @@ class DESMEDSMaker(dict):
             else:
                 wcs_hdr = img_hdr
 
-            s['wcs_header'] = util.fitsio_header_to_dict(wcs_hdr)
+            wcs_headers.append(util.fitsio_header_to_dict(wcs_hdr))
+
+        srclist = srctable.add_columns(
+            srclist,
+            {'wcs_header': srctable.object_array(wcs_headers)},
+        )
 
         return srclist
 
@@ -436,7 +483,69 @@ class DESMEDSMaker(dict):
         bin_inds = numpy.digitize(box_size,bins,right=True)
         bins = array(bins)
 
-        return bins[bin_inds]
+        box_size = bins[bin_inds]
+
+        self.box_size_report = None
+        if self['box_size_budget'] is not None:
+            box_size = self._apply_box_size_budget(box_size, bins[1:])
+
+        return box_size
+
+    def _apply_box_size_budget(self, box_size, sizes):
+        """
+        shrink the boxes of the largest, lowest priority objects until
+        the total coadd pixels are within the budget.  A report of the objects
+        that were shrunk is kept in self.box_size_report
+        """
+        cat = self.coadd_cat
+        budget = self['box_size_budget']
+
+        max_pixels = boxsizes.get_max_pixels(budget, box_size.size)
+
+        priority_name = budget.get('priority_name', None)
+        if priority_name is not None:
+            priority = cat[priority_name]
+        else:
+            priority = None
+
+        new_box_size = boxsizes.apply_pixel_budget(
+            box_size,
+            sizes,
+            max_pixels,
+            priority=priority,
+        )
+
+        self.box_size_report = boxsizes.make_report(
+            cat['number'],
+            priority,
+            box_size,
+            new_box_size,
+        )
+
+        orig_total = (box_size.astype('i8')**2).sum()
+        total = (new_box_size**2).sum()
+        print('box size budget: %g coadd pixels' % max_pixels)
+        print('    shrunk %d boxes, pixels %d -> %d' % (
+            self.box_size_report.size, orig_total, total,
+        ))
+        if total > max_pixels:
+            print('    warning: budget not reached with the '
+                  'smallest allowed box size')
+
+        return new_box_size
+
+    def _write_box_size_report(self, meds_file):
+        """
+        write the report of shrunk box sizes next to the MEDS file, if
+        a box size budget was applied
+        """
+        report = getattr(self, 'box_size_report', None)
+        if report is None:
+            return
+
+        fname = files.get_box_size_report_file(meds_file)
+        print('writing box size report:', fname)
+        fitsio.write(fname, report, extname='box_size_report', clobber=True)
 
     def _get_sigma_size(self):
         """
@@ -458,6 +567,8 @@ class DESMEDSMaker(dict):
         make the object data such as box sizes and ra,dec based on
         the row,col->ra,dec transformation
         """
+        from meds.util import get_meds_input_struct
+
         print('building basic object data')
 
         nobj=len(self.coadd_cat)
@@ -479,17 +590,7 @@ class DESMEDSMaker(dict):
         self.obj_data['input_row'] = pos['zrow']
         self.obj_data['input_col'] = pos['zcol']
 
-        self.obj_data['flags']    = self.coadd_cat[self['flags_name']]
-        self.obj_data['flux']     = self.coadd_cat[self['flux_name']]
-        self.obj_data['flux_err'] = self.coadd_cat[self['fluxerr_name']]
-        self.obj_data['x2']       = self.coadd_cat[self['x2_name']]
-        self.obj_data['x2_err']   = self.coadd_cat[self['x2err_name']]
-        self.obj_data['y2']       = self.coadd_cat[self['y2_name']]
-        self.obj_data['y2_err']   = self.coadd_cat[self['y2err_name']]
-
-
-        iso_area = self.coadd_cat[self['isoarea_name']].clip(min=1)
-        self.obj_data['iso_radius'] = sqrt(iso_area/PI)
+        self._copy_catalog_fields(self.coadd_cat)
 
         # required
         self.obj_data['box_size'] = self._get_box_sizes()
@@ -508,25 +609,64 @@ class DESMEDSMaker(dict):
         self.obj_data['psf_color'] = iddata['psf_color']
 
         # get ra,dec
-        coadd_hdr = fitsio.read_header(self.cf_refband['image_url'],
-                                       ext=self['coadd_image_ext'])
-        coadd_wcs = eu.wcsutil.WCS(coadd_hdr)
-
         if 'wcs_color' in self.obj_data.dtype.names:
             color = self.obj_data['wcs_color']
         else:
             color = None
 
+        ra, dec = self._get_coadd_radec(pos, color=color)
+
+        self.obj_data['ra'] = ra
+        self.obj_data['dec'] = dec
+
+    def _get_coadd_radec(self, pos, color=None):
+        """
+        get the ra,dec for the positions made by _make_wcs_positions, using
+        the coadd wcs of the reference band.  The color is used if the wcs
+        supports it
+        """
+        coadd_hdr = fitsio.read_header(self.cf_refband['image_url'],
+                                       ext=self['coadd_image_ext'])
+        coadd_wcs = eu.wcsutil.WCS(coadd_hdr)
 
-        ra, dec = _image2sky_func(
+        return _image2sky_func(
             coadd_wcs,
             pos['wcs_col'],
             pos['wcs_row'],
             color=color,
         )
 
-        self.obj_data['ra'] = ra
-        self.obj_data['dec'] = dec
+    def _get_catalog_field_names(self):
+        """
+        names of the catalog fields copied by _copy_catalog_fields
+        """
+        return [
+            'number',
+            self['flags_name'],
+            self['flux_name'],
+            self['fluxerr_name'],
+            self['x2_name'],
+            self['x2err_name'],
+            self['y2_name'],
+            self['y2err_name'],
+            self['isoarea_name'],
+        ]
+
+    def _copy_catalog_fields(self, cat):
+        """
+        copy the flags, fluxes and moments from the catalog into the
+        object data
+        """
+        self.obj_data['flags']    = cat[self['flags_name']]
+        self.obj_data['flux']     = cat[self['flux_name']]
+        self.obj_data['flux_err'] = cat[self['fluxerr_name']]
+        self.obj_data['x2']       = cat[self['x2_name']]
+        self.obj_data['x2_err']   = cat[self['x2err_name']]
+        self.obj_data['y2']       = cat[self['y2_name']]
+        self.obj_data['y2_err']   = cat[self['y2err_name']]
+
+        iso_area = cat[self['isoarea_name']].clip(min=1)
+        self.obj_data['iso_radius'] = sqrt(iso_area/PI)
 
     def _write_stubby_meds(self):
         """
@@ -574,6 +714,7 @@ class DESMEDSMaker(dict):
         """
         write the data using the MEDSMaker
         """
+        import meds
 
         self.maker=meds.MEDSMaker(self.obj_data,
                                   self.image_info,
@@ -584,7 +725,8 @@ class DESMEDSMaker(dict):
         fzfilename = self._get_meds_filename('compressed-final')
 
         with TempFile(ucfilename) as tfile:
-            self.maker.write(tfile.path)
+            with self._stage('meds_write'):
+                self.maker.write(tfile.path)
             self._compress_meds_file(tfile.path, fzfilename)
 
 
@@ -610,11 +752,15 @@ class DESMEDSMaker(dict):
         with StagedOutFile(fzfilename,tmpdir=tmpdir) as sf:
             cmd = self['fpack_command']
             cmd = cmd.format(fname=ucfilename)
-            ret=os.system(cmd)
+            with self._stage('compress'):
+                ret=os.system(cmd)
 
             if ret != 0:
                 raise RuntimeError("failed to compress file")
 
+            with self._stage('stage_out'):
+                sf.stage_out()
+
         print('output is in:',fzfilename)
 
     def _get_meds_filename(self, type, compressed=False):
@@ -649,6 +795,7 @@ class DESMEDSMaker(dict):
         get a structure holding the original positions
         and offset ones
         """
+        from meds.util import make_wcs_positions
 
         pos = make_wcs_positions(row,
                                  col,
@@ -669,6 +816,23 @@ class DESMEDSMaker(dict):
         path=path.replace(self.DESDATA,'${DESDATA}')
         return path
 
+    def _get_portable_urls(self, srclist, name):
+        """
+        vectorized version of _get_portable_url for a column of
+        the source table
+
+        Sub classes that over-ride _get_portable_url should also over-ride
+        this method; if they do not, their _get_portable_url is applied to
+        each source so the same policy is used
+        """
+        if type(self)._get_portable_url is not DESMEDSMaker._get_portable_url:
+            return numpy.array(
+                [self._get_portable_url(src, name) for src in srclist],
+                dtype='U',
+            )
+
+        return numpy.char.replace(srclist[name], self.DESDATA, '${DESDATA}')
+
 
     def _set_extra_config(self, coadd_run, band):
         """
@@ -0,0 +1,173 @@
+"""
+make MEDS files for all bands of a tile in one job
+
+The object data (ids, positions, ra/dec and box sizes) are computed once
+from the reference band catalog and shared between the bands.  Only the
+source lists, psfs and band specific catalog columns, such as the
+photometry, are loaded for each band; see SHARED_OBJ_DATA_FIELDS in
+desdm_maker.
+"""
+from __future__ import print_function
+import yaml
+
+from . import files
+from .defaults import default_config
+from .desdm_maker import DESMEDSMakerDESDM
+
+
+class ObjectDataBuilder(DESMEDSMakerDESDM):
+    """
+    build the object data for a tile from the reference band, without
+    loading any of the single epoch information
+
+    parameters
+    ----------
+    medsconf: string or dict
+        The meds config; see DESMEDSMakerDESDM
+    fileconf: string or dict
+        The file config for the reference band; see DESMEDSMakerDESDM
+    """
+    def __init__(self, medsconf, fileconf):
+
+        self.medsconf = medsconf
+        self.fileconf = fileconf
+        self.shared = None
+
+        self._load_config(medsconf)
+        self._load_file_config(fileconf)
+
+        self._set_extra_config('none', self.file_dict['band'])
+
+        # not relevant for this version
+        self.DESDATA = 'rootless'
+
+        # the ra,dec are calculated using the reference band coadd
+        self.cf_refband = {'image_url': self.file_dict['coadd_image_url']}
+
+        self._read_coadd_cat()
+        self._build_object_data()
+
+    def get_shared(self):
+        """
+        get the data to be sent to the DESMEDSMakerDESDM for each band
+        """
+        return {
+            'refband': self.file_dict['band'],
+            'obj_data': self.obj_data,
+            'idmap': self.idmap,
+            'box_size_report': self.box_size_report,
+        }
+
+
+class DESMEDSMultiBandMakerDESDM(object):
+    """
+    make the MEDS files for all bands of a tile, computing the object data
+    only once
+
+    Note the box sizes are calculated from the reference band catalog and
+    are thus the same in all bands
+
+    parameters
+    ----------
+    medsconf: string or dict
+        The meds config; see DESMEDSMakerDESDM
+    fileconfs: list
+        List of file configs, one for each band; see DESMEDSMakerDESDM
+    refband: string, optional
+        The band from which to compute the object data.  Defaults to the
+        refband in the meds config if it is one of the bands, otherwise
+        the first band
+    tmpdir: string, optional
+        Temporary directory for writing the files
+    """
+    def __init__(self, medsconf, fileconfs, refband=None, tmpdir=None):
+
+        if not isinstance(medsconf, dict):
+            with open(medsconf) as fobj:
+                medsconf = yaml.safe_load(fobj)
+
+        self.medsconf = medsconf
+        self.tmpdir = tmpdir
+
+        self.fileconfs = {}
+        self.bands = []
+        for fileconf in fileconfs:
+            if not isinstance(fileconf, dict):
+                fileconf = files.read_yaml(fileconf)
+
+            band = fileconf['band']
+            if band in self.fileconfs:
+                raise ValueError("band %s sent more than once" % band)
+
+            self.fileconfs[band] = fileconf
+            self.bands.append(band)
+
+        if refband is None:
+            refband = medsconf.get('refband', default_config['refband'])
+            if refband not in self.fileconfs:
+                refband = self.bands[0]
+
+        if refband not in self.fileconfs:
+            raise ValueError("refband %s not in bands %s" % (refband,
+                                                              self.bands))
+        self.refband = refband
+
+    def go(self, nproc=1):
+        """
+        make the MEDS file for each band
+
+        parameters
+        ----------
+        nproc: int, optional
+            Number of processes to use.  The bands are made in sequence if
+            nproc is 1, which is the default
+        """
+
+        print('building shared object data from band', self.refband)
+        builder = ObjectDataBuilder(
+            self.medsconf,
+            self.fileconfs[self.refband],
+        )
+        shared = builder.get_shared()
+        del builder
+
+        if nproc == 1:
+            for band in self.bands:
+                _make_band(
+                    self.medsconf,
+                    self.fileconfs[band],
+                    self.tmpdir,
+                    shared,
+                )
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=nproc) as executor:
+                futures = [
+                    executor.submit(
+                        _make_band,
+                        self.medsconf,
+                        self.fileconfs[band],
+                        self.tmpdir,
+                        shared,
+                    )
+                    for band in self.bands
+                ]
+
+                # re-raise any errors
+                for future in futures:
+                    future.result()
+
+
+def _make_band(medsconf, fileconf, tmpdir, shared):
+    """
+    make the MEDS file for a single band
+    """
+    print('making MEDS file for band', fileconf['band'])
+    maker = DESMEDSMakerDESDM(
+        medsconf,
+        fileconf,
+        tmpdir=tmpdir,
+        shared=shared,
+    )
+    maker.go()
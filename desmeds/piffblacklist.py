@@ -0,0 +1,300 @@
+"""
+combine eyeball blacklists of exposure-ccds with the piff exposure summaries
+
+The output has a row for each ccd of each exposure that appears in the
+blacklists, holding the piff info for the ccd, the number of stars used by
+piff, and flags for ccds that were blacklisted or are ccd 31.  This is the
+library behind desmeds-make-piff-blacklist
+"""
+from __future__ import print_function
+import numpy as np
+
+from . import files
+
+CCD31 = 2**0
+EYEBALL = 2**1
+
+BLACKLIST_DTYPE = [
+    ('key', 'S12'),
+    ('expnum', 'i8'),
+    ('ccdnum', 'i4'),
+    ('comments', 'S80'),
+]
+
+ADD_FIELDS = [
+    ('bflags', 'i4'),
+    ('comments', 'S80'),
+    ('nstars_used', 'i4'),
+]
+
+# piff flag bit marking a star used in the fit
+USED_FLAG = 1
+
+# set for all stars of an exposure if any piff_flag is nan
+NAN_PIFF_FLAG = 9999
+
+# the piff run, inherited by forked worker processes
+_PIFF_RUN = None
+
+
+def make_piff_blacklist(piff_run, fnames, outfile=None, nproc=1):
+    """
+    combine the blacklists with the piff exposure summaries
+
+    parameters
+    ----------
+    piff_run: string
+        The piff run
+    fnames: list
+        Files with flagged exposure-ccds, see read_blacklists
+    outfile: string, optional
+        If sent, the result is written to this file
+    nproc: int, optional
+        Number of processes used to read the exposure summaries.  Default 1
+
+    returns
+    -------
+    exp_data: array
+        The piff info for each ccd of the blacklisted exposures, with
+        bflags, comments and nstars_used added
+    """
+    blacklist = read_blacklists(fnames)
+
+    # unique exposures, in the order they first appear
+    _, ind = np.unique(blacklist['expnum'], return_index=True)
+    expnums = blacklist['expnum'][np.sort(ind)]
+
+    infos = read_exp_infos(piff_run, expnums, nproc=nproc)
+    exp_data = collate(blacklist, infos, expnums)
+
+    if outfile is not None:
+        import fitsio
+        print("writing:", outfile)
+        fitsio.write(outfile, exp_data, clobber=True)
+
+    return exp_data
+
+
+def read_blacklists(fnames):
+    """
+    read the eyeball blacklists
+
+    Each line holds the exposure-ccd, e.g. 00123456-12, with optional
+    comments following.  Entries found more than once are kept only the
+    first time
+
+    parameters
+    ----------
+    fnames: list
+        The blacklist files
+
+    returns
+    -------
+    blacklist: array
+        With fields key, expnum, ccdnum and comments
+    """
+    keys, comments = [], []
+    for fname in fnames:
+        print(fname)
+        with open(fname) as fobj:
+            for line in fobj:
+                ls = line.split(None, 1)
+                if len(ls) == 0:
+                    continue
+
+                keys.append(ls[0][0:11])
+                if len(ls) > 1:
+                    comments.append(' '.join(ls[1].split()))
+                else:
+                    comments.append('')
+
+    keys = np.array(keys, dtype='U11')
+    _, ind = np.unique(keys, return_index=True)
+    ind.sort()
+
+    blacklist = np.zeros(ind.size, dtype=BLACKLIST_DTYPE)
+    if ind.size == 0:
+        return blacklist
+
+    keys = keys[ind]
+    parts = np.char.partition(keys, '-')
+
+    blacklist['key'] = np.char.add('D', keys)
+    blacklist['expnum'] = parts[:, 0].astype('i8')
+    blacklist['ccdnum'] = parts[:, 2].astype('i4')
+    blacklist['comments'] = np.array(comments)[ind]
+    return blacklist
+
+
+def read_exp_infos(piff_run, expnums, nproc=1):
+    """
+    read the info for each exposure from the piff exposure summaries
+
+    parameters
+    ----------
+    piff_run: string
+        The piff run
+    expnums: array
+        The exposure numbers
+    nproc: int, optional
+        Number of processes used to read the summaries.  Default 1
+
+    returns
+    -------
+    infos: list
+        The info for each exposure, see read_exp_info
+    """
+    import multiprocessing
+
+    nexp = len(expnums)
+    nproc = max(1, min(nproc, nexp))
+
+    print("reading %d exposure summaries "
+          "with %d processes" % (nexp, nproc))
+
+    if nproc == 1:
+        return [read_exp_info(piff_run, expnum) for expnum in expnums]
+
+    global _PIFF_RUN
+    _PIFF_RUN = piff_run
+
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(processes=nproc) as pool:
+            # send the exposures in chunks to cut the messaging overhead
+            chunksize = max(1, nexp // (4*nproc))
+            infos = pool.map(_read_exp_info, expnums, chunksize=chunksize)
+    finally:
+        _PIFF_RUN = None
+
+    return infos
+
+
+def read_exp_info(piff_run, expnum):
+    """
+    read the info for each ccd from the piff exposure summary, with bflags,
+    comments and nstars_used added
+
+    nstars_used is the number of stars with the used bit set in piff_flag.
+    If any piff_flag is nan, all stars in the exposure are counted
+    """
+    import fitsio
+    import esutil as eu
+
+    fname = files.get_piff_exp_summary_file(piff_run, expnum)
+    with fitsio.FITS(fname) as fits:
+        info = fits['info'].read()
+        stars = fits['stars'].read(columns=['ccdnum', 'piff_flag'])
+
+    info = eu.numpy_util.add_fields(info, ADD_FIELDS)
+    info['nstars_used'] = count_used_stars(
+        stars['ccdnum'], stars['piff_flag'], info['ccdnum'],
+    )
+    return info
+
+
+def count_used_stars(star_ccdnum, piff_flag, ccdnum):
+    """
+    count the stars used by piff on each ccd
+
+    parameters
+    ----------
+    star_ccdnum: array
+        The ccd of each star
+    piff_flag: array
+        The piff flags of each star
+    ccdnum: array
+        The ccds for which to count
+
+    returns
+    -------
+    nstars_used: array
+        The number of used stars for each entry in ccdnum
+    """
+    star_ccdnum = np.asarray(star_ccdnum, dtype='i8')
+    piff_flag = np.asarray(piff_flag)
+    ccdnum = np.asarray(ccdnum, dtype='i8')
+
+    nstars_used = np.zeros(ccdnum.size, dtype='i4')
+    if star_ccdnum.size == 0:
+        return nstars_used
+
+    if np.isnan(piff_flag.astype('f8')).any():
+        piff_flag = np.full(piff_flag.size, NAN_PIFF_FLAG, dtype='i4')
+    else:
+        piff_flag = piff_flag.astype('i4')
+
+    used = (piff_flag & USED_FLAG) != 0
+
+    # stars with odd ccd numbers, e.g. negative, are never counted
+    good = used & (star_ccdnum >= 0)
+    counts = np.bincount(star_ccdnum[good])
+
+    w, = np.where((ccdnum >= 0) & (ccdnum < counts.size))
+    nstars_used[w] = counts[ccdnum[w]]
+    return nstars_used
+
+
+def collate(blacklist, infos, expnums):
+    """
+    combine the exposure info and set the flags and comments from the
+    blacklist
+
+    parameters
+    ----------
+    blacklist: array
+        As returned by read_blacklists
+    infos: list
+        The info for each exposure, as returned by read_exp_info
+    expnums: array
+        The exposure number for each entry in infos
+
+    returns
+    -------
+    exp_data: array
+        The combined info
+    """
+    import esutil as eu
+    from .blacklists import make_bigind
+
+    info_expnum = np.repeat(
+        np.asarray(expnums, dtype='i8'),
+        [info.size for info in infos],
+    )
+    exp_data = eu.numpy_util.combine_arrlist(infos, keep=True)
+
+    info_bigind = make_bigind(info_expnum, exp_data['ccdnum'].astype('i8'))
+    bl_bigind = make_bigind(
+        blacklist['expnum'], blacklist['ccdnum'].astype('i8'),
+    )
+
+    s = info_bigind.argsort()
+    sorted_bigind = info_bigind[s]
+
+    ind = np.searchsorted(sorted_bigind, bl_bigind)
+    ind.clip(max=max(sorted_bigind.size-1, 0), out=ind)
+
+    if sorted_bigind.size > 0:
+        found = sorted_bigind[ind] == bl_bigind
+    else:
+        found = np.zeros(bl_bigind.size, dtype=bool)
+
+    if not found.all():
+        missing = ['%d-%02d' % (e, c) for e, c in zip(
+            blacklist['expnum'][~found], blacklist['ccdnum'][~found],
+        )]
+        raise ValueError("blacklist entries not found in the "
+                         "piff outputs: %s" % ', '.join(missing))
+
+    md = s[ind]
+    exp_data['bflags'][md] = EYEBALL
+    exp_data['comments'][md] = blacklist['comments']
+
+    w31, = np.where(exp_data['ccdnum'] == 31)
+    exp_data['bflags'][w31] |= CCD31
+
+    return exp_data
+
+
+def _read_exp_info(expnum):
+    return read_exp_info(_PIFF_RUN, expnum)
@@ -0,0 +1,300 @@
+"""
+pipelined production of MEDS files for a set of tiles
+
+The production of a MEDS file has three stages
+
+    - prep: download the sources and make the null weight images (network
+      bound)
+    - build: run the DESMEDSMakerDESDM (cpu bound)
+    - clean: remove the downloaded sources and null weight images
+
+The TilesetPipeline runs these stages in separate threads connected by
+queues, so that tile-band N+1 is being prepared while N is being built and
+N-1 is being cleaned up.
+"""
+from __future__ import print_function
+import os
+import shutil
+import threading
+import time
+import traceback
+import queue
+import socket
+
+from . import files
+from .status import StatusDB, NERROR_LINES
+
+# marks the end of the work in a queue
+_DONE = None
+
+
+class TilesetPipeline(dict):
+    """
+    make MEDS files for all tiles and bands in a tileset, overlapping the
+    preparation, building and cleanup stages
+
+    parameters
+    ----------
+    tileset: string or dict
+        The tileset identifier, path to a tileset file, or the tileset data.
+        Must contain the medsconf, tile_ids and bands
+    tmpdir: string, optional
+        Temporary directory for writing the MEDS files
+    queue_depth: int, optional
+        Maximum number of prepared tile-bands waiting to be built.  Default 1
+    max_staged: int, optional
+        Maximum number of tile-bands that can be present on the scratch disk
+        at once, including the one being built and those waiting to be
+        cleaned.  Default queue_depth + 2
+    min_free_gb: float, optional
+        Do not start preparing a new tile-band unless the scratch disk has at
+        least this much free space, in GB.  Default 0
+    scratch_dir: string, optional
+        The directory to check for free space. Defaults to $TMPDIR
+    poll_time: float, optional
+        Time in seconds between checks for free space.  Default 30
+    status_file: string, optional
+        The status database recording the outcome for each tile-band,
+        default files.get_status_file(medsconf)
+    """
+    def __init__(self,
+                 tileset,
+                 tmpdir=None,
+                 queue_depth=1,
+                 max_staged=None,
+                 min_free_gb=0.0,
+                 scratch_dir=None,
+                 poll_time=30.0,
+                 status_file=None):
+
+        if isinstance(tileset, dict):
+            self.update(tileset)
+        else:
+            self.update(files.read_tileset(tileset))
+
+        if max_staged is None:
+            max_staged = queue_depth + 2
+
+        if max_staged < 1:
+            raise ValueError("max_staged must be at least 1, "
+                             "got %d" % max_staged)
+
+        self.tmpdir = tmpdir
+        self.queue_depth = queue_depth
+        self.max_staged = max_staged
+        self.min_free_gb = min_free_gb
+        self.poll_time = poll_time
+
+        if scratch_dir is None:
+            scratch_dir = files.get_temp_dir()
+        self.scratch_dir = scratch_dir
+
+        self.config = files.read_meds_config(self['medsconf'])
+
+        if status_file is None:
+            status_file = files.get_status_file(self['medsconf'])
+        self.status_file = status_file
+
+    def get_jobs(self):
+        """
+        get the list of (tilename, band) to process
+        """
+        jobs = []
+        for tilename in self['tile_ids']:
+            for band in self['bands']:
+                jobs.append((tilename, band))
+        return jobs
+
+    def go(self):
+        """
+        run all stages, returning a dict keyed by (tilename, band) with the
+        status of each tile-band, either 'ok' or an error message
+        """
+
+        jobs = self.get_jobs()
+        print("processing %d tile-bands" % len(jobs))
+
+        self.status = {}
+        self._status_lock = threading.Lock()
+        self._staged = threading.BoundedSemaphore(self.max_staged)
+        self._nstaged = 0
+
+        build_queue = queue.Queue(maxsize=self.queue_depth)
+        clean_queue = queue.Queue()
+
+        prep_thread = threading.Thread(
+            target=self._run_prep_stage,
+            args=(jobs, build_queue, clean_queue),
+        )
+        clean_thread = threading.Thread(
+            target=self._run_clean_stage,
+            args=(clean_queue,),
+        )
+        prep_thread.daemon = True
+        clean_thread.daemon = True
+
+        prep_thread.start()
+        clean_thread.start()
+
+        # the cpu-bound stage runs in the main thread
+        self._run_build_stage(build_queue, clean_queue)
+
+        prep_thread.join()
+        clean_queue.put(_DONE)
+        clean_thread.join()
+
+        nbad = len([s for s in self.status.values() if s != 'ok'])
+        print("finished %d tile-bands, %d failed" % (len(jobs), nbad))
+        return self.status
+
+    def _run_prep_stage(self, jobs, build_queue, clean_queue):
+        """
+        download and prepare the inputs, handing them to the build stage
+        """
+        from .desdm_maker import Preparator
+
+        try:
+            for tilename, band in jobs:
+                self._acquire_slot()
+                self._wait_for_scratch_space()
+
+                print("prep: %s %s" % (tilename, band))
+                prep = None
+                try:
+                    prep = Preparator(self.config, tilename, band)
+                    prep.go()
+                except Exception:
+                    self._set_status(tilename, band, traceback.format_exc())
+                    if prep is not None:
+                        clean_queue.put(prep)
+                    else:
+                        self._release_slot()
+                    continue
+
+                build_queue.put(prep)
+        finally:
+            build_queue.put(_DONE)
+
+    def _run_build_stage(self, build_queue, clean_queue):
+        """
+        build the MEDS files for prepared inputs
+        """
+        from .desdm_maker import DESMEDSMakerDESDM
+
+        while True:
+            prep = build_queue.get()
+            if prep is _DONE:
+                break
+
+            tilename, band = prep['tilename'], prep['band']
+            print("build: %s %s" % (tilename, band))
+            self._record_start(tilename, band)
+            try:
+                fileconf = files.read_yaml(
+                    files.get_desdm_file_config(
+                        self.config['medsconf'],
+                        tilename,
+                        band,
+                    )
+                )
+                maker = DESMEDSMakerDESDM(
+                    self.config,
+                    fileconf,
+                    tmpdir=self.tmpdir,
+                )
+                maker.go()
+                self._set_status(
+                    tilename, band, 'ok', meds_file=fileconf['meds_url'],
+                )
+            except Exception:
+                self._set_status(tilename, band, traceback.format_exc())
+            finally:
+                clean_queue.put(prep)
+
+    def _run_clean_stage(self, clean_queue):
+        """
+        remove the inputs for tile-bands that are done
+        """
+        while True:
+            prep = clean_queue.get()
+            if prep is _DONE:
+                break
+
+            print("clean: %s %s" % (prep['tilename'], prep['band']))
+            try:
+                prep.clean()
+            except Exception:
+                print("error cleaning %s %s:" % (prep['tilename'],
+                                                 prep['band']))
+                traceback.print_exc()
+            finally:
+                self._release_slot()
+
+    def _acquire_slot(self):
+        self._staged.acquire()
+        with self._status_lock:
+            self._nstaged += 1
+
+    def _release_slot(self):
+        with self._status_lock:
+            self._nstaged -= 1
+        self._staged.release()
+
+    def _wait_for_scratch_space(self):
+        """
+        wait until there is enough free space on the scratch disk
+
+        We never wait if no other tile-band is staged, since no space would
+        be freed
+        """
+        if self.min_free_gb <= 0:
+            return
+
+        while True:
+            free_gb = get_free_gb(self.scratch_dir)
+            if free_gb >= self.min_free_gb or self._nstaged <= 1:
+                break
+
+            print("only %g GB free in %s, waiting for "
+                  "%g GB" % (free_gb, self.scratch_dir, self.min_free_gb))
+            time.sleep(self.poll_time)
+
+    def _set_status(self, tilename, band, status, meds_file=None):
+        with self._status_lock:
+            db = StatusDB(self.status_file)
+            try:
+                db.add_jobs([(tilename, band)])
+                if status == 'ok' and meds_file is not None:
+                    file_bytes = db.set_output(tilename, band, meds_file)
+                    if file_bytes is None:
+                        status = 'meds file was not written: %s' % meds_file
+
+                if status == 'ok':
+                    db.set_done(tilename, band)
+                else:
+                    print("error processing %s %s:\n%s" % (
+                        tilename, band, status,
+                    ))
+                    error = '\n'.join(status.splitlines()[-NERROR_LINES:])
+                    db.set_failed(tilename, band, error)
+            finally:
+                db.close()
+
+            self.status[(tilename, band)] = status
+
+    def _record_start(self, tilename, band):
+        with self._status_lock:
+            db = StatusDB(self.status_file)
+            try:
+                db.start(tilename, band, socket.gethostname(), os.getpid())
+            finally:
+                db.close()
+
+
+def get_free_gb(dir):
+    """
+    get free space in the file system holding the directory, in GB
+    """
+    dir = os.path.expandvars(dir)
+    usage = shutil.disk_usage(dir)
+    return usage.free/1024.0**3
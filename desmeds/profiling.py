@@ -0,0 +1,256 @@
+"""
+opt-in profiling for the command line scripts
+
+Three modes are supported
+
+    cprofile: run under cProfile, writing the stats to {output}.prof and
+        a summary sorted by cumulative time to {output}.txt
+    sample: sample the stack of the main thread at fixed intervals,
+        writing the stacks in the collapsed format used by flamegraph.pl
+        and speedscope to {output}-sample.txt
+    tracemalloc: trace memory allocations, writing the top allocation sites
+        at the end of each maker stage to {output}-tracemalloc.txt
+
+Child processes, such as those used to write shards, are not profiled
+"""
+from __future__ import print_function
+import sys
+import time
+import threading
+from collections import Counter
+
+from . import instrument
+
+MODES = ['cprofile', 'sample', 'tracemalloc']
+DEFAULT_OUTPUT = 'desmeds-profile'
+
+# number of entries to show in summaries
+NTOP = 30
+
+
+def add_profile_args(parser):
+    """
+    add the --profile and --profile-output options to the parser
+    """
+    parser.add_argument(
+        '--profile',
+        choices=MODES,
+        default=None,
+        help='run the job under the profiler',
+    )
+    parser.add_argument(
+        '--profile-output',
+        default=DEFAULT_OUTPUT,
+        help=('front of the name for the profile output files, '
+              'default %s' % DEFAULT_OUTPUT),
+    )
+
+
+def run_profiled(func, mode, output=DEFAULT_OUTPUT):
+    """
+    run the function, possibly under a profiler
+
+    parameters
+    ----------
+    func: callable
+        The function to run, taking no arguments
+    mode: string or None
+        One of MODES, or None for no profiling
+    output: string, optional
+        The front of the name for the output files
+
+    returns
+    -------
+    the return value of the function
+    """
+    if mode is None:
+        return func()
+    elif mode == 'cprofile':
+        return _run_cprofile(func, output)
+    elif mode == 'sample':
+        return _run_sample(func, output)
+    elif mode == 'tracemalloc':
+        return _run_tracemalloc(func, output)
+    else:
+        raise ValueError("profile mode should be one of %s, "
+                         "got '%s'" % (MODES, mode))
+
+
+def _run_cprofile(func, output):
+    import cProfile
+    import pstats
+
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        return func()
+    finally:
+        prof.disable()
+
+        stats_file = output + '.prof'
+        print('writing profile stats:', stats_file)
+        prof.dump_stats(stats_file)
+
+        summary_file = output + '.txt'
+        print('writing profile summary:', summary_file)
+        with open(summary_file, 'w') as fobj:
+            stats = pstats.Stats(prof, stream=fobj)
+            stats.sort_stats('cumulative').print_stats(NTOP)
+
+
+def _run_sample(func, output):
+    sampler = SamplingProfiler()
+    sampler.start()
+    try:
+        return func()
+    finally:
+        sampler.stop()
+        sampler.write(output + '-sample.txt')
+
+
+def _run_tracemalloc(func, output):
+    tracer = AllocationTracer(output + '-tracemalloc.txt')
+    tracer.start()
+    try:
+        return func()
+    finally:
+        tracer.snapshot('end')
+        tracer.stop()
+
+
+class SamplingProfiler(object):
+    """
+    sample the stack of a thread at fixed intervals, from a background
+    thread
+
+    parameters
+    ----------
+    interval: float, optional
+        Seconds between samples, default 0.01
+    thread_id: int, optional
+        The thread to sample, default the thread creating the profiler
+    """
+    def __init__(self, interval=0.01, thread_id=None):
+        self.interval = interval
+
+        if thread_id is None:
+            thread_id = threading.current_thread().ident
+        self.thread_id = thread_id
+
+        self.counts = Counter()
+        self.nsamples = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        start sampling in a background thread
+        """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._tstart = time.time()
+        self._thread.start()
+
+    def stop(self):
+        """
+        stop sampling
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._tend = time.time()
+
+    def write(self, fname):
+        """
+        write the stacks in collapsed format, one line per unique stack
+        with the number of samples, and print the functions with the most
+        samples
+        """
+        print('writing %d samples over %.1f seconds to: %s' % (
+            self.nsamples, self._tend - self._tstart, fname,
+        ))
+        with open(fname, 'w') as fobj:
+            for stack, count in self.counts.most_common():
+                fobj.write('%s %d\n' % (stack, count))
+
+        leaves = Counter()
+        for stack, count in self.counts.items():
+            leaves[stack.split(';')[-1]] += count
+
+        print('functions with the most samples:')
+        for leaf, count in leaves.most_common(NTOP):
+            print('    %6.2f%% %s' % (100.0*count/self.nsamples, leaf))
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (
+                    code.co_name, code.co_filename, code.co_firstlineno,
+                ))
+                frame = frame.f_back
+
+            self.counts[';'.join(reversed(stack))] += 1
+            self.nsamples += 1
+
+
+class AllocationTracer(object):
+    """
+    trace memory allocations, writing the top allocation sites at the end
+    of each maker stage
+
+    parameters
+    ----------
+    fname: string
+        The output file
+    nframes: int, optional
+        Number of frames to store for each allocation, default 10
+    """
+    def __init__(self, fname, nframes=10):
+        self.fname = fname
+        self.nframes = nframes
+
+    def start(self):
+        """
+        start tracing and register the stage hook
+        """
+        import tracemalloc
+
+        print('writing allocation snapshots to:', self.fname)
+        with open(self.fname, 'w'):
+            pass
+
+        tracemalloc.start(self.nframes)
+        instrument.add_stage_hook(self.snapshot)
+
+    def stop(self):
+        """
+        stop tracing and remove the stage hook
+        """
+        import tracemalloc
+
+        instrument.remove_stage_hook(self.snapshot)
+        tracemalloc.stop()
+
+    def snapshot(self, name):
+        """
+        write the top allocation sites for the memory currently allocated
+        """
+        import tracemalloc
+
+        current, peak = tracemalloc.get_traced_memory()
+        snap = tracemalloc.take_snapshot()
+        stats = snap.statistics('lineno')
+
+        with open(self.fname, 'a') as fobj:
+            fobj.write('stage: %s current: %.1f MB peak: %.1f MB\n' % (
+                name, current/1.0e6, peak/1.0e6,
+            ))
+            for stat in stats[:NTOP]:
+                fobj.write('    %s\n' % stat)
+            fobj.write('\n')
@@ -0,0 +1,399 @@
+"""
+run the tile-band jobs of a tileset on the cores of the local node
+
+Jobs are taken from a work queue kept in the status database, see the status
+module, and started as subprocesses whenever enough cores and memory are
+free for them.  Failed jobs are retried with an exponential backoff.
+
+Runners on several nodes can share the same status database, each taking
+jobs from the queue until none are left.
+"""
+from __future__ import print_function
+import os
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+
+from . import files
+from . import status
+from .batch import make_seed
+
+DEFAULT_THREADS = 1
+DEFAULT_MEMORY_GB = 0.0
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_BACKOFF = 60.0
+DEFAULT_POLL_TIME = 1.0
+
+_script_command = (
+    'desmeds-make-meds --tmpdir=$TMPDIR '
+    '%(medsconf)s %(tilename)s %(band)s'
+)
+_coadd_script_command = (
+    'desmeds-make-meds --tmpdir=$TMPDIR --coadd --seed=%(seed)d '
+    '%(medsconf)s %(tilename)s %(band)s'
+)
+
+
+class LocalRunner(dict):
+    """
+    run the tile-band jobs of a tileset in subprocesses on this node
+
+    parameters
+    ----------
+    tileset: string or dict
+        The tileset identifier, path to a tileset file, or the tileset data.
+        Must contain the medsconf, tile_ids and bands.  An optional
+        'resources' entry gives the threads and memory_gb for jobs, keyed by
+        tilename or by tilename-band, e.g.
+
+            resources:
+                DES0417-5914: {threads: 4, memory_gb: 8}
+                DES0417-5914-r: {memory_gb: 12}
+
+    command: string, optional
+        Shell command template for a job, with %(medsconf)s, %(tilename)s,
+        %(band)s, %(seed)d and %(threads)d available.  Default runs
+        desmeds-make-meds
+    ncores: int, optional
+        Number of cores to use, default all on the node
+    memory_gb: float, optional
+        Memory available for jobs in GB, default the physical memory
+    threads: int, optional
+        Default threads for a job, used for OMP_NUM_THREADS.  Default 1
+    job_memory_gb: float, optional
+        Default memory for a job in GB.  Default 0
+    max_retries: int, optional
+        Number of times a failed job is retried.  Default 2
+    backoff: float, optional
+        Seconds to wait before the first retry, doubling for each further
+        retry.  Default 60
+    status_file: string, optional
+        The status database, default files.get_status_file(medsconf)
+    log_dir: string, optional
+        Directory for job logs, default the logs are written next to the
+        MEDS files as files.get_meds_log_file
+    tmpdir: string, optional
+        Each job gets its own temporary directory under this one, default
+        $TMPDIR
+    retry_failed: bool, optional
+        If True, jobs that failed in a previous run are run again
+    poll_time: float, optional
+        Seconds between checks on running jobs.  Default 1
+    """
+    def __init__(self,
+                 tileset,
+                 command=None,
+                 ncores=None,
+                 memory_gb=None,
+                 threads=DEFAULT_THREADS,
+                 job_memory_gb=DEFAULT_MEMORY_GB,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=DEFAULT_BACKOFF,
+                 status_file=None,
+                 log_dir=None,
+                 tmpdir=None,
+                 retry_failed=False,
+                 poll_time=DEFAULT_POLL_TIME):
+
+        if isinstance(tileset, dict):
+            self.update(tileset)
+        else:
+            self.update(files.read_tileset(tileset))
+
+        if ncores is None:
+            ncores = os.cpu_count()
+        if memory_gb is None:
+            memory_gb = get_memory_gb()
+
+        if ncores < 1:
+            raise ValueError("ncores must be at least 1, got %d" % ncores)
+        if max_retries < 0:
+            raise ValueError("max_retries must be non-negative, "
+                             "got %d" % max_retries)
+
+        self.ncores = ncores
+        self.memory_gb = memory_gb
+        self.threads = threads
+        self.job_memory_gb = job_memory_gb
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.log_dir = log_dir
+        self.retry_failed = retry_failed
+        self.poll_time = poll_time
+        self.host = socket.gethostname()
+
+        if tmpdir is None:
+            tmpdir = files.get_temp_dir()
+        self.tmpdir = tmpdir
+
+        if command is None:
+            command = self._get_default_command()
+        self.command = command
+
+        if status_file is None:
+            status_file = files.get_status_file(self['medsconf'])
+        self.status_file = status_file
+
+    def get_jobs(self):
+        """
+        get the list of (tilename, band) to process
+        """
+        jobs = []
+        for tilename in self['tile_ids']:
+            for band in self['bands']:
+                jobs.append((tilename, band))
+        return jobs
+
+    def get_resources(self, tilename, band):
+        """
+        get the threads and memory in GB for a job, limited to what is
+        available on the node
+        """
+        res = {
+            'threads': self.threads,
+            'memory_gb': self.job_memory_gb,
+        }
+
+        hints = self.get('resources', None)
+        if hints is not None:
+            res.update(hints.get(tilename, {}))
+            res.update(hints.get('%s-%s' % (tilename, band), {}))
+
+        # a job that asks for more than the node has runs alone
+        res['threads'] = max(1, min(int(res['threads']), self.ncores))
+        res['memory_gb'] = min(float(res['memory_gb']), self.memory_gb)
+        return res
+
+    def go(self):
+        """
+        run jobs until none are left to run
+
+        returns
+        -------
+        counts: dict
+            The number of jobs in each state at the end
+        """
+        db = status.StatusDB(self.status_file)
+        try:
+            # other tilesets may share the database, so only the jobs of
+            # this tileset are run, reset and counted
+            self._jobs = self.get_jobs()
+            db.add_jobs(self._jobs)
+
+            # jobs left running on this host by a runner that was killed
+            nreset = db.reset(status.RUNNING, host=self.host, jobs=self._jobs)
+            if nreset > 0:
+                print("reset %d jobs left running "
+                      "on %s" % (nreset, self.host))
+
+            if self.retry_failed:
+                nreset = db.reset(status.FAILED, jobs=self._jobs)
+                print("retrying %d failed jobs" % nreset)
+
+            self._running = {}
+            try:
+                self._run(db)
+            except BaseException:
+                self._stop_all(db)
+                raise
+
+            counts = db.get_counts(jobs=self._jobs)
+        finally:
+            db.close()
+
+        print("done: %(done)d failed: %(failed)d "
+              "pending: %(pending)d running: %(running)d" % counts)
+        return counts
+
+    def _run(self, db):
+        """
+        the scheduling loop
+        """
+        while True:
+            self._reap(db)
+            self._start_ready(db)
+
+            if len(self._running) == 0:
+                counts = db.get_counts(jobs=self._jobs)
+                if counts[status.PENDING] == 0:
+                    break
+
+            time.sleep(self.poll_time)
+
+    def _start_ready(self, db):
+        """
+        start ready jobs, in order, that fit in the free cores and memory
+        """
+        free_cores = self.ncores
+        free_memory = self.memory_gb
+        for job in self._running.values():
+            free_cores -= job['threads']
+            free_memory -= job['memory_gb']
+
+        if free_cores <= 0:
+            return
+
+        for row in db.get_ready(jobs=self._jobs):
+            tilename, band = row['tilename'], row['band']
+            res = self.get_resources(tilename, band)
+
+            if res['threads'] > free_cores:
+                continue
+            if res['memory_gb'] > free_memory:
+                continue
+
+            if not db.claim(tilename, band, self.host):
+                # taken by another runner
+                continue
+
+            job = self._start(tilename, band, res)
+            db.set_pid(tilename, band, job['proc'].pid)
+            db.set_tuning(tilename, band, {
+                'omp_num_threads': res['threads'],
+                'workers': 1,
+            })
+            self._running[(tilename, band)] = job
+
+            free_cores -= res['threads']
+            free_memory -= res['memory_gb']
+            if free_cores <= 0:
+                break
+
+    def _start(self, tilename, band, res):
+        """
+        start the job in a subprocess
+        """
+        job = {
+            'tilename': tilename,
+            'band': band,
+            'threads': res['threads'],
+            'memory_gb': res['memory_gb'],
+        }
+
+        job['command'] = self.command % {
+            'medsconf': self['medsconf'],
+            'tilename': tilename,
+            'band': band,
+            'seed': make_seed(dict(self, tilename=tilename, band=band)),
+            'threads': res['threads'],
+        }
+
+        job['log_file'] = self._get_log_file(tilename, band)
+        files.makedir_fromfile(job['log_file'])
+
+        files.try_makedir(self.tmpdir)
+        job['tmpdir'] = tempfile.mkdtemp(
+            prefix='meds-%s-%s-' % (tilename, band),
+            dir=self.tmpdir,
+        )
+
+        env = dict(os.environ)
+        env['TMPDIR'] = job['tmpdir']
+        env['OMP_NUM_THREADS'] = str(res['threads'])
+        env['DESMEDS_NCORES'] = str(res['threads'])
+
+        print("starting %s %s threads: %d memory: %g GB" % (
+            tilename, band, res['threads'], res['memory_gb'],
+        ))
+        job['log_fobj'] = open(job['log_file'], 'w')
+        job['proc'] = subprocess.Popen(
+            job['command'],
+            shell=True,
+            env=env,
+            stdout=job['log_fobj'],
+            stderr=subprocess.STDOUT,
+        )
+        return job
+
+    def _reap(self, db):
+        """
+        record the outcome of jobs that have finished
+        """
+        for key in list(self._running):
+            job = self._running[key]
+            exit_status = job['proc'].poll()
+            if exit_status is None:
+                continue
+
+            del self._running[key]
+            self._cleanup(job)
+
+            tilename, band = key
+            if exit_status == 0:
+                print("finished %s %s" % key)
+                db.set_done(tilename, band)
+                continue
+
+            error = 'exit status %d\n%s' % (
+                exit_status, get_log_tail(job['log_file']),
+            )
+            attempts = db.get(tilename, band)['attempts']
+            if attempts <= self.max_retries:
+                delay = self.backoff*2**(attempts-1)
+                print("%s %s failed with exit status %d, retrying "
+                      "in %g seconds" % (tilename, band, exit_status, delay))
+                db.set_failed(
+                    tilename, band, error, retry_time=time.time() + delay,
+                )
+            else:
+                print("%s %s failed with exit status %d after %d "
+                      "attempts" % (tilename, band, exit_status, attempts))
+                db.set_failed(tilename, band, error)
+
+    def _stop_all(self, db):
+        """
+        stop running jobs and put them back in the queue
+        """
+        for (tilename, band), job in self._running.items():
+            print("stopping %s %s" % (tilename, band))
+            job['proc'].terminate()
+            job['proc'].wait()
+            self._cleanup(job)
+
+        db.reset(status.RUNNING, host=self.host, jobs=self._jobs)
+        self._running = {}
+
+    def _cleanup(self, job):
+        job['log_fobj'].close()
+        shutil.rmtree(job['tmpdir'], ignore_errors=True)
+
+    def _get_log_file(self, tilename, band):
+        if self.log_dir is not None:
+            return os.path.join(
+                self.log_dir,
+                '%s-%s-%s.log' % (tilename, band, self['medsconf']),
+            )
+        else:
+            return os.path.expandvars(
+                files.get_meds_log_file(self['medsconf'], tilename, band)
+            )
+
+    def _get_default_command(self):
+        config = files.read_meds_config(self['medsconf'])
+        if 'coadd' in config:
+            return _coadd_script_command
+        else:
+            return _script_command
+
+
+def get_memory_gb():
+    """
+    get the physical memory of the node in GB
+    """
+    nbytes = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    return nbytes/1024.0**3
+
+
+def get_log_tail(fname, nlines=status.NERROR_LINES):
+    """
+    get the last lines of a log file
+    """
+    try:
+        with open(fname) as fobj:
+            lines = fobj.readlines()
+    except IOError:
+        return ''
+
+    return ''.join(lines[-nlines:])
@@ -0,0 +1,396 @@
+"""
+tools for writing MEDS files in shards of objects and merging them
+into a single MEDS file
+"""
+from __future__ import print_function
+import os
+import numpy as np
+
+from .util import DEFVAL
+
+OBJECT_DATA_EXT = 'object_data'
+PSF_EXT = 'psf'
+
+
+def get_shard_ranges(nobj, nshards):
+    """
+    split the objects into contiguous, disjoint ranges
+
+    parameters
+    ----------
+    nobj: int
+        Number of objects
+    nshards: int
+        Number of shards.  If greater than nobj, nobj shards are used
+
+    returns
+    -------
+    list of (start, end) tuples; end is not inclusive
+    """
+    if nshards < 1:
+        raise ValueError("nshards must be at least 1, got %d" % nshards)
+
+    nshards = max(1, min(nshards, nobj))
+    edges = np.linspace(0, nobj, nshards+1).astype('i8')
+
+    return [(edges[i], edges[i+1]) for i in range(nshards)]
+
+
+def get_chunk_ranges(nobj, chunksize):
+    """
+    split the objects into contiguous, disjoint ranges of fixed size; the
+    last range may be smaller
+
+    parameters
+    ----------
+    nobj: int
+        Number of objects
+    chunksize: int
+        Number of objects in each range
+
+    returns
+    -------
+    list of (start, end) tuples; end is not inclusive
+    """
+    if chunksize < 1:
+        raise ValueError("chunksize must be at least 1, got %d" % chunksize)
+
+    return [
+        (start, min(start+chunksize, nobj))
+        for start in range(0, nobj, chunksize)
+    ]
+
+
+def get_shard_file(fname, ishard):
+    """
+    get the name of the file for the given shard, e.g.
+
+        DES0000+0000_r_meds-y6a2.fits -> DES0000+0000_r_meds-y6a2-shard003.fits
+    """
+    fname = fname.replace('.fits.fz', '.fits')
+    front = fname.replace('.fits', '')
+    return '%s-shard%03d.fits' % (front, ishard)
+
+
+def get_chunk_file(fname, ichunk):
+    """
+    get the name of the file for the given checkpoint chunk, e.g.
+
+        DES0000+0000_r_meds-y6a2.fits -> DES0000+0000_r_meds-y6a2-chunk0003.fits
+    """
+    fname = fname.replace('.fits.fz', '.fits')
+    front = fname.replace('.fits', '')
+    return '%s-chunk%04d.fits' % (front, ichunk)
+
+
+def merge_meds_files(shard_files, output_file):
+    """
+    merge MEDS files written for disjoint, ordered ranges of objects into a
+    single MEDS file
+
+    The object data are concatenated, with start_row and psf_start_row
+    shifted to point into the concatenated cutout extensions.  All other
+    tables, such as the image_info and metadata, are taken from the first
+    shard
+
+    parameters
+    ----------
+    shard_files: list of strings
+        The shard files, in object order
+    output_file: string
+        The merged file, which must not be compressed
+    """
+    import fitsio
+
+    if len(shard_files) == 0:
+        raise ValueError("no shard files sent")
+
+    print("merging %d shards -> %s" % (len(shard_files), output_file))
+
+    with fitsio.FITS(shard_files[0]) as fits:
+        image_exts, table_exts = _get_ext_names(fits)
+
+    obj_list = _read_object_data(shard_files)
+    image_sizes = _get_image_sizes(shard_files, image_exts, obj_list)
+    obj_data = _merge_object_data(obj_list, image_sizes)
+
+    with fitsio.FITS(output_file, 'rw', clobber=True) as output:
+        output.write(obj_data, extname=OBJECT_DATA_EXT)
+
+        with fitsio.FITS(shard_files[0]) as fits:
+            for extname in table_exts:
+                if extname == OBJECT_DATA_EXT:
+                    continue
+                output.write(fits[extname].read(), extname=extname)
+
+        for extname in image_exts:
+            _merge_image_ext(shard_files, extname, image_sizes, output)
+
+
+def _get_ext_names(fits):
+    """
+    get the names of the 1-d image extensions holding cutouts and of the
+    table extensions
+    """
+    image_exts = []
+    table_exts = []
+
+    for hdu in fits:
+        extname = hdu.get_extname()
+        if extname == '':
+            # the primary hdu
+            continue
+
+        if hdu.get_exttype() == 'IMAGE_HDU':
+            image_exts.append(extname)
+        else:
+            table_exts.append(extname)
+
+    return image_exts, table_exts
+
+
+def _read_object_data(shard_files):
+    """
+    read the object data from each shard
+    """
+    import fitsio
+
+    return [
+        fitsio.read(fname, ext=OBJECT_DATA_EXT) for fname in shard_files
+    ]
+
+
+def _get_image_sizes(shard_files, image_exts, obj_list):
+    """
+    get the number of pixels used by the objects in each cutout extension
+    of each shard.  These are the pixels copied to the merged file, and
+    the offsets applied to the start rows
+
+    The extensions can hold more pixels than are used, e.g. a shard with no
+    cutouts still has an image of one pixel, since fitsio cannot create an
+    empty image
+    """
+    import fitsio
+
+    sizes = {extname: [] for extname in image_exts}
+    for fname, obj_data in zip(shard_files, obj_list):
+        with fitsio.FITS(fname) as fits:
+            for extname in image_exts:
+                dims = fits[extname].get_dims()
+                hdu_npix = int(np.prod(dims)) if dims else 0
+
+                npix = _get_used_npix(obj_data, extname)
+                if npix is None:
+                    npix = hdu_npix
+                elif npix > hdu_npix:
+                    raise ValueError(
+                        "extension %s of %s holds %d pixels, but the "
+                        "objects use %d" % (extname, fname, hdu_npix, npix)
+                    )
+
+                sizes[extname].append(npix)
+
+    return sizes
+
+
+def _get_used_npix(obj_data, extname):
+    """
+    number of pixels used by the objects in the extension, or None if it
+    cannot be determined from the object data
+    """
+    if extname == PSF_EXT:
+        return _get_psf_npix(obj_data)
+    else:
+        return _get_cutout_npix(obj_data)
+
+
+def _merge_image_ext(shard_files, extname, image_sizes, output):
+    """
+    concatenate the used pixels of the 1-d cutout extension from all shards
+    into the output
+    """
+    import fitsio
+
+    sizes = image_sizes[extname]
+    total = sum(sizes)
+
+    with fitsio.FITS(shard_files[0]) as fits:
+        hdr = fits[extname].read_header()
+        dtype = fits[extname][0:1].dtype
+
+    # fitsio cannot create an empty image
+    dims = [max(total, 1)]
+    output.create_image_hdu(dims=dims, dtype=dtype, extname=extname)
+    output[extname].write_keys(hdr, clean=True)
+
+    offset = 0
+    for i, fname in enumerate(shard_files):
+        if sizes[i] > 0:
+            with fitsio.FITS(fname) as fits:
+                data = fits[extname][0:sizes[i]]
+
+            output[extname].write(data, start=offset)
+
+        offset += sizes[i]
+
+
+def _merge_object_data(obj_list, image_sizes):
+    """
+    concatenate the object data, shifting the start rows by the number of
+    pixels placed in the merged extensions before each shard
+    """
+    nshard = len(obj_list)
+    obj_list = _pad_object_data(obj_list)
+
+    cutout_sizes = _get_cutout_sizes(image_sizes, nshard)
+    psf_sizes = image_sizes.get(PSF_EXT, [0]*nshard)
+
+    image_offset = 0
+    psf_offset = 0
+    for i, obj_data in enumerate(obj_list):
+        used = _get_used_mask(obj_data)
+
+        if 'start_row' in obj_data.dtype.names:
+            obj_data['start_row'][used] += image_offset
+        if 'psf_start_row' in obj_data.dtype.names:
+            psf_used = used & (obj_data['psf_box_size'] > 0)
+            obj_data['psf_start_row'][psf_used] += psf_offset
+
+        image_offset += cutout_sizes[i]
+        psf_offset += psf_sizes[i]
+
+    return np.concatenate(obj_list)
+
+
+def _get_cutout_sizes(image_sizes, nshard):
+    """
+    the pixels used in each shard by the extensions sharing start_row,
+    which is all of them but the psf
+    """
+    sizes = [
+        image_sizes[extname] for extname in image_sizes
+        if extname != PSF_EXT
+    ]
+    if len(sizes) == 0:
+        return [0]*nshard
+
+    for other in sizes[1:]:
+        assert other == sizes[0], "cutout extensions differ in size"
+
+    return sizes[0]
+
+
+def _get_cutout_npix(obj_data):
+    """
+    total number of pixels in the cutouts of the objects
+    """
+    box_size = obj_data['box_size'].astype('i8')
+    return int((box_size**2 * obj_data['ncutout']).sum())
+
+
+def _get_psf_npix(obj_data):
+    """
+    number of pixels in the psf extension up to the end of the last psf
+    used by the objects.  The psf extension can be allocated larger than
+    needed, and the extra pixels are not kept in the merge
+
+    returns None if the object data have no psf layout
+    """
+    names = obj_data.dtype.names
+    if 'psf_start_row' not in names or 'psf_box_size' not in names:
+        return None
+
+    used = _get_used_mask(obj_data) & (obj_data['psf_box_size'] > 0)
+    if not used.any():
+        return 0
+
+    if 'psf_row_size' in names and 'psf_col_size' in names:
+        npix = (obj_data['psf_row_size'].astype('i8')
+                * obj_data['psf_col_size'])
+    else:
+        npix = obj_data['psf_box_size'].astype('i8')**2
+
+    start = obj_data['psf_start_row'].astype('i8')
+    return int((start[used] + npix[used]).max())
+
+
+def _get_max_cutouts(obj_data):
+    """
+    the per-cutout fields are read as 1-d arrays when max_cutouts is 1
+    """
+    file_id = obj_data['file_id']
+    if file_id.ndim == 1:
+        return 1
+    else:
+        return file_id.shape[1]
+
+
+def _get_used_mask(obj_data):
+    """
+    boolean array with the shape of the per-cutout fields, marking real
+    cutouts
+    """
+    if obj_data['file_id'].ndim == 1:
+        return obj_data['ncutout'] > 0
+
+    max_cutouts = _get_max_cutouts(obj_data)
+    icut = np.arange(max_cutouts)
+    return icut[np.newaxis, :] < obj_data['ncutout'][:, np.newaxis]
+
+
+def _pad_object_data(obj_list):
+    """
+    the shards can have different max_cutouts; pad all the per-cutout
+    fields to the largest
+
+    The fill value is taken from an unused entry in the widest shard, if
+    available, otherwise DEFVAL is used
+    """
+    widths = [_get_max_cutouts(obj_data) for obj_data in obj_list]
+    max_cutouts = max(widths)
+    if all(width == max_cutouts for width in widths):
+        return obj_list
+
+    widest = obj_list[int(np.argmax(widths))]
+    unused = ~_get_used_mask(widest)
+
+    descr = []
+    for name in widest.dtype.names:
+        dt = widest.dtype[name]
+        descr.append((name, dt.base.str, dt.shape) if dt.shape else
+                     (name, dt.str))
+
+    padded = []
+    for obj_data in obj_list:
+        width = _get_max_cutouts(obj_data)
+        if width == max_cutouts:
+            padded.append(obj_data)
+            continue
+
+        new_data = np.zeros(obj_data.size, dtype=descr)
+        for name in widest.dtype.names:
+            if widest.dtype[name].shape == (max_cutouts,):
+                if unused.any():
+                    fill = widest[name][unused][0]
+                else:
+                    fill = DEFVAL
+                new_data[name][:, :] = fill
+                new_data[name][:, :width] = (
+                    obj_data[name].reshape(obj_data.size, width)
+                )
+            else:
+                new_data[name] = obj_data[name]
+
+        padded.append(new_data)
+
+    return padded
+
+
+def remove_shard_files(shard_files):
+    """
+    remove the shard files, ignoring those that do not exist
+    """
+    for fname in shard_files:
+        if os.path.exists(fname):
+            print("removing:", fname)
+            os.remove(fname)
@@ -0,0 +1,188 @@
+"""
+columnar representation of the list of single epoch sources
+
+The source information is held in a numpy structured array, with one row
+per source image.  Strings are held as unicode, and python objects such as
+the wcs headers are held in object columns.
+"""
+from __future__ import print_function
+import numpy as np
+
+
+def make_src_table(columns):
+    """
+    make a source table from a dict of columns
+
+    parameters
+    ----------
+    columns: dict
+        Keyed by column name.  Each entry must be a numpy array, and all
+        must have the same length
+
+    returns
+    -------
+    table: numpy structured array
+    """
+    names = list(columns)
+    if len(names) == 0:
+        raise ValueError("no columns sent")
+
+    nsrc = len(columns[names[0]])
+
+    descr = []
+    for name in names:
+        col = columns[name]
+        if len(col) != nsrc:
+            raise ValueError("column %s has length %d, "
+                             "expected %d" % (name, len(col), nsrc))
+        descr.append((name, col.dtype))
+
+    table = np.zeros(nsrc, dtype=descr)
+    for name in names:
+        table[name] = columns[name]
+
+    return table
+
+
+def add_columns(table, columns):
+    """
+    return a new table with the columns added, replacing any existing
+    columns with the same name
+
+    parameters
+    ----------
+    table: numpy structured array
+        The source table
+    columns: dict
+        Keyed by column name, with arrays of the same length as the table
+    """
+    all_columns = {}
+    for name in table.dtype.names:
+        all_columns[name] = table[name]
+
+    all_columns.update(columns)
+    return make_src_table(all_columns)
+
+
+def srclist_to_table(srclist, names=None):
+    """
+    convert a list of dicts into a source table
+
+    The column types are taken from the values in the first entry: strings
+    become unicode columns, ints and floats numeric columns, and anything
+    else an object column
+
+    parameters
+    ----------
+    srclist: list of dicts
+        The source list
+    names: list of strings, optional
+        The names of the entries to keep, default all in the first entry
+    """
+    if len(srclist) == 0:
+        raise ValueError("cannot convert an empty source list")
+
+    if names is None:
+        names = list(srclist[0].keys())
+
+    columns = {}
+    for name in names:
+        columns[name] = _to_array([src[name] for src in srclist])
+
+    return make_src_table(columns)
+
+
+def table_to_srclist(table):
+    """
+    convert a source table to a list of dicts holding python scalars, for
+    writing to yaml
+    """
+    names = table.dtype.names
+    columns = [table[name].tolist() for name in names]
+
+    srclist = []
+    for row in zip(*columns):
+        srclist.append(dict(zip(names, row)))
+
+    return srclist
+
+
+def object_array(values):
+    """
+    make a 1-d object array holding the values, which can be dicts or None
+    """
+    arr = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        arr[i] = value
+    return arr
+
+
+def basenames(paths):
+    """
+    get the base names of an array of paths
+    """
+    paths = np.asarray(paths, dtype='U')
+    return np.char.rpartition(paths, '/')[..., 2]
+
+
+def get_filenames_as_ids(paths):
+    """
+    the base name of each path, without the .fz, if present
+    """
+    return np.char.replace(basenames(paths), '.fz', '')
+
+
+def get_exp_band_ccd(paths):
+    """
+    extract the exposure, band and ccd strings from file names such as
+
+        D00502664_r_c36_r2378p01_immasked.fits.fz
+
+    returns
+    -------
+    expstr, bandstr, ccdstr: arrays of strings
+        e.g. 'D00502664', 'r', 'c36'
+    """
+    names = basenames(paths)
+
+    parts = np.char.partition(names, '_')
+    expstr = parts[..., 0]
+
+    parts = np.char.partition(parts[..., 2], '_')
+    bandstr = parts[..., 0]
+
+    parts = np.char.partition(parts[..., 2], '_')
+    ccdstr = parts[..., 0]
+
+    return expstr, bandstr, ccdstr
+
+
+def get_max_str_len(table, names):
+    """
+    get the maximum string length over the given columns
+    """
+    slen = 0
+    for name in names:
+        if table.size > 0:
+            slen = max(slen, np.char.str_len(table[name]).max())
+
+    return int(slen)
+
+
+def _to_array(values):
+    """
+    convert a list of values to an array with appropriate type
+    """
+    first = values[0]
+    if isinstance(first, bytes):
+        return np.array([v.decode('utf-8') for v in values], dtype='U')
+    elif isinstance(first, str):
+        return np.array(values, dtype='U')
+    elif isinstance(first, (bool, np.bool_)):
+        return np.array(values, dtype=bool)
+    elif isinstance(first, (int, np.integer)):
+        return np.array(values, dtype='i8')
+    elif isinstance(first, (float, np.floating)):
+        return np.array(values, dtype='f8')
+    else:
+        return object_array(values)
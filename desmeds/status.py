@@ -0,0 +1,524 @@
+"""
+status of the tile-band jobs for a meds config, kept in a sqlite database
+
+The database is an index of the outputs as well as a work queue: each
+tile-band has a row holding its state, the MEDS file with its size and
+checksum, the run time and a summary of any error.  The threads chosen for
+each job are kept in a separate table.  Tools that need the done or missing
+tile-bands query it instead of checking the output files one by one.
+
+The state is one of
+
+    - pending: waiting to run, possibly not before a retry time
+    - running: claimed by a runner on some host
+    - done: finished successfully
+    - failed: failed and will not be retried
+
+A job is claimed with a single conditional update, so several runners, e.g.
+on different nodes, can share one database as a work queue.  The database
+must then be on a file system with working file locks.
+"""
+from __future__ import print_function
+import os
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import traceback
+from contextlib import contextmanager
+
+from . import files
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STATES = [PENDING, RUNNING, DONE, FAILED]
+
+_SCHEMA = """
+create table if not exists jobs (
+    tilename text not null,
+    band text not null,
+    state text not null default 'pending',
+    attempts integer not null default 0,
+    not_before real not null default 0,
+    host text,
+    pid integer,
+    start_time real,
+    end_time real,
+    error text,
+    run_seconds real,
+    meds_file text,
+    file_bytes integer,
+    checksum text,
+    primary key (tilename, band)
+)
+"""
+
+# the threads chosen for each job, kept apart from the jobs so that tuning
+# a job does not add it to the queue
+_TUNING_SCHEMA = """
+create table if not exists tuning (
+    tilename text not null,
+    band text not null,
+    tuning text not null,
+    primary key (tilename, band)
+)
+"""
+
+# columns added since the first version of the schema, with their types
+_ADDED_COLUMNS = [
+    ('run_seconds', 'real'),
+    ('meds_file', 'text'),
+    ('file_bytes', 'integer'),
+    ('checksum', 'text'),
+]
+
+# bytes read at a time when computing checksums
+CHECKSUM_BUFSIZE = 16*1024*1024
+
+# lines kept from the end of a traceback as the error summary
+NERROR_LINES = 10
+
+
+class StatusDB(object):
+    """
+    the status database for a set of tile-band jobs
+
+    parameters
+    ----------
+    fname: string
+        Path to the sqlite file, created if it does not exist
+    timeout: float, optional
+        Seconds to wait for a lock held by another process.  Default 60
+    """
+    def __init__(self, fname, timeout=60.0):
+        fname = os.path.expandvars(fname)
+        dir = os.path.dirname(fname)
+        if dir != '' and not os.path.exists(dir):
+            os.makedirs(dir, exist_ok=True)
+
+        self.fname = fname
+
+        # autocommit, each statement is its own transaction
+        self.conn = sqlite3.connect(
+            fname,
+            timeout=timeout,
+            isolation_level=None,
+        )
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(_SCHEMA)
+        self.conn.execute(_TUNING_SCHEMA)
+        self._add_missing_columns()
+
+    def close(self):
+        self.conn.close()
+
+    def add_jobs(self, jobs):
+        """
+        add pending jobs; jobs already in the database are left as they are
+
+        parameters
+        ----------
+        jobs: sequence
+            (tilename, band) pairs
+        """
+        self.conn.executemany(
+            'insert or ignore into jobs (tilename, band) values (?, ?)',
+            list(jobs),
+        )
+
+    def get(self, tilename, band):
+        """
+        get the row for a job as a dict, or None if it is not present
+        """
+        row = self.conn.execute(
+            'select * from jobs where tilename = ? and band = ?',
+            (tilename, band),
+        ).fetchone()
+
+        if row is None:
+            return None
+        return dict(row)
+
+    def get_jobs(self, state=None):
+        """
+        get the rows as a list of dicts, in the order they were added
+
+        parameters
+        ----------
+        state: string, optional
+            Only get jobs in this state
+        """
+        if state is None:
+            rows = self.conn.execute('select * from jobs order by rowid')
+        else:
+            _check_state(state)
+            rows = self.conn.execute(
+                'select * from jobs where state = ? order by rowid',
+                (state,),
+            )
+        return [dict(row) for row in rows]
+
+    def get_counts(self, jobs=None):
+        """
+        get the number of jobs in each state
+
+        parameters
+        ----------
+        jobs: sequence, optional
+            Only count these (tilename, band) pairs.  By default all jobs
+            in the database are counted
+        """
+        counts = dict((state, 0) for state in STATES)
+        if jobs is None:
+            rows = self.conn.execute(
+                'select state, count(*) from jobs group by state'
+            )
+            for state, count in rows:
+                counts[state] = count
+        else:
+            rows = self.conn.execute('select tilename, band, state from jobs')
+            for row in _select_jobs(rows, jobs):
+                counts[row['state']] += 1
+        return counts
+
+    def get_done(self):
+        """
+        get the set of (tilename, band) that are done
+        """
+        rows = self.conn.execute(
+            'select tilename, band from jobs where state = ?', (DONE,),
+        )
+        return set((row[0], row[1]) for row in rows)
+
+    def get_ready(self, now=None, jobs=None):
+        """
+        get the pending jobs that can be run now, whose retry time has passed
+
+        parameters
+        ----------
+        now: float, optional
+            The current time, default time.time()
+        jobs: sequence, optional
+            Only get these (tilename, band) pairs.  By default any job in
+            the database can be returned
+        """
+        if now is None:
+            now = time.time()
+
+        rows = self.conn.execute(
+            'select * from jobs where state = ? and not_before <= ? '
+            'order by rowid',
+            (PENDING, now),
+        )
+        if jobs is not None:
+            rows = _select_jobs(rows, jobs)
+        return [dict(row) for row in rows]
+
+    def claim(self, tilename, band, host, pid=None):
+        """
+        mark a pending job as running on the host
+
+        returns
+        -------
+        True if the job was claimed, False if it was no longer pending,
+        e.g. because another runner claimed it first
+        """
+        cursor = self.conn.execute(
+            'update jobs set state = ?, attempts = attempts + 1, '
+            'host = ?, pid = ?, start_time = ?, end_time = null, '
+            'error = null '
+            'where tilename = ? and band = ? and state = ?',
+            (RUNNING, host, pid, time.time(), tilename, band, PENDING),
+        )
+        return cursor.rowcount == 1
+
+    def start(self, tilename, band, host, pid=None):
+        """
+        mark a job as running on the host, adding it if needed
+
+        This is for a job started outside of a runner.  If the job was
+        already claimed, e.g. by the runner that started this process, the
+        attempt is not counted again and the start time is kept
+        """
+        self.add_jobs([(tilename, band)])
+        self.conn.execute(
+            'update jobs set '
+            'attempts = attempts + (state != ?), '
+            'start_time = case when state = ? then start_time else ? end, '
+            'state = ?, host = ?, pid = ?, end_time = null, error = null '
+            'where tilename = ? and band = ?',
+            (RUNNING, RUNNING, time.time(), RUNNING, host, pid,
+             tilename, band),
+        )
+
+    def set_output(self, tilename, band, meds_file, checksum=True):
+        """
+        record the output file with its size and, optionally, checksum
+
+        returns
+        -------
+        The size of the file in bytes, or None if it does not exist
+        """
+        meds_file = os.path.expandvars(meds_file)
+
+        file_bytes, md5 = None, None
+        if os.path.exists(meds_file):
+            file_bytes = os.path.getsize(meds_file)
+            if checksum:
+                md5 = get_checksum(meds_file)
+
+        self.conn.execute(
+            'update jobs set meds_file = ?, file_bytes = ?, checksum = ? '
+            'where tilename = ? and band = ?',
+            (meds_file, file_bytes, md5, tilename, band),
+        )
+        return file_bytes
+
+    def set_tuning(self, tilename, band, tuning):
+        """
+        record the threads chosen for the job, see the tuning module
+
+        The tuning is kept in its own table, replacing any earlier choice,
+        so a job that is not in the queue is not added to it
+
+        parameters
+        ----------
+        tuning: dict
+            Must hold omp_num_threads and workers; stored as JSON
+        """
+        self.conn.execute(
+            'insert or replace into tuning (tilename, band, tuning) '
+            'values (?, ?, ?)',
+            (tilename, band, json.dumps(tuning)),
+        )
+
+    def get_tunings(self):
+        """
+        get the recorded tunings as a dict keyed by (tilename, band)
+        """
+        rows = self.conn.execute('select tilename, band, tuning from tuning')
+        return dict(
+            ((row[0], row[1]), json.loads(row[2])) for row in rows
+        )
+
+    def set_pid(self, tilename, band, pid):
+        self.conn.execute(
+            'update jobs set pid = ? where tilename = ? and band = ?',
+            (pid, tilename, band),
+        )
+
+    def set_done(self, tilename, band):
+        self._finish(tilename, band, DONE, None)
+
+    def set_failed(self, tilename, band, error, retry_time=None):
+        """
+        record a failure
+
+        parameters
+        ----------
+        error: string
+            Summary of the error
+        retry_time: float, optional
+            If sent, the job is set back to pending and will not be run
+            before this time.  Otherwise it is marked failed
+        """
+        if retry_time is None:
+            self._finish(tilename, band, FAILED, error)
+        else:
+            self.conn.execute(
+                'update jobs set state = ?, not_before = ?, end_time = ?, '
+                'error = ? where tilename = ? and band = ?',
+                (PENDING, retry_time, time.time(), error, tilename, band),
+            )
+
+    def reset(self, state, host=None, jobs=None):
+        """
+        set jobs in the given state back to pending, clearing the number of
+        attempts
+
+        This is used to retry failed jobs, or to recover jobs left running
+        by a runner that was killed
+
+        parameters
+        ----------
+        state: string
+            Reset jobs in this state
+        host: string, optional
+            Only reset jobs claimed by this host
+        jobs: sequence, optional
+            Only reset these (tilename, band) pairs
+
+        returns
+        -------
+        The number of jobs reset
+        """
+        _check_state(state)
+
+        query = (
+            'update jobs set state = ?, attempts = 0, not_before = 0 '
+            'where state = ?'
+        )
+        args = [PENDING, state]
+        if host is not None:
+            query += ' and host = ?'
+            args.append(host)
+
+        if jobs is None:
+            cursor = self.conn.execute(query, args)
+            return cursor.rowcount
+
+        query += ' and tilename = ? and band = ?'
+        nreset = 0
+        for tilename, band in jobs:
+            cursor = self.conn.execute(query, args + [tilename, band])
+            nreset += cursor.rowcount
+        return nreset
+
+    def _finish(self, tilename, band, state, error):
+        now = time.time()
+        self.conn.execute(
+            'update jobs set state = ?, end_time = ?, error = ?, '
+            'run_seconds = ? - start_time '
+            'where tilename = ? and band = ?',
+            (state, now, error, now, tilename, band),
+        )
+
+    def _add_missing_columns(self):
+        """
+        add columns missing from databases made with an older schema
+        """
+        rows = self.conn.execute('pragma table_info(jobs)')
+        existing = set(row['name'] for row in rows)
+
+        for name, type in _ADDED_COLUMNS:
+            if name not in existing:
+                self.conn.execute(
+                    'alter table jobs add column %s %s' % (name, type)
+                )
+
+
+@contextmanager
+def track_job(medsconf, tilename, band, meds_file=None, status_file=None):
+    """
+    record the outcome of the code run in the with block in the status
+    database
+
+    The job is marked running on entry.  If the block completes the job is
+    marked done, with the size and checksum of the MEDS file; if the MEDS
+    file was not written the job is marked failed and an IOError is raised.
+    If the block raises the job is marked failed with the end of the
+    traceback, and the exception is raised again
+
+    parameters
+    ----------
+    medsconf: string
+        The meds config name
+    tilename: string
+        e.g. 'DES0417-5914'
+    band: string
+        e.g. 'i'
+    meds_file: string, optional
+        The output file.  Default files.get_meds_file
+    status_file: string, optional
+        The status database, default files.get_status_file(medsconf)
+    """
+    if meds_file is None:
+        meds_file = files.get_meds_file(medsconf, tilename, band)
+    if status_file is None:
+        status_file = files.get_status_file(medsconf)
+
+    db = StatusDB(status_file)
+    try:
+        db.start(tilename, band, socket.gethostname(), pid=os.getpid())
+        try:
+            yield db
+        except BaseException:
+            db.set_failed(tilename, band, get_error_summary())
+            raise
+
+        file_bytes = db.set_output(tilename, band, meds_file)
+        if file_bytes is None:
+            error = 'meds file was not written: %s' % meds_file
+            db.set_failed(tilename, band, error)
+            raise IOError(error)
+
+        db.set_done(tilename, band)
+    finally:
+        db.close()
+
+
+def get_done(medsconf, status_file=None):
+    """
+    get the set of (tilename, band) that are done for the meds config
+
+    These are the jobs marked done in the status database, if it exists,
+    along with the MEDS files found with a scan of the meds directory, see
+    files.find_meds_files.  The scan finds files made before the database
+    was created or made without tracking the status
+
+    parameters
+    ----------
+    medsconf: string
+        The meds config name
+    status_file: string, optional
+        The status database, default files.get_status_file(medsconf)
+    """
+    if status_file is None:
+        status_file = files.get_status_file(medsconf)
+
+    done = files.find_meds_files(medsconf)
+
+    if not os.path.exists(os.path.expandvars(status_file)):
+        print("no status database %s, using the meds files "
+              "found" % status_file)
+        return done
+
+    db = StatusDB(status_file)
+    try:
+        done.update(db.get_done())
+    finally:
+        db.close()
+
+    return done
+
+
+def get_checksum(fname):
+    """
+    get the md5 checksum of the file
+    """
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as fobj:
+        while True:
+            data = fobj.read(CHECKSUM_BUFSIZE)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def get_error_summary(nlines=NERROR_LINES):
+    """
+    get the end of the traceback for the exception being handled
+    """
+    lines = traceback.format_exc().strip().splitlines()
+    return '\n'.join(lines[-nlines:])
+
+
+def _select_jobs(rows, jobs):
+    """
+    keep the rows for the given (tilename, band) pairs
+    """
+    jobs = set(tuple(job) for job in jobs)
+    return [
+        row for row in rows if (row['tilename'], row['band']) in jobs
+    ]
+
+
+def _check_state(state):
+    if state not in STATES:
+        raise ValueError("bad state '%s', expected one "
+                         "of %s" % (state, STATES))
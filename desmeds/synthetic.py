@@ -0,0 +1,673 @@
+"""
+synthetic tiles for benchmarking and testing without DES data
+
+A synthetic tile has all of the inputs read by DESMEDSMakerDESDM: a coadd
+image with weight map, seg map, SExtractor-like catalog and object map,
+plus single epoch images with TPV headers, scamp head files, background and
+seg files.  The single epoch images are placed at random on the coadd pixel
+grid.
+
+The psfs are simple Gaussians with a small spatial variation, with the
+parameters stored in a one row FITS table for each image.  GaussianPSF and
+GaussianPiffPSF provide the same interface as psfex.PSFEx and PIFFWrapper,
+so these stand-ins can be loaded in place of the real psf models; see
+benchmark.SyntheticMEDSMaker
+
+usage
+-----
+fileconf = make_tile('/tmp/tile', nobj=1000, nepoch=10)
+medsconf = get_medsconf()
+"""
+from __future__ import print_function
+import os
+import numpy as np
+import yaml
+
+# the coadd pixel scale in degrees
+PIXEL_SCALE = 0.263/3600.0
+
+MAGZP = 30.0
+SKY_LEVEL = 100.0
+NOISE = 1.0
+
+# psf sigma in pixels, and the fractional change across the image
+PSF_SIGMA = 1.8
+PSF_SIGMA_RANGE = 0.05
+DEFAULT_PSF_SIZE = 25
+
+DEFAULT_COLOR = 1.1
+
+# the objects are drawn out to this many sigma
+DRAW_NSIGMA = 4.0
+
+# number of stamp pixels to draw at a time, limiting the memory
+DRAW_MAX_PIXELS = 10000000
+
+# number of ccds in an exposure, for making up file names
+NCCD = 62
+
+PSF_TYPES = ['psfex', 'piff']
+
+
+def make_tile(dir,
+              nobj=1000,
+              nepoch=10,
+              psf_type='psfex',
+              band='r',
+              tilename='DES0000+0000',
+              coadd_dims=(2000, 2000),
+              se_dims=(1024, 512),
+              sigma_range=(1.0, 4.0),
+              compress=False,
+              seed=None):
+    """
+    write a synthetic tile and the file config for it
+
+    parameters
+    ----------
+    dir: string
+        Directory to hold the files
+    nobj: int, optional
+        Number of objects, default 1000
+    nepoch: int, optional
+        Number of single epoch images, default 10
+    psf_type: string, optional
+        'psfex' or 'piff', the type of single epoch psf, default 'psfex'.
+        The coadd psf is always psfex
+    band: string, optional
+        The band, default 'r'
+    tilename: string, optional
+        The tile name, default 'DES0000+0000'
+    coadd_dims: sequence, optional
+        Dimensions [nrow, ncol] of the coadd image, default [2000, 2000]
+    se_dims: sequence, optional
+        Dimensions [nrow, ncol] of the single epoch images, default
+        [1024, 512]
+    sigma_range: sequence, optional
+        The object sigma in pixels is drawn log-uniform in this range,
+        default [1, 4].  This controls the box size distribution
+    compress: bool, optional
+        If True the meds_url ends in .fits.fz, so the file will be
+        compressed with fpack.  Default False
+    seed: int, optional
+        Seed for the random number generator
+
+    returns
+    -------
+    fileconf: dict
+        The file config; this is also written to {dir}/fileconf.yaml
+    """
+    if psf_type not in PSF_TYPES:
+        raise ValueError("psf_type should be one of %s, "
+                         "got '%s'" % (PSF_TYPES, psf_type))
+
+    rng = np.random.RandomState(seed)
+
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+
+    print('making synthetic tile %s %s with %d objects '
+          'and %d epochs in: %s' % (tilename, band, nobj, nepoch, dir))
+
+    front = os.path.join(dir, '%s_%s' % (tilename, band))
+
+    coadd_wcs = get_coadd_wcs(coadd_dims)
+    cat = make_catalog(rng, nobj, coadd_dims, sigma_range)
+
+    fileconf = {
+        'band': band,
+        'tilename': tilename,
+        'coadd_image_url': front + '.fits',
+        'coadd_cat_url': front + '_cat.fits',
+        'coadd_seg_url': front + '_segmap.fits',
+        'coadd_psf_url': front + '_psfcat.psf',
+        'coadd_magzp': MAGZP,
+        'coadd_object_map': front + '_objmap.fits',
+        'finalcut_flist': os.path.join(dir, 'finalcut-flist.dat'),
+        'seg_flist': os.path.join(dir, 'seg-flist.dat'),
+        'bkg_flist': os.path.join(dir, 'bkg-flist.dat'),
+        'meds_url': front + '_meds-synthetic.fits',
+    }
+    if compress:
+        fileconf['meds_url'] += '.fz'
+
+    if psf_type == 'piff':
+        fileconf['piff_flist'] = os.path.join(dir, 'piff-flist.dat')
+        psf_list_key = 'piff_flist'
+    else:
+        fileconf['psf_flist'] = os.path.join(dir, 'psf-flist.dat')
+        psf_list_key = 'psf_flist'
+
+    _write_coadd(fileconf, rng, cat, coadd_wcs, coadd_dims)
+
+    flists = {
+        'finalcut_flist': [],
+        'seg_flist': [],
+        'bkg_flist': [],
+        psf_list_key: [],
+    }
+    for iepoch in range(nepoch):
+        paths = _write_epoch(
+            dir, rng, iepoch, band, psf_type, cat, coadd_wcs, se_dims,
+        )
+        flists['finalcut_flist'].append(
+            '%s %s %g' % (paths['image'], paths['head'], MAGZP)
+        )
+        flists['seg_flist'].append(paths['seg'])
+        flists['bkg_flist'].append(paths['bkg'])
+        flists[psf_list_key].append(paths['psf'])
+
+    for key, lines in flists.items():
+        _write_lines(fileconf[key], lines)
+
+    fname = os.path.join(dir, 'fileconf.yaml')
+    print('writing:', fname)
+    with open(fname, 'w') as fobj:
+        yaml.dump(fileconf, fobj)
+
+    return fileconf
+
+
+def get_medsconf(psf_type='psfex', psf_stamp_size=DEFAULT_PSF_SIZE):
+    """
+    get a meds config for a synthetic tile
+
+    parameters
+    ----------
+    psf_type: string, optional
+        'psfex' or 'piff', must match the tile.  Default 'psfex'
+    psf_stamp_size: int, optional
+        Size of the psf stamps, default 25
+    """
+    if psf_type not in PSF_TYPES:
+        raise ValueError("psf_type should be one of %s, "
+                         "got '%s'" % (PSF_TYPES, psf_type))
+
+    se = {'type': psf_type, 'stamp_size': psf_stamp_size}
+    if psf_type == 'piff':
+        se['use_color'] = True
+
+    return {
+        'medsconf': 'synthetic',
+        'source_type': 'finalcut',
+        'psf': {
+            'coadd': {'type': 'psfex', 'stamp_size': psf_stamp_size},
+            'se': se,
+        },
+    }
+
+
+def get_coadd_wcs(coadd_dims, ra=10.0, dec=0.0):
+    """
+    get the TAN wcs header for the coadd, as a dict
+
+    parameters
+    ----------
+    coadd_dims: sequence
+        Dimensions [nrow, ncol] of the coadd
+    ra, dec: float, optional
+        Center of the tile in degrees
+    """
+    return {
+        'ctype1': 'RA---TAN',
+        'ctype2': 'DEC--TAN',
+        'crval1': ra,
+        'crval2': dec,
+        'crpix1': coadd_dims[1]/2.0 + 0.5,
+        'crpix2': coadd_dims[0]/2.0 + 0.5,
+        'cd1_1': -PIXEL_SCALE,
+        'cd1_2': 0.0,
+        'cd2_1': 0.0,
+        'cd2_2': PIXEL_SCALE,
+        'equinox': 2000.0,
+        'radesys': 'ICRS',
+    }
+
+
+def get_se_wcs(coadd_wcs, row0, col0):
+    """
+    get the TPV wcs header for a single epoch image whose pixel [0, 0]
+    falls on coadd pixel [row0, col0]
+
+    The polynomial is the identity, so single epoch positions are simply
+    shifted coadd positions, but the TPV code path is still used when
+    converting between pixels and sky
+    """
+    wcs = dict(coadd_wcs)
+    wcs['ctype1'] = 'RA---TPV'
+    wcs['ctype2'] = 'DEC--TPV'
+    wcs['crpix1'] = float(coadd_wcs['crpix1'] - col0)
+    wcs['crpix2'] = float(coadd_wcs['crpix2'] - row0)
+
+    for i in range(11):
+        wcs['pv1_%d' % i] = 0.0
+        wcs['pv2_%d' % i] = 0.0
+
+    wcs['pv1_1'] = 1.0
+    wcs['pv2_1'] = 1.0
+    return wcs
+
+
+def make_catalog(rng, nobj, coadd_dims, sigma_range):
+    """
+    make a SExtractor-like catalog of Gaussian objects at random
+    positions on the coadd
+
+    The positions are 1-offset as in SExtractor
+    """
+    dt = [
+        ('number', 'i4'),
+        ('x_image', 'f4'),
+        ('y_image', 'f4'),
+        ('xmin_image', 'i4'),
+        ('xmax_image', 'i4'),
+        ('ymin_image', 'i4'),
+        ('ymax_image', 'i4'),
+        ('flux_radius', 'f4'),
+        ('a_world', 'f4'),
+        ('b_world', 'f4'),
+        ('flags', 'i2'),
+        ('flux_auto', 'f4'),
+        ('fluxerr_auto', 'f4'),
+        ('x2_image', 'f8'),
+        ('errx2_image', 'f8'),
+        ('y2_image', 'f8'),
+        ('erry2_image', 'f8'),
+        ('isoarea_image', 'i4'),
+    ]
+    cat = np.zeros(nobj, dtype=dt)
+
+    nrow, ncol = coadd_dims
+    cat['number'] = np.arange(1, nobj+1)
+    cat['x_image'] = rng.uniform(low=1.0, high=ncol, size=nobj)
+    cat['y_image'] = rng.uniform(low=1.0, high=nrow, size=nobj)
+
+    sigma = np.exp(rng.uniform(
+        low=np.log(sigma_range[0]),
+        high=np.log(sigma_range[1]),
+        size=nobj,
+    ))
+    axis_ratio = rng.uniform(low=0.5, high=1.0, size=nobj)
+
+    rad = np.ceil(3*sigma).astype('i4')
+    xpix = (cat['x_image'] + 0.5).astype('i4')
+    ypix = (cat['y_image'] + 0.5).astype('i4')
+    cat['xmin_image'] = (xpix - rad).clip(min=1)
+    cat['xmax_image'] = (xpix + rad).clip(max=ncol)
+    cat['ymin_image'] = (ypix - rad).clip(min=1)
+    cat['ymax_image'] = (ypix + rad).clip(max=nrow)
+
+    # half light radius of a Gaussian
+    cat['flux_radius'] = sigma*np.sqrt(2*np.log(2))
+    cat['a_world'] = sigma*PIXEL_SCALE
+    cat['b_world'] = cat['a_world']*axis_ratio
+
+    cat['flux_auto'] = 10.0**rng.uniform(low=2.0, high=5.0, size=nobj)
+    cat['fluxerr_auto'] = np.sqrt(
+        cat['flux_auto'] + 4*np.pi*sigma**2*NOISE**2
+    )
+
+    cat['x2_image'] = sigma**2
+    cat['y2_image'] = sigma**2
+    cat['errx2_image'] = 0.01*sigma**2
+    cat['erry2_image'] = 0.01*sigma**2
+    cat['isoarea_image'] = np.ceil(4*np.pi*sigma**2)
+
+    return cat
+
+
+def make_objmap(rng, cat):
+    """
+    make the object map holding the ids and colors
+    """
+    dt = [
+        ('object_number', 'i4'),
+        ('id', 'i8'),
+        ('gi_color', 'f8'),
+        ('iz_color', 'f8'),
+    ]
+    objmap = np.zeros(cat.size, dtype=dt)
+    objmap['object_number'] = cat['number']
+    objmap['id'] = 100000000 + cat['number']
+    objmap['gi_color'] = rng.normal(loc=DEFAULT_COLOR, scale=0.3,
+                                    size=cat.size)
+    objmap['iz_color'] = rng.normal(loc=0.3, scale=0.1, size=cat.size)
+    return objmap
+
+
+def draw_objects(image, cat, row0=0, col0=0):
+    """
+    add Gaussian objects to the image, and return a seg map holding the
+    object number in the central pixel of each object
+
+    parameters
+    ----------
+    image: array
+        The image, modified in place
+    cat: array
+        The catalog, with 1-offset coadd positions
+    row0, col0: int, optional
+        Coadd pixel of pixel [0, 0] in the image
+    """
+    nrow, ncol = image.shape
+    seg = np.zeros(image.shape, dtype='i4')
+
+    row = cat['y_image'] - 1.0 - row0
+    col = cat['x_image'] - 1.0 - col0
+    sigma = np.sqrt(cat['x2_image'])
+
+    w, = np.where(
+        (row > -DRAW_NSIGMA*sigma)
+        & (row < nrow-1+DRAW_NSIGMA*sigma)
+        & (col > -DRAW_NSIGMA*sigma)
+        & (col < ncol-1+DRAW_NSIGMA*sigma)
+    )
+    if w.size == 0:
+        return seg
+
+    rad = int(np.ceil(DRAW_NSIGMA*sigma[w].max()))
+    offsets = np.arange(-rad, rad+1)
+    doff, coff = np.meshgrid(offsets, offsets, indexing='ij')
+    doff = doff.ravel()
+    coff = coff.ravel()
+
+    chunksize = max(1, DRAW_MAX_PIXELS//doff.size)
+    for start in range(0, w.size, chunksize):
+        ind = w[start:start+chunksize]
+
+        rcen = (row[ind] + 0.5).astype('i8')
+        ccen = (col[ind] + 0.5).astype('i8')
+        rows = rcen[:, np.newaxis] + doff[np.newaxis, :]
+        cols = ccen[:, np.newaxis] + coff[np.newaxis, :]
+
+        s2 = (sigma[ind]**2)[:, np.newaxis]
+        r2 = (rows - row[ind, np.newaxis])**2 + (cols - col[ind, np.newaxis])**2
+        norm = (cat['flux_auto'][ind]/(2*np.pi))[:, np.newaxis]/s2
+        vals = norm*np.exp(-0.5*r2/s2)
+
+        keep = (rows >= 0) & (rows < nrow) & (cols >= 0) & (cols < ncol)
+        np.add.at(image, (rows[keep], cols[keep]), vals[keep])
+
+        keep = (rcen >= 0) & (rcen < nrow) & (ccen >= 0) & (ccen < ncol)
+        seg[rcen[keep], ccen[keep]] = cat['number'][ind[keep]]
+
+    return seg
+
+
+def write_psf(fname, sigma, sigma_grad, stamp_size=DEFAULT_PSF_SIZE):
+    """
+    write the parameters for a GaussianPSF
+
+    parameters
+    ----------
+    fname: string
+        The output file
+    sigma: float
+        The sigma in pixels at pixel [0, 0]
+    sigma_grad: sequence
+        Change of sigma per pixel in row and column
+    stamp_size: int, optional
+        Size of the psf stamps, default 25
+    """
+    import fitsio
+
+    dt = [
+        ('sigma', 'f8'),
+        ('sigma_grad_row', 'f8'),
+        ('sigma_grad_col', 'f8'),
+        ('stamp_size', 'i4'),
+    ]
+    data = np.zeros(1, dtype=dt)
+    data['sigma'] = sigma
+    data['sigma_grad_row'] = sigma_grad[0]
+    data['sigma_grad_col'] = sigma_grad[1]
+    data['stamp_size'] = stamp_size
+
+    fitsio.write(fname, data, extname='psf', clobber=True)
+
+
+class GaussianPSF(dict):
+    """
+    analytic Gaussian psf, providing the interface of psfex.PSFEx
+
+    parameters
+    ----------
+    fname: string
+        File holding the parameters, written by write_psf
+    stamp_size: int, optional
+        Size of the stamps, default is taken from the file
+    """
+    def __init__(self, fname, stamp_size=None):
+        import fitsio
+
+        data = fitsio.read(fname, ext='psf')
+
+        self['filename'] = fname
+        self['sigma'] = float(data['sigma'][0])
+        self['sigma_grad_row'] = float(data['sigma_grad_row'][0])
+        self['sigma_grad_col'] = float(data['sigma_grad_col'][0])
+
+        if stamp_size is None:
+            stamp_size = int(data['stamp_size'][0])
+
+        self['stamp_size'] = stamp_size
+        self['rec_shape'] = (stamp_size, stamp_size)
+
+    def get_rec_shape(self, *args, **kwargs):
+        return self['rec_shape']
+
+    def get_rec(self, row, col, color=None):
+        """
+        get the psf reconstruction as a numpy array
+
+        image is normalized
+        """
+        sigma = self._get_sigma_at(row, col, color=color)
+        rowcen, colcen = self.get_center(row, col)
+
+        nrow, ncol = self['rec_shape']
+        rows, cols = np.mgrid[0:nrow, 0:ncol]
+
+        r2 = (rows - rowcen)**2 + (cols - colcen)**2
+        im = np.exp(-0.5*r2/sigma**2)
+        im *= (1.0/im.sum())
+
+        return im
+
+    def get_center(self, row, col):
+        """
+        get the center location, the center of the stamp plus the offset
+        of the position from the nearest pixel
+        """
+        sa = np.array(self.get_rec_shape(row, col))
+
+        drow = row - int(row + 0.5)
+        dcol = col - int(col + 0.5)
+
+        return np.array([
+            (sa[0] - 1)/2.0 + drow,
+            (sa[1] - 1)/2.0 + dcol,
+        ])
+
+    def get_sigma(self):
+        """
+        pixels
+        """
+        return self['sigma']
+
+    def _get_sigma_at(self, row, col, color=None):
+        sigma = self['sigma']*(
+            1.0 + self['sigma_grad_row']*row + self['sigma_grad_col']*col
+        )
+        if color is not None:
+            # redder objects have slightly smaller psfs
+            sigma *= 1.0 - 0.01*(color - DEFAULT_COLOR)
+
+        return sigma
+
+
+class GaussianPiffPSF(GaussianPSF):
+    """
+    analytic Gaussian psf, providing the interface of PIFFWrapper
+
+    parameters
+    ----------
+    fname: string
+        File holding the parameters, written by write_psf
+    stamp_size: int, optional
+        Size of the stamps, default 25
+    ccdnum: int, optional
+        The ccd number, not used but kept for consistency with PIFFWrapper
+    wcs: wcs object, optional
+        The wcs, can also be set with set_wcs
+    """
+    def __init__(self,
+                 fname,
+                 stamp_size=DEFAULT_PSF_SIZE,
+                 ccdnum=None,
+                 wcs=None):
+        super(GaussianPiffPSF, self).__init__(fname, stamp_size=stamp_size)
+        self.ccdnum = ccdnum
+        self._wcs = wcs
+
+    def set_wcs(self, wcs):
+        self._wcs = wcs
+
+    def get_wcs(self):
+        return self._wcs
+
+
+def _write_coadd(fileconf, rng, cat, coadd_wcs, coadd_dims):
+    """
+    write the coadd image, weight, seg map, catalog, object map and psf
+    """
+    import fitsio
+
+    image = rng.normal(scale=NOISE, size=coadd_dims).astype('f4')
+    seg = draw_objects(image, cat)
+    weight = np.zeros(coadd_dims, dtype='f4') + 1.0/NOISE**2
+
+    hdr = _make_header(coadd_wcs, MAGZP)
+
+    fname = fileconf['coadd_image_url']
+    print('writing:', fname)
+    with fitsio.FITS(fname, 'rw', clobber=True) as fits:
+        fits.write(None)
+        fits.write(image, extname='sci', header=hdr)
+        fits.write(weight, extname='wgt', header=hdr)
+
+    _write_image(fileconf['coadd_seg_url'], seg, hdr, 'seg')
+
+    print('writing:', fileconf['coadd_cat_url'])
+    fitsio.write(fileconf['coadd_cat_url'], cat,
+                 extname='LDAC_OBJECTS', clobber=True)
+
+    print('writing:', fileconf['coadd_object_map'])
+    fitsio.write(fileconf['coadd_object_map'], make_objmap(rng, cat),
+                 extname='OBJECTS', clobber=True)
+
+    write_psf(fileconf['coadd_psf_url'], PSF_SIGMA, [0.0, 0.0])
+
+
+def _write_epoch(dir, rng, iepoch, band, psf_type, cat, coadd_wcs, se_dims):
+    """
+    write the files for a single epoch image placed at random on the coadd
+    grid, overlapping it at least partly
+    """
+    import fitsio
+
+    expnum = 100000 + iepoch//NCCD
+    ccdnum = 1 + iepoch % NCCD
+    front = os.path.join(
+        dir, 'D%08d_%s_c%02d_r1' % (expnum, band, ccdnum),
+    )
+    paths = {
+        'image': front + '_immasked.fits',
+        'head': front + '_scamp.ohead',
+        'bkg': front + '_bkg.fits',
+        'seg': front + '_segmap.fits',
+    }
+    if psf_type == 'piff':
+        paths['psf'] = front + '_piff-model.fits'
+    else:
+        paths['psf'] = front + '_psfexcat.psf'
+
+    nrow, ncol = se_dims
+    coadd_nrow = int(2*coadd_wcs['crpix2'] - 1)
+    coadd_ncol = int(2*coadd_wcs['crpix1'] - 1)
+    row0 = rng.randint(-nrow//2, coadd_nrow - nrow//2)
+    col0 = rng.randint(-ncol//2, coadd_ncol - ncol//2)
+
+    wcs = get_se_wcs(coadd_wcs, row0, col0)
+    hdr = _make_header(wcs, MAGZP)
+
+    image = rng.normal(scale=NOISE, size=se_dims).astype('f4')
+    seg = draw_objects(image, cat, row0=row0, col0=col0)
+    image += SKY_LEVEL
+
+    bmask = np.zeros(se_dims, dtype='i4')
+    weight = np.zeros(se_dims, dtype='f4') + 1.0/NOISE**2
+    bkg = np.zeros(se_dims, dtype='f4') + SKY_LEVEL
+
+    print('writing:', paths['image'])
+    with fitsio.FITS(paths['image'], 'rw', clobber=True) as fits:
+        fits.write(None)
+        fits.write(image, extname='sci', header=hdr)
+        fits.write(bmask, extname='msk', header=hdr)
+        fits.write(weight, extname='wgt', header=hdr)
+
+    _write_image(paths['bkg'], bkg, hdr, 'sci')
+    _write_image(paths['seg'], seg, hdr, 'sci')
+    _write_scamp_head(paths['head'], wcs)
+
+    sigma_grad = rng.uniform(
+        low=-PSF_SIGMA_RANGE, high=PSF_SIGMA_RANGE, size=2,
+    )/np.array(se_dims)
+    write_psf(paths['psf'], PSF_SIGMA, sigma_grad)
+
+    return paths
+
+
+def _make_header(wcs, magzp):
+    """
+    make a FITSHDR from the wcs dict, adding the zero point
+    """
+    import fitsio
+
+    hdr = fitsio.FITSHDR()
+    for key, value in wcs.items():
+        hdr[key.upper()] = value
+    hdr['MAGZERO'] = magzp
+    return hdr
+
+
+def _write_image(fname, image, hdr, extname):
+    """
+    write an image in extension 1, as for the DES files
+    """
+    import fitsio
+
+    with fitsio.FITS(fname, 'rw', clobber=True) as fits:
+        fits.write(None)
+        fits.write(image, extname=extname, header=hdr)
+
+
+def _write_scamp_head(fname, wcs):
+    """
+    write the wcs as a scamp .head file, one card per line
+    """
+    with open(fname, 'w') as fobj:
+        for key, value in wcs.items():
+            if isinstance(value, str):
+                fobj.write("%-8s= '%s'\n" % (key.upper(), value))
+            else:
+                fobj.write("%-8s= %20r\n" % (key.upper(), float(value)))
+        fobj.write('END\n')
+
+
+def _write_lines(fname, lines):
+    print('writing:', fname)
+    with open(fname, 'w') as fobj:
+        for line in lines:
+            fobj.write(line)
+            fobj.write('\n')
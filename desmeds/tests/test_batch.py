@@ -0,0 +1,221 @@
+import os
+import glob
+import pytest
+
+from .. import batch
+
+TILESET = {
+    'medsconf': 'test',
+    'tile_ids': ['DES0000+0000', 'DES0001+0000', 'DES0002+0000'],
+    'bands': ['g', 'r'],
+}
+
+
+def test_pack_tile_bands():
+    hour = 3600.0
+    costs = [
+        ('a', 1*hour),
+        ('b', 30*hour),
+        ('c', 5*hour),
+        ('d', 4*hour),
+        ('e', 7*hour),
+        ('f', 13*hour),
+    ]
+    packs = batch.pack_tile_bands(
+        costs, 12*hour, cores_per_task=2, max_cores=4, parallel_fraction=1,
+    )
+
+    # each tile-band is in exactly one pack
+    ids = sorted(id for pack in packs for id in pack['jobs'])
+    assert ids == sorted(id for id, _ in costs)
+
+    # expensive ones get their own job with more cores, up to the max
+    big = dict((pack['jobs'][0], pack) for pack in packs
+               if pack['ncores'] > 2)
+    assert sorted(big) == ['b', 'f']
+    assert big['b']['ncores'] == 4
+    assert big['f']['ncores'] == 4
+    assert big['f']['wall_time_seconds'] == pytest.approx(6.5*hour)
+
+    # the small ones are packed within the target, longest first
+    small = [pack for pack in packs if pack['ncores'] == 2]
+    assert [pack['jobs'] for pack in small] == [['e', 'c'], ['d', 'a']]
+
+    times = [pack['wall_time_seconds'] for pack in packs]
+    assert times == sorted(times, reverse=True)
+
+    # with only part of the work in parallel, only that part is scaled
+    packs = batch.pack_tile_bands(
+        costs, 12*hour, cores_per_task=2, max_cores=4, parallel_fraction=0.5,
+    )
+    big = dict((pack['jobs'][0], pack) for pack in packs
+               if pack['ncores'] > 2)
+    assert big['f']['wall_time_seconds'] == pytest.approx(0.75*13*hour)
+
+    # serial work gets its own job, with no extra cores or time reduction
+    packs = batch.pack_tile_bands(
+        costs, 12*hour, cores_per_task=2, max_cores=4,
+    )
+    assert all(pack['ncores'] == 2 for pack in packs)
+    alone = dict((pack['jobs'][0], pack) for pack in packs
+                 if len(pack['jobs']) == 1)
+    assert alone['b']['wall_time_seconds'] == 30*hour
+    assert alone['f']['wall_time_seconds'] == 13*hour
+
+    with pytest.raises(ValueError):
+        batch.pack_tile_bands(costs, 0)
+
+    with pytest.raises(ValueError):
+        batch.pack_tile_bands(costs, 12*hour, parallel_fraction=1.5)
+
+
+def test_packed_generator(tmpdir, monkeypatch):
+    config_dir = tmpdir.join('config')
+    config_dir.mkdir()
+    config_dir.join('meds-test.yaml').write('medsconf: test\n')
+
+    monkeypatch.setenv('DESMEDS_CONFIG_DIR', str(config_dir))
+    monkeypatch.setenv('MEDS_DIR', str(tmpdir.join('meds')))
+    monkeypatch.setenv('TMPDIR', str(tmpdir.join('tmp')))
+
+    estimates = [
+        {'tilename': 'DES0000+0000', 'band': 'g',
+         'wall_time_seconds': 20*3600.0},
+        {'tilename': 'DES0000+0000', 'band': 'r',
+         'wall_time_seconds': 2*3600.0},
+        {'tilename': 'DES0001+0000', 'band': 'g',
+         'wall_time_seconds': 2*3600.0},
+    ]
+
+    generator = batch.PackedGenerator(
+        TILESET, estimates, target_hours=12, max_cores=8,
+    )
+    generator.write()
+
+    script_dir = str(tmpdir.join('meds', 'test', 'scripts'))
+    lsf_files = sorted(glob.glob(os.path.join(script_dir, 'pack*.lsf')))
+    scripts = glob.glob(os.path.join(script_dir, '*.sh'))
+    assert len(scripts) == 6
+
+    # the expensive one alone, the rest packed, using the median time
+    # of 2 hours for those with no estimate.  Making the file is serial,
+    # so the expensive one gets no extra cores and its full time
+    assert len(lsf_files) == 2
+    with open(lsf_files[0]) as fobj:
+        text = fobj.read()
+    assert '#BSUB -n 2' in text
+    assert '#BSUB -W 30:01' in text
+    assert 'DES0000+0000-g-make-meds.sh' in text
+
+    with open(lsf_files[1]) as fobj:
+        text = fobj.read()
+    assert '#BSUB -n 2' in text
+    assert text.count('make-meds.sh') == 5
+
+    # the wall time is never below the predicted serial time of the
+    # tile-bands in the job
+    serial_hours = {'DES0000+0000-g': 20, 'DES0000+0000-r': 2}
+    for lsf_file in lsf_files:
+        with open(lsf_file) as fobj:
+            text = fobj.read()
+        hours, minutes = text.split('#BSUB -W ')[1].split()[0].split(':')
+        walltime = int(hours) + int(minutes)/60.0
+
+        total = sum(
+            serial_hours.get(name, 2.0)
+            for name in ['DES%04d+0000-%s' % (i, b)
+                         for i in range(3) for b in 'gr']
+            if '%s-make-meds.sh' % name in text
+        )
+        assert walltime >= total
+
+    # only coadding runs in parallel
+    generator = batch.PackedGenerator(
+        TILESET, estimates, target_hours=12, max_cores=8,
+        parallel_fraction=0.5,
+    )
+    with pytest.raises(ValueError):
+        generator.write()
+
+
+def _setup_dirs(tmpdir, monkeypatch):
+    config_dir = tmpdir.join('config')
+    config_dir.mkdir()
+    config_dir.join('meds-test.yaml').write('medsconf: test\n')
+
+    monkeypatch.setenv('DESMEDS_CONFIG_DIR', str(config_dir))
+    monkeypatch.setenv('MEDS_DIR', str(tmpdir.join('meds')))
+    monkeypatch.setenv('TMPDIR', str(tmpdir.join('tmp')))
+
+
+def test_find_meds_files(tmpdir, monkeypatch):
+    from .. import files
+
+    _setup_dirs(tmpdir, monkeypatch)
+    assert files.find_meds_files('test') == set()
+
+    expected = set()
+    for tilename, band in [('DES0000+0000', 'g'), ('DES0001+0000', 'r')]:
+        fname = files.get_meds_file('test', tilename, band)
+        files.makedir_fromfile(fname)
+        open(fname, 'w').close()
+        expected.add((tilename, band))
+
+    # not meds files for this config
+    log_file = files.get_meds_log_file('test', 'DES0000+0000', 'r')
+    open(log_file, 'w').close()
+    other = files.get_meds_file('other', 'DES0000+0000', 'r')
+    files.makedir_fromfile(other)
+    open(other, 'w').close()
+
+    assert files.find_meds_files('test') == expected
+
+
+def test_array_generator(tmpdir, monkeypatch):
+    from .. import files
+
+    _setup_dirs(tmpdir, monkeypatch)
+
+    fname = files.get_meds_file('test', 'DES0001+0000', 'g')
+    files.makedir_fromfile(fname)
+    open(fname, 'w').close()
+
+    for missing in [False, True]:
+        generator = batch.ArrayGenerator(TILESET, missing=missing)
+        generator.write()
+
+        with open(generator['index_file']) as fobj:
+            lines = [line.split() for line in fobj]
+
+        njobs = 5 if missing else 6
+        assert len(lines) == njobs
+        assert [int(line[0]) for line in lines] == list(range(1, njobs+1))
+        assert (['DES0001+0000', 'g'] in [line[1:3] for line in lines]) == (
+            not missing
+        )
+
+        with open(generator['lsf_file']) as fobj:
+            text = fobj.read()
+        assert '#BSUB -J "meds-test[1-%d]"' % njobs in text
+        assert generator['index_file'] in text
+
+    script_dir = os.path.dirname(generator['lsf_file'])
+    assert len(os.listdir(script_dir)) == 5
+
+
+def test_array_generator_status(tmpdir, monkeypatch):
+    from .. import files
+    from .. import status
+
+    _setup_dirs(tmpdir, monkeypatch)
+
+    # the status database is used when it exists, rather than the files
+    db = status.StatusDB(files.get_status_file('test'))
+    db.add_jobs([('DES0002+0000', 'r')])
+    db.set_done('DES0002+0000', 'r')
+    db.close()
+
+    generator = batch.ArrayGenerator(TILESET, missing=True)
+    jobs = generator.get_jobs()
+    assert len(jobs) == 5
+    assert ('DES0002+0000', 'r') not in jobs
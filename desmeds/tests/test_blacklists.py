@@ -0,0 +1,84 @@
+import os
+import numpy as np
+
+from .. import blacklists
+
+BLACKLISTS = [
+    ('list1', 'list1.txt', 2**10),
+    ('list2', 'list2.txt', 2**11),
+    ('corrupted', 'corrupted.txt', blacklists.CORRUPTED_FLAG),
+]
+
+
+def _write_lists(tmpdir):
+    tmpdir.join('list1.txt').write('100 1\n200 2\n300 3\n')
+    tmpdir.join('list2.txt').write('200 2\n400 4\n')
+    tmpdir.join('corrupted.txt').write('500 5\n')
+
+
+def _make_srctable(expnums, ccds):
+    srctable = np.zeros(
+        len(expnums),
+        dtype=[('expname', 'U14'), ('ccd', 'i4'), ('flags', 'i4')],
+    )
+    srctable['expname'] = ['DECam_%08d' % e for e in expnums]
+    srctable['ccd'] = ccds
+    return blacklists.add_bigind(srctable)
+
+
+def test_engine(tmpdir):
+    _write_lists(tmpdir)
+    dir = str(tmpdir)
+    cache_file = str(tmpdir.join('cache', 'blacklists.npz'))
+
+    engine = blacklists.BlacklistEngine.load(
+        BLACKLISTS, dir=dir, cache_file=cache_file,
+    )
+    assert os.path.exists(cache_file)
+
+    bigind = blacklists.make_bigind(
+        np.array([100, 200, 400, 500, 600, 100]),
+        np.array([1, 2, 4, 5, 6, 2]),
+    )
+    flags = engine.get_flags(bigind)
+    assert flags.tolist() == [
+        2**10, 2**10 | 2**11, 2**11, blacklists.CORRUPTED_FLAG, 0, 0,
+    ]
+
+    # the cache is used, and gives the same result
+    cached = blacklists.BlacklistEngine.load(
+        BLACKLISTS, dir=dir, cache_file=cache_file,
+    )
+    assert np.array_equal(cached.bigind, engine.bigind)
+    assert np.array_equal(cached.get_flags(bigind), flags)
+    assert cached.names == engine.names
+
+    # a changed list invalidates the cache
+    tmpdir.join('list2.txt').write('600 6\n')
+    os.utime(str(tmpdir.join('list2.txt')), ns=(0, 10**9))
+    updated = blacklists.BlacklistEngine.load(
+        BLACKLISTS, dir=dir, cache_file=cache_file,
+    )
+    assert updated.get_flags(bigind).tolist() == [
+        2**10, 2**10, 0, blacklists.CORRUPTED_FLAG, 2**11, 0,
+    ]
+
+
+def test_flag_srctable(tmpdir):
+    _write_lists(tmpdir)
+    engine = blacklists.BlacklistEngine.from_files(BLACKLISTS, dir=str(tmpdir))
+
+    srctable = _make_srctable([100, 200, 500, 700], [1, 2, 5, 7])
+
+    srctable = blacklists.remove_corrupted(srctable, engine=engine)
+    assert srctable.size == 3
+    assert 500 + 5*10**7 not in srctable['bigind']
+
+    blacklists.add_blacklist_flags(srctable, engine=engine)
+    assert srctable['flags'].tolist() == [2**10, 2**10 | 2**11, 0]
+
+    # the same result as the dict based lists
+    d = blacklists.read_blacklist_as_dict(str(tmpdir.join('list1.txt')))
+    assert sorted(d) == sorted(
+        blacklists.make_bigind(np.array([100, 200, 300]), np.arange(1, 4))
+    )
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from ..boxsizes import (
+    get_max_pixels,
+    apply_pixel_budget,
+    make_report,
+)
+
+SIZES = [32, 48, 64, 96, 128, 192, 256]
+
+
+def test_get_max_pixels():
+    assert get_max_pixels({'max_pixels': 100}, 10) == 100
+    assert get_max_pixels({'max_coadd_pixels_per_object': 5}, 10) == 50
+    assert get_max_pixels(
+        {'max_pixels': 100, 'max_coadd_pixels_per_object': 5}, 10,
+    ) == 50
+
+    with pytest.raises(ValueError):
+        get_max_pixels({'max_pixels_per_object': 5}, 10)
+
+
+def test_apply_pixel_budget():
+    rng = np.random.RandomState(3115)
+    box_size = rng.choice(SIZES, size=1000)
+    priority = rng.uniform(size=box_size.size)
+
+    max_pixels = 0.5*(box_size**2).sum()
+    new_box_size = apply_pixel_budget(
+        box_size, SIZES, max_pixels, priority=priority,
+    )
+
+    assert (new_box_size**2).sum() <= max_pixels
+    assert np.all(new_box_size <= box_size)
+    assert np.all(np.isin(new_box_size, SIZES))
+
+    # the largest boxes are shrunk first
+    shrunk = new_box_size != box_size
+    assert box_size[shrunk].min() >= new_box_size[~shrunk].max()
+
+    report = make_report(
+        np.arange(box_size.size), priority, box_size, new_box_size,
+    )
+    assert report.size == shrunk.sum()
+
+
+def test_apply_pixel_budget_priority():
+    box_size = np.array([256, 256, 256, 32])
+    priority = np.array([3.0, 1.0, 2.0, 0.0])
+
+    max_pixels = (box_size**2).sum() - 1
+    new_box_size = apply_pixel_budget(
+        box_size, SIZES, max_pixels, priority=priority,
+    )
+
+    # only the lowest priority of the largest objects is shrunk
+    assert np.all(new_box_size == [256, 192, 256, 32])
+
+
+def test_apply_pixel_budget_unreachable():
+    box_size = np.array([64, 32])
+    new_box_size = apply_pixel_budget(box_size, SIZES, 1)
+    assert np.all(new_box_size == 32)
@@ -0,0 +1,409 @@
+import numpy as np
+import pytest
+
+meds = pytest.importorskip('meds')
+
+from ..coadd import DESMEDSCoadder, DESMEDSCoaddMaker  # noqa
+
+
+class FakePSF(object):
+    def __init__(self, size, nodraw=True):
+        self.size = size
+        self.nodraw = nodraw
+        self.ndraw = 0
+        self.nshape = 0
+
+    def get_rec_shape(self, row, col):
+        self.nshape += 1
+        return (self.size, self.size)
+
+    def get_rec(self, row, col):
+        if self.nodraw:
+            raise RuntimeError('the layout should not draw psfs')
+
+        self.ndraw += 1
+        return np.zeros(self.get_rec_shape(row, col)) + row + col
+
+    def get_center(self, row, col):
+        return np.array([row, col])
+
+
+class FakeMEDS(dict):
+    def __init__(self, obj_data, image_info):
+        self.update({n: obj_data[n] for n in obj_data.dtype.names})
+        self._image_info = image_info
+        self.size = obj_data.size
+        self._cat = obj_data
+
+    def get_image_info(self):
+        return self._image_info.copy()
+
+    def get_cat(self):
+        return self._cat.copy()
+
+
+def _make_inputs(rng, nobj=20, max_cutouts=4):
+    """
+    make a fake MEDS with a coadd and five single epoch files, and the
+    psf map for the single epoch files
+    """
+    paths = ['DES0000+0000_r.fits'] + [
+        'D%08d_r_c%02d_r1_immasked_nullwt.fits' % (1000+i, i+1)
+        for i in range(5)
+    ]
+    image_info = np.zeros(len(paths), dtype=[('image_path', 'U50')])
+    image_info['image_path'] = paths
+
+    psfmap = {
+        '%08d-%02d' % (1000+i, i+1): FakePSF(17 + 2*i) for i in range(5)
+    }
+
+    obj_data = np.zeros(
+        nobj,
+        dtype=[('id', 'i8'),
+               ('ncutout', 'i4'),
+               ('file_id', 'i4', max_cutouts)],
+    )
+    obj_data['id'] = 1000 + np.arange(nobj)
+    obj_data['ncutout'] = rng.randint(0, max_cutouts+1, size=nobj)
+    obj_data['file_id'] = -1
+    for i in range(nobj):
+        ncut = obj_data['ncutout'][i]
+        if ncut > 0:
+            obj_data['file_id'][i, 0] = 0
+            obj_data['file_id'][i, 1:ncut] = rng.randint(1, 6, size=ncut-1)
+
+    return FakeMEDS(obj_data, image_info), psfmap
+
+
+def _make_maker(m, psfmap, seed=3141):
+    coadder = DESMEDSCoadder.__new__(DESMEDSCoadder)
+    coadder.m = m
+    coadder.psfmap = psfmap
+    coadder.seed = seed
+    coadder.rng = np.random.RandomState(seed)
+
+    maker = DESMEDSCoaddMaker.__new__(DESMEDSCoaddMaker)
+    maker.m = m
+    maker.coadder = coadder
+    maker.tmpdir = None
+    return maker
+
+
+def _get_expected_psf_pixels(m, shapes, first, last):
+    """
+    the largest psf of the epochs for each object, summed, with the
+    padding added by the maker
+    """
+    expected = 0
+    for i in range(first, last+1):
+        ncut = m['ncutout'][i]
+        if ncut > 1:
+            fids = m['file_id'][i, 1:ncut]
+            expected += max(shapes[fid, 0]*shapes[fid, 1] for fid in fids)
+
+    return int(1.1*expected)
+
+
+def test_psf_layout():
+    rng = np.random.RandomState(8)
+
+    m, psfmap = _make_inputs(rng)
+    maker = _make_maker(m, psfmap)
+
+    shapes = maker.coadder.get_psf_shapes()
+    assert shapes.shape == (6, 2)
+    assert np.all(shapes[0] == 0)
+    assert np.all(shapes[1:, 0] == 17 + 2*np.arange(5))
+
+    maker._set_psf_layout()
+    assert maker.total_psf_pixels == _get_expected_psf_pixels(
+        m, shapes, 0, m.size-1,
+    )
+
+    # only the objects being written are counted
+    maker._obj_range = [5, 9]
+    maker._set_psf_layout()
+    assert maker.total_psf_pixels == _get_expected_psf_pixels(
+        m, shapes, 5, 9,
+    )
+
+
+def test_psf_shapes_range():
+    """
+    under an object range only the psfs of the files used by the objects
+    in the range are loaded
+    """
+    rng = np.random.RandomState(31)
+
+    m, psfmap = _make_inputs(rng)
+    maker = _make_maker(m, psfmap)
+
+    first, last = 2, 4
+    maker._obj_range = [first, last]
+    maker._set_psf_layout()
+
+    used = set()
+    for i in range(first, last+1):
+        used.update(m['file_id'][i, 1:m['ncutout'][i]])
+
+    keys = maker.coadder._get_file_psf_keys()
+    for file_id in range(1, len(keys)):
+        expected = 1 if file_id in used else 0
+        assert psfmap[keys[file_id]].nshape == expected
+
+    # the full layout computes the rest, once each
+    maker._obj_range = None
+    maker._set_psf_layout()
+    assert all(psf.nshape <= 1 for psf in psfmap.values())
+    assert maker.total_psf_pixels == _get_expected_psf_pixels(
+        m, maker.coadder.get_psf_shapes(), 0, m.size-1,
+    )
+
+
+class FakeColorPSF(FakePSF):
+    color_name = 'GI_COLOR'
+
+    def __init__(self, size):
+        super(FakeColorPSF, self).__init__(size, nodraw=False)
+        self.colors = []
+
+    def get_rec(self, row, col, color=None):
+        self.colors.append(color)
+        return super(FakeColorPSF, self).get_rec(row, col)
+
+
+def _get_coadd_psf_color(self, iobj):
+    """
+    stands in for MEDSCoadder.get_coadd, drawing the psf of the first
+    epoch as _get_psf_obs does
+    """
+    color = self._get_psf_color(1)
+    return self._get_psf_im_cached(1, 10, 20, color=color)
+
+
+def test_psf_color(monkeypatch):
+    monkeypatch.setattr(meds.MEDSCoadder, 'get_coadd', _get_coadd_psf_color)
+
+    paths = ['DES0000+0000_r.fits', 'D00001000_r_c01_r1_piff-model.fits']
+    image_info = np.zeros(len(paths), dtype=[('image_path', 'U50')])
+    image_info['image_path'] = paths
+
+    obj_data = np.zeros(3, dtype=[('ncutout', 'i4'), ('psf_color', 'f4')])
+    obj_data['psf_color'] = [0.5, 1.0, 1.5]
+
+    coadder = DESMEDSCoadder.__new__(DESMEDSCoadder)
+    coadder['psf'] = {'se': {'type': 'piff', 'use_color': True}}
+    coadder.m = FakeMEDS(obj_data, image_info)
+    coadder.seed = 5
+    coadder.rng = np.random.RandomState(5)
+
+    # the color is sent to color dependent models only, and the others
+    # are cached independent of color
+    for psf, expected, ndraw in [
+        (FakeColorPSF(17), [0.5, 1.0, 1.5], 3),
+        (FakePSF(17, nodraw=False), [], 1),
+    ]:
+        coadder.psfmap = {'00001000-01': psf}
+        coadder.__dict__.pop('_psf_cache', None)
+
+        for iobj in range(obj_data.size):
+            coadder.get_coadd(iobj)
+
+        assert getattr(psf, 'colors', []) == expected
+        assert psf.ndraw == ndraw
+
+    coadder._check_psf_type()
+    coadder['psf'] = {'type': 'psfex'}
+    coadder._check_psf_type()
+    coadder['psf'] = {'type': 'other'}
+    with pytest.raises(AssertionError):
+        coadder._check_psf_type()
+
+
+def test_psf_cache():
+    paths = ['DES0000+0000_r.fits', 'D00001000_r_c01_r1_immasked_nullwt.fits']
+    image_info = np.zeros(len(paths), dtype=[('image_path', 'U50')])
+    image_info['image_path'] = paths
+
+    psf = FakePSF(17, nodraw=False)
+
+    coadder = DESMEDSCoadder.__new__(DESMEDSCoadder)
+    coadder['psf_cache_size'] = 2
+    coadder.m = FakeMEDS(np.zeros(1, dtype=[('ncutout', 'i4')]), image_info)
+    coadder.psfmap = {'00001000-01': psf}
+
+    pim, pcen = coadder._get_psf_im_cached(1, 10, 20)
+    assert psf.ndraw == 1
+    assert np.all(pim == 30)
+
+    # cached copies are returned
+    pim[:, :] = 0
+    pim, pcen = coadder._get_psf_im_cached(1, 10, 20)
+    assert psf.ndraw == 1
+    assert np.all(pim == 30)
+
+    coadder._get_psf_im_cached(1, 11, 20)
+    coadder._get_psf_im_cached(1, 12, 20)
+    assert psf.ndraw == 3
+
+    # the least recently used was dropped
+    coadder._get_psf_im_cached(1, 10, 20)
+    assert psf.ndraw == 4
+
+
+def _fake_coadder_init(self, config, m, psfmap, seed, make_plots=False):
+    """
+    stands in for MEDSCoadder.__init__
+    """
+    self.update(config)
+    self.m = m
+    self.psfmap = psfmap
+    self.rng = np.random.RandomState(seed)
+
+
+def _fake_get_coadd(self, iobj):
+    """
+    stands in for MEDSCoadder.get_coadd, returning a noise image drawn
+    from the generator
+    """
+    return self.rng.normal(size=(4, 4))
+
+
+def _fake_maker_init(self, config, coadder):
+    """
+    stands in for MEDSCoaddMaker.__init__
+    """
+    self.update(config)
+    self.coadder = coadder
+    self.m = coadder.m
+    self.tmpdir = None
+
+
+def _fake_maker_write(self, fname, obj_range=None):
+    """
+    stands in for MEDSCoaddMaker.write, writing a coadd cutout and a psf
+    for each object in the range.  Like the MEDSMaker, the psf extension
+    is allocated with total_psf_pixels
+    """
+    import fitsio
+
+    first, last = self._get_first_last(obj_range)
+    shapes = self.coadder.get_psf_shapes()
+
+    obj_data = np.zeros(
+        last-first+1,
+        dtype=[('id', 'i8'), ('ncutout', 'i4'), ('box_size', 'i4'),
+               ('file_id', 'i4'), ('start_row', 'i8'),
+               ('psf_box_size', 'i4'), ('psf_start_row', 'i8')],
+    )
+    obj_data['id'] = self.m['id'][first:last+1]
+    obj_data['ncutout'] = 1
+    obj_data['box_size'] = 4
+    obj_data['start_row'] = 16*np.arange(obj_data.size)
+    obj_data['psf_start_row'] = -9999
+
+    psf = np.zeros(max(self.total_psf_pixels, 1), dtype='f4')
+    npsf = 0
+    for i, iobj in enumerate(range(first, last+1)):
+        ncut = self.m['ncutout'][iobj]
+        if ncut > 1:
+            size = shapes[self.m['file_id'][iobj, 1:ncut], 0].max()
+            obj_data['psf_box_size'][i] = size
+            obj_data['psf_start_row'][i] = npsf
+            psf[npsf:npsf+size**2] = iobj
+            npsf += size**2
+
+    assert npsf <= psf.size
+
+    image = np.concatenate([
+        self.coadder.get_coadd(iobj).ravel() for iobj in range(first, last+1)
+    ]).astype('f4')
+    with fitsio.FITS(fname, 'rw', clobber=True) as fits:
+        fits.write(obj_data, extname='object_data')
+        fits.write(image, extname='image_cutouts')
+        fits.write(psf, extname='psf')
+
+
+def test_chunked_psf(tmpdir, monkeypatch):
+    """
+    the merged psf extension of a chunked write holds the same psfs as a
+    single pass write, without the space allocated in each chunk
+    """
+    fitsio = pytest.importorskip('fitsio')
+    monkeypatch.setattr(meds.MEDSCoaddMaker, 'write', _fake_maker_write)
+    monkeypatch.setattr(meds.MEDSCoadder, 'get_coadd', _fake_get_coadd)
+
+    rng = np.random.RandomState(1771)
+    m, psfmap = _make_inputs(rng, nobj=23)
+    maker = _make_maker(m, psfmap)
+
+    single_file = str(tmpdir.join('single-meds.fits'))
+    maker.write(single_file)
+
+    chunked_file = str(tmpdir.join('chunked-meds.fits'))
+    maker.write(chunked_file, chunksize=5)
+
+    with fitsio.FITS(single_file) as fits:
+        single_data = fits['object_data'].read()
+        single_psf = fits['psf'].read()
+        single_image = fits['image_cutouts'].read()
+
+    with fitsio.FITS(chunked_file) as fits:
+        chunked_data = fits['object_data'].read()
+        chunked_psf = fits['psf'].read()
+        assert np.all(fits['image_cutouts'].read() == single_image)
+
+    for name in ['id', 'start_row', 'psf_box_size', 'psf_start_row']:
+        assert np.all(chunked_data[name] == single_data[name])
+
+    used = single_data['psf_box_size'] > 0
+    npsf = (single_data['psf_start_row'][used]
+            + single_data['psf_box_size'][used]**2).max()
+
+    assert chunked_psf.size == npsf
+    assert single_psf.size >= npsf
+    assert np.all(chunked_psf == single_psf[:npsf])
+
+
+def test_write_parallel(tmpdir, monkeypatch):
+    """
+    each object is coadded with its own seed, so the result does not
+    depend on the number of processes
+    """
+    from .. import coadd
+
+    fitsio = pytest.importorskip('fitsio')
+
+    rng = np.random.RandomState(2718)
+    m, psfmap = _make_inputs(rng, nobj=17)
+
+    monkeypatch.setattr(coadd.meds, 'MEDS', lambda fname: m)
+    monkeypatch.setattr(meds.MEDSCoadder, '__init__', _fake_coadder_init)
+    monkeypatch.setattr(meds.MEDSCoadder, 'get_coadd', _fake_get_coadd)
+    monkeypatch.setattr(meds.MEDSCoaddMaker, '__init__', _fake_maker_init)
+    monkeypatch.setattr(meds.MEDSCoaddMaker, 'write', _fake_maker_write)
+
+    data = {}
+    for nworkers in [1, 3]:
+        fname = str(tmpdir.join('coadd-%d.fits' % nworkers))
+        coadd.write_parallel(
+            {}, 'meds.fits', psfmap, 9901, fname, nworkers,
+            obj_range=[0, m.size-1],
+        )
+        with fitsio.FITS(fname) as fits:
+            data[nworkers] = (
+                fits['object_data'].read(),
+                fits['image_cutouts'].read(),
+                fits['psf'].read(),
+            )
+
+    obj_data1, image1, psf1 = data[1]
+    obj_data3, image3, psf3 = data[3]
+
+    assert np.all(obj_data3['id'] == m['id'])
+    for name in obj_data1.dtype.names:
+        assert np.all(obj_data3[name] == obj_data1[name])
+
+    assert np.all(image3 == image1)
+    assert np.all(psf3 == psf1)
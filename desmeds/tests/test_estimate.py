@@ -0,0 +1,235 @@
+import json
+import numpy as np
+import pytest
+
+fitsio = pytest.importorskip('fitsio')
+eu = pytest.importorskip('esutil')
+
+from .. import estimate  # noqa
+from .. import batch  # noqa
+from .. import maker  # noqa
+from .. import tuning  # noqa
+from ..defaults import default_config  # noqa
+
+NROW, NCOL = 100, 100
+SCALE = 0.263/3600
+
+# positions in the first image, zero offset.  The second image is shifted
+# by 50 columns, so these are in the first only, both, the second only
+# and neither
+ROWS = np.array([10.0, 10.0, 10.0, 10.0])
+COLS = np.array([10.0, 60.0, 120.0, 200.0])
+EXPECTED_NCUTOUT = np.array([2, 3, 2, 1])
+
+BOX_SIZE = np.array([32, 32, 48, 64])
+
+
+def _get_header(crpix1):
+    return {
+        'ctype1': 'RA---TAN',
+        'ctype2': 'DEC--TAN',
+        'crval1': 10.0,
+        'crval2': 0.0,
+        'crpix1': crpix1,
+        'crpix2': 50.0,
+        'cd1_1': -SCALE,
+        'cd1_2': 0.0,
+        'cd2_1': 0.0,
+        'cd2_2': SCALE,
+        'naxis1': NCOL,
+        'naxis2': NROW,
+    }
+
+
+def _make_srclist(tmpdir):
+    """
+    two single epoch images, the second with its wcs in the source list
+    rather than the image header
+    """
+    srclist = []
+    for i, crpix1 in enumerate([50.0, 0.0]):
+        fname = str(tmpdir.join('D%08d_r_c01_r1_immasked.fits' % i))
+        hdr = _get_header(crpix1)
+        with fitsio.FITS(fname, 'rw', clobber=True) as fits:
+            fits.write(np.zeros((NROW, NCOL), dtype='f4'))
+            fits.write(
+                np.zeros((NROW, NCOL), dtype='f4'),
+                header=hdr if i == 0 else None,
+            )
+
+        srclist.append({
+            'red_image': fname,
+            'wcs_header': None if i == 0 else hdr,
+        })
+
+    return srclist
+
+
+def _make_estimator(tmpdir):
+    est = estimate.MEDSCostEstimator.__new__(estimate.MEDSCostEstimator)
+    est.update(default_config)
+    est['psf'] = {'coadd': {'stamp_size': 31}, 'se': {}}
+    est._set_extra_config('none', 'r')
+    est.calibration = dict(estimate.DEFAULT_CALIBRATION)
+    est.file_dict = {
+        'tilename': 'DES0000+0000',
+        'band': 'r',
+        'meds_url': '/meds/DES0000+0000_r_meds.fits.fz',
+        'coadd_psf_url': '/data/DES0000+0000_r_psfcat.psf',
+    }
+
+    wcs = eu.wcsutil.WCS(_get_header(50.0))
+    ra, dec = wcs.image2sky(
+        COLS + est['position_offset'], ROWS + est['position_offset'],
+    )
+
+    srclist = _make_srclist(tmpdir)
+    est._get_box_sizes = lambda: BOX_SIZE
+    est._get_radec = lambda: (ra, dec)
+    est._load_source_image_info = lambda: srclist
+    return est
+
+
+def test_get_estimate(tmpdir):
+    est = _make_estimator(tmpdir).get_estimate()
+
+    ncutout = EXPECTED_NCUTOUT
+    image_pixels = int((BOX_SIZE**2*ncutout).sum())
+    psf_pixels = ncutout.size*31**2 + (ncutout-1).sum()*25**2
+
+    assert est['tilename'] == 'DES0000+0000'
+    assert est['band'] == 'r'
+    assert est['nobj'] == 4
+    assert est['nepoch'] == 2
+    assert est['ncutout'] == ncutout.sum()
+    assert est['max_cutouts'] == 3
+    assert est['image_pixels'] == image_pixels
+    assert est['psf_pixels'] == psf_pixels
+    assert est['se_image_bytes'] == NROW*NCOL*4*5
+    assert est['uncompressed_bytes'] == (
+        4*(4*image_pixels + psf_pixels)
+        + 4*3*estimate.BYTES_PER_OBJECT_EPOCH
+    )
+
+    cal = estimate.DEFAULT_CALIBRATION
+    assert est['wall_time_seconds'] == pytest.approx(
+        cal['seconds_base']
+        + cal['seconds_per_epoch']*2
+        + cal['seconds_per_cutout']*ncutout.sum()
+        + cal['seconds_per_mpix']*image_pixels/1.0e6
+    )
+    assert est['peak_memory_bytes'] == int(
+        cal['memory_base_bytes']
+        + cal['memory_per_epoch_bytes']*2
+        + est['se_image_bytes']
+    )
+    assert est['compressed_bytes'] == int(
+        cal['compression_ratio']*est['uncompressed_bytes']
+    )
+
+
+def test_get_radec(tmpdir, monkeypatch):
+    """
+    the positions are found as by the maker, with the wcs colors from the
+    coadd object map
+    """
+    est = estimate.MEDSCostEstimator.__new__(estimate.MEDSCostEstimator)
+    est.update(default_config)
+    est._set_extra_config('none', 'r')
+
+    fname = str(tmpdir.join('DES0000+0000_r.fits'))
+    with fitsio.FITS(fname, 'rw', clobber=True) as fits:
+        fits.write(np.zeros((NROW, NCOL), dtype='f4'))
+        fits.write(
+            np.zeros((NROW, NCOL), dtype='f4'), header=_get_header(50.0),
+        )
+    est.cf_refband = {'image_url': fname}
+
+    nobj = ROWS.size
+    est.coadd_cat = np.zeros(
+        nobj, dtype=[('number', 'i4'), ('x_image', 'f8'), ('y_image', 'f8')],
+    )
+    est.coadd_cat['number'] = np.arange(nobj) + 1
+    est.coadd_cat['x_image'] = COLS + est['position_offset']
+    est.coadd_cat['y_image'] = ROWS + est['position_offset']
+
+    # the object map is not in catalog order
+    iddata = np.zeros(nobj, dtype=[('object_number', 'i4'),
+                                   ('wcs_color', 'f4')])
+    iddata['object_number'] = est.coadd_cat['number'][::-1]
+    iddata['wcs_color'] = 0.5 + iddata['object_number']
+    est._get_coadd_objects_ids = lambda: iddata
+
+    # make_wcs_positions is from the meds package; the wcs positions are
+    # offset from the zero offset positions
+    def _make_wcs_positions(row, col, inverse=False):
+        offset = est['position_offset']
+        return {'wcs_row': row, 'wcs_col': col,
+                'zrow': row - offset, 'zcol': col - offset}
+
+    est._make_wcs_positions = _make_wcs_positions
+
+    colors = []
+
+    def _image2sky_func(wcs, x, y, color=None):
+        colors.append(color)
+        return wcs.image2sky(x, y)
+
+    monkeypatch.setattr(maker, '_image2sky_func', _image2sky_func)
+
+    ra, dec = est._get_radec()
+
+    wcs = eu.wcsutil.WCS(_get_header(50.0))
+    expected_ra, expected_dec = wcs.image2sky(
+        COLS + est['position_offset'], ROWS + est['position_offset'],
+    )
+    assert np.allclose(ra, expected_ra)
+    assert np.allclose(dec, expected_dec)
+
+    assert len(colors) == 1
+    assert np.all(colors[0] == 0.5 + est.coadd_cat['number'])
+
+
+def test_estimate_json(tmpdir):
+    """
+    the estimates written as JSON by desmeds-estimate are used by the
+    PackedGenerator and tune_job
+    """
+    est = _make_estimator(tmpdir).get_estimate()
+
+    fname = str(tmpdir.join('estimates.json'))
+    with open(fname, 'w') as fobj:
+        json.dump([est], fobj, indent=1)
+
+    with open(fname) as fobj:
+        estimates = json.load(fobj)
+
+    assert estimates == [est]
+
+    tileset = {
+        'medsconf': 'test',
+        'tile_ids': ['DES0000+0000', 'DES0001+0000'],
+        'bands': ['r'],
+    }
+    generator = batch.PackedGenerator(tileset, estimates)
+    generators = [
+        {'tilename': tilename, 'band': 'r'}
+        for tilename in tileset['tile_ids']
+    ]
+
+    # the tile-band with no estimate gets the median
+    costs = generator._get_costs(generators)
+    assert costs == [
+        (0, est['wall_time_seconds']), (1, est['wall_time_seconds']),
+    ]
+
+    choice = tuning.tune_job(
+        'test', 'DES0000+0000', 'r', ncores=8, estimates=estimates,
+        status_file=str(tmpdir.join('status.db')),
+        seconds_per_thread=20,
+    )
+    assert choice['cost_source'] == 'estimate'
+    assert choice['cost_seconds'] == est['wall_time_seconds']
+
+    # limited by the number of epochs in the estimate
+    assert choice['psf_load_threads'] == 2
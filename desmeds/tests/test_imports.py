@@ -0,0 +1,49 @@
+import sys
+import subprocess
+import pytest
+
+HEAVY_MODULES = ['galsim', 'meds', 'esutil', 'fitsio', 'piff', 'psfex']
+
+
+def _get_imported(code):
+    """
+    run the code in a new interpreter and get the heavy modules it
+    imported
+    """
+    code = code + (
+        '\nimport sys\n'
+        'print(" ".join(m for m in %r if m in sys.modules))\n'
+    ) % (HEAVY_MODULES,)
+
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return output.decode().split()
+
+
+@pytest.mark.parametrize('code', [
+    'import desmeds',
+    'import desmeds.files',
+    'import desmeds.batch',
+    'import desmeds.runner',
+    'import desmeds; desmeds.files.get_desdata',
+    'from desmeds import __version__',
+])
+def test_light_imports(code):
+    assert _get_imported(code) == []
+
+
+def test_maker_import_no_galsim():
+    imported = _get_imported('import desmeds.desdm_maker')
+    assert 'galsim' not in imported
+    assert 'meds' not in imported
+
+
+def test_lazy_attributes():
+    import desmeds
+
+    assert 'DESMEDSMakerDESDM' in dir(desmeds)
+    assert (
+        desmeds.DESMEDSMakerDESDM is desmeds.desdm_maker.DESMEDSMakerDESDM
+    )
+
+    with pytest.raises(AttributeError):
+        desmeds.not_an_attribute
@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+
+fitsio = pytest.importorskip('fitsio')
+pytest.importorskip('esutil')
+
+from ..defaults import default_config  # noqa
+from ..desdm_maker import DESMEDSMakerDESDM, SHARED_OBJ_DATA_FIELDS  # noqa
+
+NOBJ = 10
+
+CAT_NAMES = [
+    'number', 'flags', 'flux_auto', 'fluxerr_auto', 'x2_image',
+    'errx2_image', 'y2_image', 'erry2_image', 'isoarea_image',
+    'flux_radius', 'ra',
+]
+
+
+def _write_cat(tmpdir, band, rng):
+    """
+    a coadd catalog for the band, in random order and with upper case
+    names, as written by sextractor
+    """
+    cat = np.zeros(NOBJ, dtype=[(n.upper(), 'f8') for n in CAT_NAMES])
+    for name in cat.dtype.names:
+        cat[name] = rng.uniform(1, 100, size=NOBJ)
+
+    cat['NUMBER'] = rng.permutation(NOBJ) + 1
+    cat['FLAGS'] = rng.randint(0, 4, size=NOBJ)
+
+    fname = str(tmpdir.join('DES0000+0000_%s_cat.fits' % band))
+    fitsio.write(fname, cat, clobber=True)
+    return fname
+
+
+def _make_shared(rng):
+    """
+    the object data shared between bands, with an extra field that is
+    also in the catalogs
+    """
+    maker = DESMEDSMakerDESDM.__new__(DESMEDSMakerDESDM)
+    maker.update(default_config)
+    maker._set_extra_config('none', 'i')
+
+    dt = [('id', 'i8'), ('box_size', 'i4'), ('ra', 'f8'), ('dec', 'f8')]
+    dt += maker['extra_obj_data_fields'] + [('flux_radius', 'f4')]
+
+    obj_data = np.zeros(NOBJ, dtype=dt)
+    obj_data['number'] = np.arange(NOBJ) + 1
+    obj_data['id'] = 1000 + obj_data['number']
+    obj_data['box_size'] = rng.choice([32, 48, 64], size=NOBJ)
+    obj_data['ra'] = rng.uniform(size=NOBJ)
+    obj_data['dec'] = rng.uniform(size=NOBJ)
+    obj_data['wcs_color'] = 1.1
+
+    # the reference band values, which should not be used by other bands
+    for name in ['flags', 'flux', 'x2', 'iso_radius', 'flux_radius']:
+        obj_data[name] = -1
+
+    return {
+        'refband': 'i',
+        'obj_data': obj_data,
+        'idmap': None,
+        'box_size_report': None,
+    }
+
+
+def _make_band_maker(band, cat_file, shared, psf_color):
+    maker = DESMEDSMakerDESDM.__new__(DESMEDSMakerDESDM)
+    maker.update(default_config)
+    maker._set_extra_config('none', band)
+    maker.file_dict = {'band': band, 'coadd_cat_url': cat_file}
+    maker.shared = shared
+
+    def _get_coadd_objects_ids():
+        iddata = np.zeros(NOBJ, dtype=[('psf_color', 'f4')])
+        iddata['psf_color'] = psf_color
+        return iddata
+
+    maker._get_coadd_objects_ids = _get_coadd_objects_ids
+    return maker
+
+
+def test_build_object_data_from_shared(tmpdir):
+    rng = np.random.RandomState(9117)
+    shared = _make_shared(rng)
+
+    obj_data = {}
+    cats = {}
+    for band, psf_color in [('g', 1.5), ('r', 0.5)]:
+        cat_file = _write_cat(tmpdir, band, rng)
+        maker = _make_band_maker(band, cat_file, shared, psf_color)
+        maker._build_object_data_from_shared()
+
+        obj_data[band] = maker.obj_data
+
+        cat = fitsio.read(cat_file, lower=True)
+        cats[band] = cat[cat['number'].argsort()]
+
+        assert np.all(maker.obj_data['psf_color'] == psf_color)
+
+    for band in ['g', 'r']:
+        data, cat = obj_data[band], cats[band]
+
+        # the photometry is from the catalog for the band
+        assert np.all(data['flags'] == cat['flags'])
+        assert np.all(data['flux'] == cat['flux_auto'].astype('f4'))
+        assert np.all(data['x2'] == cat['x2_image'].astype('f4'))
+        assert np.allclose(
+            data['iso_radius'], np.sqrt(cat['isoarea_image']/np.pi),
+        )
+        assert np.all(data['flux_radius'] == cat['flux_radius'].astype('f4'))
+
+        # the ids, positions and box sizes are shared, even though
+        # the catalog has an ra column
+        for name in SHARED_OBJ_DATA_FIELDS:
+            assert np.all(data[name] == shared['obj_data'][name]), name
+
+    assert not np.all(obj_data['g']['flux'] == obj_data['r']['flux'])
+    assert not np.all(
+        obj_data['g']['flux_radius'] == obj_data['r']['flux_radius']
+    )
+
+    # the shared data are not modified
+    assert np.all(shared['obj_data']['flux'] == -1)
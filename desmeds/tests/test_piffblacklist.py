@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from .. import piffblacklist
+
+fitsio = pytest.importorskip('fitsio')
+pytest.importorskip('esutil')
+
+PIFF_RUN = 'y3a1-v29'
+
+
+def _write_summary(tmpdir, expnum, piff_flag):
+    info = np.zeros(4, dtype=[('ccdnum', 'i4'), ('fwhm', 'f8')])
+    info['ccdnum'] = [1, 2, 31, 62]
+    info['fwhm'] = 1.0
+
+    stars = np.zeros(len(piff_flag), dtype=[('ccdnum', 'i4'),
+                                            ('piff_flag', 'f8')])
+    stars['ccdnum'] = [1, 1, 2, 31, 62, 62][:len(piff_flag)]
+    stars['piff_flag'] = piff_flag
+
+    fname = tmpdir.join(
+        PIFF_RUN, '%d' % expnum, 'exp_psf_cat_%d.fits' % expnum,
+    )
+    fname.dirpath().ensure(dir=True)
+    with fitsio.FITS(str(fname), 'rw', clobber=True) as fits:
+        fits.write(info, extname='info')
+        fits.write(stars, extname='stars')
+
+
+def _setup(tmpdir, monkeypatch):
+    monkeypatch.setenv('PIFF_DATA_DIR', str(tmpdir))
+
+    _write_summary(tmpdir, 123456, [1, 1, 0, 1, 3, 2])
+    _write_summary(tmpdir, 234567, [0, np.nan, 0, 0, 0, 0])
+
+    list1 = tmpdir.join('list1.txt')
+    list1.write('00234567-02 bad  ghost\n\n00123456-31\n')
+    list2 = tmpdir.join('list2.txt')
+    list2.write('00234567-02 duplicate\n00123456-62 streak\n')
+    return [str(list1), str(list2)]
+
+
+def test_read_blacklists(tmpdir, monkeypatch):
+    fnames = _setup(tmpdir, monkeypatch)
+
+    blacklist = piffblacklist.read_blacklists(fnames)
+    assert blacklist['key'].tolist() == [
+        b'D00234567-02', b'D00123456-31', b'D00123456-62',
+    ]
+    assert blacklist['expnum'].tolist() == [234567, 123456, 123456]
+    assert blacklist['ccdnum'].tolist() == [2, 31, 62]
+    assert blacklist['comments'].tolist() == [b'bad ghost', b'', b'streak']
+
+
+def test_count_used_stars():
+    ccdnum = np.array([1, 2, 3, 100])
+    nstars_used = piffblacklist.count_used_stars(
+        [1, 1, 2, 3, 3], [1, 0, 1, 1, 3], ccdnum,
+    )
+    assert nstars_used.tolist() == [1, 1, 2, 0]
+
+    # a nan anywhere in the exposure means all stars are counted
+    nstars_used = piffblacklist.count_used_stars(
+        [1, 1, 2, 3, 3], [0, 0, np.nan, 0, 0], ccdnum,
+    )
+    assert nstars_used.tolist() == [2, 1, 2, 0]
+
+
+@pytest.mark.parametrize('nproc', [1, 2])
+def test_make_piff_blacklist(tmpdir, monkeypatch, nproc):
+    fnames = _setup(tmpdir, monkeypatch)
+    outfile = str(tmpdir.join('blacklist.fits'))
+
+    data = piffblacklist.make_piff_blacklist(
+        PIFF_RUN, fnames, outfile=outfile, nproc=nproc,
+    )
+
+    # exposures in the order they first appear in the lists
+    assert data['ccdnum'].tolist() == [1, 2, 31, 62]*2
+    assert data['nstars_used'].tolist() == [2, 1, 1, 2, 2, 0, 1, 1]
+
+    EYEBALL, CCD31 = piffblacklist.EYEBALL, piffblacklist.CCD31
+    assert data['bflags'].tolist() == [
+        0, EYEBALL, CCD31, 0,
+        0, 0, EYEBALL | CCD31, EYEBALL,
+    ]
+    assert data['comments'][1] == b'bad ghost'
+    assert data['comments'][7] == b'streak'
+
+    read_data = fitsio.read(outfile)
+    assert read_data['bflags'].tolist() == data['bflags'].tolist()
+
+
+def test_missing_entry(tmpdir, monkeypatch):
+    fnames = _setup(tmpdir, monkeypatch)
+    tmpdir.join('list3.txt').write('00123456-05\n')
+    fnames.append(str(tmpdir.join('list3.txt')))
+
+    with pytest.raises(ValueError):
+        piffblacklist.make_piff_blacklist(PIFF_RUN, fnames)
@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+import pytest
+
+from .. import desdm_maker
+from .. import files
+from .. import pipeline
+from .. import status
+
+TILESET = {
+    'medsconf': 'test',
+    'tile_ids': ['DES0000+0000', 'DES0001+0000', 'DES0002+0000'],
+    'bands': ['g', 'r'],
+}
+
+
+class Recorder(object):
+    """
+    records the stages run for each tile-band, and the number of
+    tile-bands prepared but not yet built or cleaned
+    """
+    def __init__(self, build_seconds=0.0, prep_fail=(), build_fail=(),
+                 no_output=()):
+        self.build_seconds = build_seconds
+        self.prep_fail = prep_fail
+        self.build_fail = build_fail
+        self.no_output = no_output
+
+        self.lock = threading.Lock()
+        self.events = []
+        self.nstaged = 0
+        self.max_staged = 0
+        self.nwaiting = 0
+        self.max_waiting = 0
+
+    def add(self, stage, tilename, band, dstaged=0, dwaiting=0):
+        with self.lock:
+            self.events.append((stage, tilename, band))
+            self.nstaged += dstaged
+            self.max_staged = max(self.max_staged, self.nstaged)
+            self.nwaiting += dwaiting
+            self.max_waiting = max(self.max_waiting, self.nwaiting)
+
+    def get_stages(self, tilename, band):
+        return [e[0] for e in self.events if e[1:] == (tilename, band)]
+
+
+def _setup(tmpdir, monkeypatch, recorder):
+    """
+    set up the config and replace the stages with ones that only record
+    what was run
+    """
+    config_dir = tmpdir.join('config')
+    config_dir.mkdir()
+    config_dir.join('meds-test.yaml').write('medsconf: test\n')
+    monkeypatch.setenv('DESMEDS_CONFIG_DIR', str(config_dir))
+
+    class FakePreparator(dict):
+        def __init__(self, config, tilename, band):
+            self['tilename'] = tilename
+            self['band'] = band
+
+        def go(self):
+            key = (self['tilename'], self['band'])
+            recorder.add('prep', *key, dstaged=1, dwaiting=1)
+            if key in recorder.prep_fail:
+                raise RuntimeError('prep failed for %s %s' % key)
+
+        def clean(self):
+            recorder.add('clean', self['tilename'], self['band'], dstaged=-1)
+
+    class FakeMaker(object):
+        def __init__(self, config, fileconf, tmpdir=None):
+            self.fileconf = fileconf
+
+        def go(self):
+            key = (self.fileconf['tilename'], self.fileconf['band'])
+            recorder.add('build', *key, dwaiting=-1)
+            time.sleep(recorder.build_seconds)
+            if key in recorder.build_fail:
+                raise RuntimeError('build failed for %s %s' % key)
+            if key in recorder.no_output:
+                return
+
+            with open(self.fileconf['meds_url'], 'w') as fobj:
+                fobj.write('meds')
+
+    def read_yaml(fname):
+        tilename, band = os.path.basename(fname).split('-')[0:2]
+        return {
+            'tilename': tilename,
+            'band': band,
+            'meds_url': str(tmpdir.join('%s-%s-meds.fits' % (tilename, band))),
+        }
+
+    monkeypatch.setattr(desdm_maker, 'Preparator', FakePreparator)
+    monkeypatch.setattr(desdm_maker, 'DESMEDSMakerDESDM', FakeMaker)
+    monkeypatch.setattr(
+        files, 'get_desdm_file_config',
+        lambda medsconf, tilename, band: '%s-%s-fileconf.yaml' % (
+            tilename, band,
+        ),
+    )
+    monkeypatch.setattr(files, 'read_yaml', read_yaml)
+
+
+def _make_pipeline(tmpdir, **kw):
+    return pipeline.TilesetPipeline(
+        TILESET,
+        scratch_dir=str(tmpdir),
+        status_file=str(tmpdir.join('status.db')),
+        poll_time=0.001,
+        **kw
+    )
+
+
+@pytest.mark.parametrize('queue_depth', [1, 2])
+def test_pipeline_queue_depth(tmpdir, monkeypatch, queue_depth):
+    """
+    with a slow build stage the preparation runs ahead, but only as far as
+    the queue and the staging slots allow
+    """
+    recorder = Recorder(build_seconds=0.05)
+    _setup(tmpdir, monkeypatch, recorder)
+
+    pipe = _make_pipeline(tmpdir, queue_depth=queue_depth)
+    assert pipe.max_staged == queue_depth + 2
+
+    res = pipe.go()
+
+    jobs = pipe.get_jobs()
+    assert res == {job: 'ok' for job in jobs}
+    for job in jobs:
+        assert recorder.get_stages(*job) == ['prep', 'build', 'clean']
+
+    assert recorder.nstaged == 0
+
+    # besides those in the queue, one may be waiting to be put on the
+    # queue and one just taken by the build stage
+    assert 1 < recorder.max_waiting <= queue_depth + 2
+    assert recorder.max_staged <= pipe.max_staged
+
+    db = status.StatusDB(str(tmpdir.join('status.db')))
+    try:
+        assert len(db.get_jobs(state=status.DONE)) == len(jobs)
+        row = db.get(*jobs[0])
+        meds_file = str(tmpdir.join('%s-%s-meds.fits' % jobs[0]))
+        assert row['meds_file'] == meds_file
+        assert row['file_bytes'] == 4
+    finally:
+        db.close()
+
+
+def test_pipeline_free_space(tmpdir, monkeypatch):
+    """
+    with too little free space, a tile-band is only prepared once the
+    others are cleaned up
+    """
+    recorder = Recorder()
+    _setup(tmpdir, monkeypatch, recorder)
+
+    ncheck = []
+
+    def get_free_gb(dir):
+        assert dir == str(tmpdir)
+        ncheck.append(1)
+        return 1.0
+
+    monkeypatch.setattr(pipeline, 'get_free_gb', get_free_gb)
+
+    pipe = _make_pipeline(tmpdir, queue_depth=2, min_free_gb=10.0)
+    res = pipe.go()
+
+    assert all(s == 'ok' for s in res.values())
+    assert len(ncheck) > 0
+    assert recorder.max_staged == 1
+
+    # each tile-band is done before the next is prepared
+    stages = [e[0] for e in recorder.events]
+    assert stages == ['prep', 'build', 'clean']*len(pipe.get_jobs())
+
+
+def test_pipeline_errors(tmpdir, monkeypatch):
+    """
+    errors in a stage are recorded for the tile-band, and the others are
+    still made
+    """
+    prep_bad = ('DES0000+0000', 'r')
+    build_bad = ('DES0001+0000', 'g')
+    no_output = ('DES0002+0000', 'r')
+    recorder = Recorder(
+        prep_fail=[prep_bad], build_fail=[build_bad], no_output=[no_output],
+    )
+    _setup(tmpdir, monkeypatch, recorder)
+
+    pipe = _make_pipeline(tmpdir)
+    res = pipe.go()
+
+    assert 'prep failed for DES0000+0000 r' in res[prep_bad]
+    assert 'build failed for DES0001+0000 g' in res[build_bad]
+    assert 'meds file was not written' in res[no_output]
+
+    jobs = pipe.get_jobs()
+    for job in jobs:
+        if job not in (prep_bad, build_bad, no_output):
+            assert res[job] == 'ok'
+
+    # failed tile-bands are still cleaned
+    assert recorder.get_stages(*prep_bad) == ['prep', 'clean']
+    assert recorder.get_stages(*build_bad) == ['prep', 'build', 'clean']
+    assert recorder.nstaged == 0
+
+    db = status.StatusDB(str(tmpdir.join('status.db')))
+    try:
+        failed = db.get_jobs(state=status.FAILED)
+        assert sorted((r['tilename'], r['band']) for r in failed) == sorted(
+            [prep_bad, build_bad, no_output]
+        )
+        assert 'build failed' in db.get(*build_bad)['error']
+        assert len(db.get_jobs(state=status.DONE)) == len(jobs) - 3
+    finally:
+        db.close()
@@ -0,0 +1,107 @@
+import pytest
+
+from ..util import PSFMap, load_psfmap
+
+
+class CountingPSFMap(PSFMap):
+    def __init__(self, *args, **kwargs):
+        self.nload = 0
+        super(CountingPSFMap, self).__init__(*args, **kwargs)
+
+    def _load_psf(self, key, path):
+        self.nload += 1
+        return {'key': key, 'path': path}
+
+
+def _write_psfmap(tmpdir):
+    fname = str(tmpdir.join('psfmap.dat'))
+    with open(fname, 'w') as fobj:
+        fobj.write('-9999 -9999 /data/DES0000+0000_r_psfcat.psf\n')
+        for i in range(1, 5):
+            fobj.write(
+                '00001000 %02d /data/D00001000_r_c%02d_r1_psfexcat.psf\n'
+                % (i, i)
+            )
+    return fname
+
+
+def test_psfmap_lazy(tmpdir):
+    fname = _write_psfmap(tmpdir)
+    psfmap = CountingPSFMap(fname, max_loaded=2)
+
+    assert len(psfmap) == 4
+    assert '00001000-01' in psfmap
+    assert '-9999--9999' not in psfmap
+    assert psfmap.nload == 0
+
+    psf = psfmap['00001000-01']
+    assert psf['path'] == '/data/D00001000_r_c01_r1_psfexcat.psf'
+    assert psfmap['00001000-01'] is psf
+    assert psfmap.nload == 1
+
+    psfmap['00001000-02']
+    psfmap['00001000-03']
+    assert psfmap.nload == 3
+    assert psfmap.get_nloaded() == 2
+
+    # the first was released
+    psfmap['00001000-01']
+    assert psfmap.nload == 4
+
+    assert psfmap.get('not-there') is None
+    with pytest.raises(KeyError):
+        psfmap['not-there']
+
+
+def test_psfmap_bad_type(tmpdir):
+    fname = str(tmpdir.join('psfmap.dat'))
+    with open(fname, 'w') as fobj:
+        fobj.write('00001000 01 /data/D00001000_r_c01_r1_other.fits\n')
+
+    psfmap = PSFMap(fname)
+    with pytest.raises(ValueError):
+        psfmap['00001000-01']
+
+
+class FakePIFFWrapper(object):
+    def __init__(self, path, ccdnum=None, stamp_size=None, color_name=None):
+        self.path = path
+        self.ccdnum = ccdnum
+        self.stamp_size = stamp_size
+        self.color_name = color_name
+
+
+def _write_piff_psfmap(tmpdir):
+    fname = str(tmpdir.join('piff-psfmap.dat'))
+    with open(fname, 'w') as fobj:
+        for band, ccd in [('r', 1), ('z', 2)]:
+            fobj.write(
+                '00001000 %02d /data/D00001000_%s_c%02d_r1_piff-model.fits\n'
+                % (ccd, band, ccd)
+            )
+    return fname
+
+
+@pytest.mark.parametrize('use_color', [True, False])
+def test_psfmap_piff_color(tmpdir, monkeypatch, use_color):
+    pytest.importorskip('esutil')
+    from .. import desdm_maker
+    monkeypatch.setattr(desdm_maker, 'PIFFWrapper', FakePIFFWrapper)
+
+    fname = _write_piff_psfmap(tmpdir)
+    config = {'psf': {'se': {'type': 'piff',
+                             'stamp_size': 33,
+                             'use_color': use_color}}}
+    psfmap = load_psfmap(fname, config=config)
+
+    rpsf = psfmap['00001000-01']
+    zpsf = psfmap['00001000-02']
+    assert rpsf.ccdnum == 1
+    assert rpsf.stamp_size == 33
+
+    if use_color:
+        assert rpsf.color_name == 'GI_COLOR'
+        assert zpsf.color_name == 'IZ_COLOR'
+    else:
+        assert rpsf.color_name is None
+        assert zpsf.color_name is None
@@ -0,0 +1,184 @@
+import os
+import sys
+import pytest
+
+from .. import runner
+from .. import status
+
+TILESET = {
+    'medsconf': 'test',
+    'tile_ids': ['DES0000+0000', 'DES0001+0000', 'DES0002+0000'],
+    'bands': ['g', 'r'],
+}
+
+
+def _get_runner(tmpdir, command, **kw):
+    return runner.LocalRunner(
+        dict(TILESET),
+        command=command,
+        ncores=2,
+        memory_gb=4.0,
+        status_file=str(tmpdir.join('status.db')),
+        log_dir=str(tmpdir.join('logs')),
+        tmpdir=str(tmpdir.join('tmp')),
+        backoff=0.0,
+        poll_time=0.01,
+        **kw
+    )
+
+
+def test_runner_noop(tmpdir):
+    # each job records its tile, band and threads
+    outdir = tmpdir.join('out')
+    outdir.mkdir()
+    command = (
+        'echo $OMP_NUM_THREADS > ' + str(outdir) + '/%(tilename)s-%(band)s'
+    )
+
+    run = _get_runner(tmpdir, command)
+    counts = run.go()
+    assert counts['done'] == 6
+    assert counts['failed'] == 0
+
+    for tilename, band in run.get_jobs():
+        fname = outdir.join('%s-%s' % (tilename, band))
+        assert fname.read().strip() == '1'
+
+    # all done, so nothing is run again
+    for f in outdir.listdir():
+        f.remove()
+    counts = _get_runner(tmpdir, command).go()
+    assert counts['done'] == 6
+    assert len(outdir.listdir()) == 0
+
+
+def test_runner_retry(tmpdir):
+    # fails on the first attempt for g band, succeeds on the second
+    command = (
+        'if [ %(band)s = r ] || [ -e ' + str(tmpdir) + '/%(tilename)s ]; '
+        'then exit 0; else touch ' + str(tmpdir) + '/%(tilename)s; '
+        'echo failing; exit 3; fi'
+    )
+    run = _get_runner(tmpdir, command, max_retries=1)
+    counts = run.go()
+    assert counts['done'] == 6
+
+    db = status.StatusDB(run.status_file)
+    for row in db.get_jobs():
+        expected = 2 if row['band'] == 'g' else 1
+        assert row['attempts'] == expected
+    db.close()
+
+
+def test_runner_failed(tmpdir):
+    command = 'echo bad %(tilename)s; exit 2'
+    run = _get_runner(tmpdir, command, max_retries=2)
+    counts = run.go()
+    assert counts['failed'] == 6
+
+    db = status.StatusDB(run.status_file)
+    for row in db.get_jobs():
+        assert row['attempts'] == 3
+        assert 'exit status 2' in row['error']
+        assert 'bad %s' % row['tilename'] in row['error']
+    db.close()
+
+    # the failed jobs are only run again if requested
+    counts = _get_runner(tmpdir, 'exit 0').go()
+    assert counts['failed'] == 6
+    counts = _get_runner(tmpdir, 'exit 0', retry_failed=True).go()
+    assert counts['done'] == 6
+
+
+def test_runner_resources(tmpdir):
+    # the jobs record the number running at the start, which must never
+    # exceed what fits in the cores and memory
+    lock_dir = tmpdir.join('running')
+    lock_dir.mkdir()
+    command = (
+        sys.executable + ' -c "import os, time; '
+        "d = '" + str(lock_dir) + "'; "
+        "f = os.path.join(d, '%(tilename)s-%(band)s'); "
+        "open(f, 'w').close(); "
+        "print(len(os.listdir(d))); "
+        'time.sleep(0.2); os.remove(f)"'
+    )
+
+    tileset = dict(TILESET)
+    tileset['resources'] = {
+        # needs all the memory, so runs alone
+        'DES0000+0000-g': {'memory_gb': 4.0},
+        # asks for more cores than the node has
+        'DES0001+0000': {'threads': 8},
+    }
+    run = runner.LocalRunner(
+        tileset,
+        command=command,
+        ncores=2,
+        memory_gb=4.0,
+        job_memory_gb=1.0,
+        status_file=str(tmpdir.join('status.db')),
+        log_dir=str(tmpdir.join('logs')),
+        tmpdir=str(tmpdir.join('tmp')),
+        poll_time=0.01,
+    )
+    assert run.get_resources('DES0001+0000', 'r')['threads'] == 2
+    assert run.get_resources('DES0002+0000', 'r') == {
+        'threads': 1, 'memory_gb': 1.0,
+    }
+
+    counts = run.go()
+    assert counts['done'] == 6
+
+    for tilename, band in run.get_jobs():
+        log_file = os.path.join(
+            run.log_dir, '%s-%s-test.log' % (tilename, band),
+        )
+        with open(log_file) as fobj:
+            nrunning = int(fobj.read())
+
+        if tilename == 'DES0001+0000' or (tilename, band) == (
+            'DES0000+0000', 'g',
+        ):
+            assert nrunning == 1
+        else:
+            assert nrunning <= 2
+
+
+def test_status_claim(tmpdir):
+    db = status.StatusDB(str(tmpdir.join('status.db')))
+    db.add_jobs([('DES0000+0000', 'g')])
+
+    assert db.claim('DES0000+0000', 'g', 'host1')
+    assert not db.claim('DES0000+0000', 'g', 'host2')
+    assert db.get('DES0000+0000', 'g')['host'] == 'host1'
+
+    with pytest.raises(ValueError):
+        db.get_jobs(state='bad')
+    db.close()
+
+
+def test_runner_other_jobs(tmpdir):
+    # jobs of another tileset sharing the database, pending or failed,
+    # are neither run nor counted
+    db = status.StatusDB(str(tmpdir.join('status.db')))
+    db.add_jobs([('DES0100+0000', 'g'), ('DES0101+0000', 'g')])
+    db.set_failed('DES0101+0000', 'g', 'exit status 1')
+    db.close()
+
+    outdir = tmpdir.join('out')
+    outdir.mkdir()
+    command = 'touch ' + str(outdir) + '/%(tilename)s-%(band)s'
+
+    run = _get_runner(tmpdir, command, retry_failed=True)
+    counts = run.go()
+    assert counts == {'pending': 0, 'running': 0, 'done': 6, 'failed': 0}
+    assert len(outdir.listdir()) == 6
+
+    db = status.StatusDB(run.status_file)
+    assert db.get('DES0100+0000', 'g')['state'] == status.PENDING
+    assert db.get('DES0101+0000', 'g')['state'] == status.FAILED
+    assert db.get_counts() == {
+        'pending': 1, 'running': 0, 'done': 6, 'failed': 1,
+    }
+    db.close()
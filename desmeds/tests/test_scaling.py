@@ -0,0 +1,202 @@
+"""
+scaling benchmarks for the stages of making a MEDS file, run on synthetic
+tiles
+
+These are slow and need pytest-benchmark, so they only run when
+DESMEDS_BENCHMARK is set.  Save the results as JSON to compare versions
+
+    DESMEDS_BENCHMARK=1 pytest desmeds/tests/test_scaling.py \\
+        --benchmark-autosave
+    pytest-benchmark compare
+
+The peak memory traced during each stage is recorded in the extra_info of
+each benchmark
+"""
+import os
+import shutil
+import tracemalloc
+import numpy as np
+import pytest
+
+if 'DESMEDS_BENCHMARK' not in os.environ:
+    pytest.skip(
+        'set DESMEDS_BENCHMARK to run the scaling benchmarks',
+        allow_module_level=True,
+    )
+
+pytest.importorskip('pytest_benchmark')
+
+from .. import synthetic  # noqa
+from .. import util  # noqa
+from ..benchmark import SyntheticMEDSMaker  # noqa
+from ..defaults import __version__  # noqa
+
+# object sigma ranges in pixels, giving different box size distributions
+BOX_SIZE_DISTS = {
+    'small': (0.8, 1.5),
+    'medium': (1.0, 4.0),
+    'large': (3.0, 12.0),
+}
+
+DEFAULT_NOBJ = 10000
+DEFAULT_NEPOCH = 10
+DEFAULT_BOX_SIZES = 'medium'
+
+NOBJS = [1000, 10000, 100000]
+NEPOCHS = [10, 100, 500]
+
+# smaller than DES ccds to limit the disk space used for 500 epochs
+SE_DIMS = (512, 256)
+
+# number of psf images drawn for each epoch
+NRENDER = 100
+
+ROUNDS = 3
+
+# tiles and makers are shared between benchmarks
+_MAKERS = {}
+
+
+@pytest.fixture(scope='module')
+def get_maker(tmp_path_factory):
+    """
+    get a maker for a synthetic tile, generating the tile the first time
+    """
+    def _get_maker(nobj, nepoch, box_sizes):
+        key = (nobj, nepoch, box_sizes)
+        if key not in _MAKERS:
+            dir = str(tmp_path_factory.mktemp(
+                'tile-%d-%d-%s' % key, numbered=True,
+            ))
+            fileconf = synthetic.make_tile(
+                dir,
+                nobj=nobj,
+                nepoch=nepoch,
+                se_dims=SE_DIMS,
+                sigma_range=BOX_SIZE_DISTS[box_sizes],
+                seed=nobj + nepoch,
+            )
+            medsconf = synthetic.get_medsconf()
+            _MAKERS[key] = SyntheticMEDSMaker(medsconf, fileconf)
+
+        return _MAKERS[key]
+
+    yield _get_maker
+
+    _MAKERS.clear()
+
+
+def _run(benchmark, maker, func, setup=None):
+    """
+    run the function once under tracemalloc to get the peak memory, then
+    run the benchmark
+    """
+    if setup is not None:
+        setup()
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    benchmark.extra_info.update({
+        'desmeds_version': __version__,
+        'nobj': int(maker.coadd_cat.size),
+        'nepoch': int(maker.image_info.size - 1),
+        'mean_box_size': float(maker.obj_data['box_size'].mean()),
+        'peak_traced_bytes': int(peak),
+    })
+
+    benchmark.pedantic(func, setup=setup, rounds=ROUNDS, iterations=1)
+
+
+def _sweep():
+    """
+    sweep each of number of objects, number of epochs and box size
+    distribution, keeping the others at their defaults
+    """
+    params = []
+    for nobj in NOBJS:
+        params.append((nobj, DEFAULT_NEPOCH, DEFAULT_BOX_SIZES))
+    for nepoch in NEPOCHS:
+        params.append((DEFAULT_NOBJ, nepoch, DEFAULT_BOX_SIZES))
+    for box_sizes in BOX_SIZE_DISTS:
+        params.append((DEFAULT_NOBJ, DEFAULT_NEPOCH, box_sizes))
+
+    # the defaults appear in all three sweeps
+    return sorted(set(params), key=params.index)
+
+
+SWEEP = _sweep()
+
+
+@pytest.mark.parametrize('nobj,nepoch,box_sizes', SWEEP)
+def test_build_object_data(benchmark, get_maker, nobj, nepoch, box_sizes):
+    benchmark.group = 'build_object_data'
+    maker = get_maker(nobj, nepoch, box_sizes)
+    _run(benchmark, maker, maker._build_object_data)
+
+
+@pytest.mark.parametrize('nobj,nepoch,box_sizes', SWEEP)
+def test_build_image_data(benchmark, get_maker, nobj, nepoch, box_sizes):
+    benchmark.group = 'build_image_data'
+    maker = get_maker(nobj, nepoch, box_sizes)
+    _run(benchmark, maker, maker._build_image_data)
+
+
+@pytest.mark.parametrize('nobj,nepoch,box_sizes', SWEEP)
+def test_load_psf_data(benchmark, get_maker, nobj, nepoch, box_sizes):
+    benchmark.group = 'load_psf_data'
+    maker = get_maker(nobj, nepoch, box_sizes)
+
+    def func():
+        maker._load_psf_data(maker.psf_files)
+
+    _run(benchmark, maker, func)
+
+
+@pytest.mark.parametrize('nobj,nepoch,box_sizes', SWEEP)
+def test_psf_rendering(benchmark, get_maker, nobj, nepoch, box_sizes):
+    benchmark.group = 'psf_rendering'
+    maker = get_maker(nobj, nepoch, box_sizes)
+
+    rng = np.random.RandomState(nepoch)
+    rows = rng.uniform(low=0, high=SE_DIMS[0], size=NRENDER)
+    cols = rng.uniform(low=0, high=SE_DIMS[1], size=NRENDER)
+    colors = maker.obj_data['psf_color'][:NRENDER]
+
+    def func():
+        for psf in maker.psf_data:
+            for row, col, color in zip(rows, cols, colors):
+                psf.get_rec(row, col, color=color)
+                psf.get_center(row, col)
+
+    _run(benchmark, maker, func)
+
+
+@pytest.mark.skipif(
+    shutil.which('fpack') is None,
+    reason='fpack is needed for the compression benchmark',
+)
+@pytest.mark.parametrize('nobj,nepoch,box_sizes', SWEEP)
+def test_compression(benchmark, get_maker, nobj, nepoch, box_sizes):
+    benchmark.group = 'compression'
+    maker = get_maker(nobj, nepoch, box_sizes)
+
+    fname = maker.file_dict['meds_url']
+    if not os.path.exists(fname):
+        maker.go()
+
+    fzname = fname + '.fz'
+
+    def setup():
+        if os.path.exists(fzname):
+            os.remove(fzname)
+
+    def func():
+        util.fpack_file(fname, fpack_kwargs=maker.get('fpack_kwargs', ''))
+
+    _run(benchmark, maker, func, setup=setup)
+
+    benchmark.extra_info['uncompressed_bytes'] = os.path.getsize(fname)
+    benchmark.extra_info['compressed_bytes'] = os.path.getsize(fzname)
@@ -0,0 +1,236 @@
+import os
+import numpy as np
+import pytest
+
+from ..shards import (
+    get_shard_ranges,
+    get_chunk_ranges,
+    get_shard_file,
+    merge_meds_files,
+)
+from ..checkpoint import ChunkCheckpoint
+
+fitsio = pytest.importorskip('fitsio')
+
+
+def _make_shard(fname, rng, nobj, max_cutouts, psf_size=5, empty=False,
+                psf_pad=0):
+    """
+    write a file with the MEDS layout, holding the object number in
+    all pixels of each cutout.  If empty is True, no object has cutouts.
+    psf_pad unused pixels are added to the end of the psf extension
+    """
+    dt = [
+        ('number', 'i8'),
+        ('ncutout', 'i4'),
+        ('box_size', 'i4'),
+        ('file_id', 'i4', max_cutouts),
+        ('start_row', 'i8', max_cutouts),
+        ('psf_box_size', 'i4', max_cutouts),
+        ('psf_start_row', 'i8', max_cutouts),
+    ]
+    obj_data = np.zeros(nobj, dtype=dt)
+    obj_data['number'] = rng.randint(0, 2**30, size=nobj)
+    obj_data['ncutout'] = rng.randint(0, max_cutouts+1, size=nobj)
+    obj_data['ncutout'][0] = max_cutouts
+    if empty:
+        obj_data['ncutout'] = 0
+    obj_data['box_size'] = rng.choice([2, 3, 4], size=nobj)
+    obj_data['file_id'] = -9999
+    obj_data['start_row'] = -9999
+    obj_data['psf_start_row'] = -9999
+
+    image = []
+    psf = []
+    npix = 0
+    npsf = 0
+    for i in range(nobj):
+        bs = obj_data['box_size'][i]
+        for icut in range(obj_data['ncutout'][i]):
+            obj_data['file_id'][i, icut] = icut
+            obj_data['start_row'][i, icut] = npix
+            obj_data['psf_box_size'][i, icut] = psf_size
+            obj_data['psf_start_row'][i, icut] = npsf
+
+            image.append(np.zeros(bs*bs, dtype='f4') + obj_data['number'][i])
+            psf.append(np.zeros(psf_size**2, dtype='f4') + icut)
+            npix += bs*bs
+            npsf += psf_size**2
+
+    if empty:
+        # like the maker, as fitsio cannot write an empty image
+        image = [np.zeros(1, dtype='f4')]
+        psf = [np.zeros(1, dtype='f4')]
+
+    psf.append(np.zeros(psf_pad, dtype='f4') - 1)
+
+    image_info = np.zeros(3, dtype=[('image_path', 'S10')])
+    image_info['image_path'] = 'blah'
+
+    with fitsio.FITS(fname, 'rw', clobber=True) as fits:
+        fits.write(obj_data, extname='object_data')
+        fits.write(image_info, extname='image_info')
+        fits.write(np.concatenate(image), extname='image_cutouts')
+        fits.write(np.concatenate(psf), extname='psf')
+
+    return obj_data
+
+
+def _check_cutouts(fname, ext, size_name, start_name):
+    with fitsio.FITS(fname) as fits:
+        obj_data = fits['object_data'].read()
+        cutouts = fits[ext].read()
+
+    for i in range(obj_data.size):
+        for icut in range(obj_data['ncutout'][i]):
+            if size_name == 'box_size':
+                npix = obj_data[size_name][i]**2
+            else:
+                npix = obj_data[size_name][i, icut]**2
+
+            start = obj_data[start_name][i, icut]
+            data = cutouts[start:start+npix]
+            if ext == 'psf':
+                assert np.all(data == icut)
+            else:
+                assert np.all(data == obj_data['number'][i])
+
+
+def test_get_shard_ranges():
+    ranges = get_shard_ranges(10, 3)
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == 10
+    for i in range(1, len(ranges)):
+        assert ranges[i][0] == ranges[i-1][1]
+
+    assert len(get_shard_ranges(2, 5)) == 2
+
+
+def test_get_chunk_ranges():
+    ranges = get_chunk_ranges(10, 3)
+    assert ranges == [(0, 3), (3, 6), (6, 9), (9, 10)]
+
+
+def test_get_shard_file():
+    fname = get_shard_file('/a/DES0000+0000_r_meds-y6.fits.fz', 3)
+    assert fname == '/a/DES0000+0000_r_meds-y6-shard003.fits'
+
+
+def test_merge_meds_files(tmpdir):
+    rng = np.random.RandomState(8812)
+
+    shard_files = []
+    obj_list = []
+    for ishard, max_cutouts in enumerate([3, 5, 2]):
+        fname = os.path.join(str(tmpdir), 'shard%d.fits' % ishard)
+        obj_list.append(_make_shard(fname, rng, 7, max_cutouts))
+        shard_files.append(fname)
+
+    output = os.path.join(str(tmpdir), 'merged.fits')
+    merge_meds_files(shard_files, output)
+
+    obj_data = fitsio.read(output, ext='object_data')
+    assert obj_data.size == 21
+    assert obj_data['file_id'].shape[1] == 5
+
+    numbers = np.concatenate([o['number'] for o in obj_list])
+    assert np.all(obj_data['number'] == numbers)
+
+    # unused entries are padded with the same fill value
+    w = np.where(obj_data['ncutout'] < 5)
+    assert np.all(obj_data['start_row'][w[0], -1] == -9999)
+
+    image_info = fitsio.read(output, ext='image_info')
+    assert image_info.size == 3
+
+    _check_cutouts(output, 'image_cutouts', 'box_size', 'start_row')
+    _check_cutouts(output, 'psf', 'psf_box_size', 'psf_start_row')
+
+
+def test_merge_empty_shard(tmpdir):
+    """
+    a shard with no cutouts still has a one pixel image, which must not
+    shift the cutouts of the later shards
+    """
+    rng = np.random.RandomState(311)
+
+    shard_files = []
+    for ishard, empty in enumerate([False, True, False]):
+        fname = os.path.join(str(tmpdir), 'shard%d.fits' % ishard)
+        _make_shard(fname, rng, 4, 3, empty=empty)
+        shard_files.append(fname)
+
+    output = os.path.join(str(tmpdir), 'merged.fits')
+    merge_meds_files(shard_files, output)
+
+    with fitsio.FITS(output) as fits:
+        obj_data = fits['object_data'].read()
+        npix = fits['image_cutouts'].get_dims()[0]
+
+    box_size = obj_data['box_size'].astype('i8')
+    assert npix == (box_size**2 * obj_data['ncutout']).sum()
+
+    _check_cutouts(output, 'image_cutouts', 'box_size', 'start_row')
+    _check_cutouts(output, 'psf', 'psf_box_size', 'psf_start_row')
+
+
+def test_merge_padded_psf(tmpdir):
+    """
+    the psf extensions can be allocated larger than needed; only the used
+    pixels are kept in the merge
+    """
+    rng = np.random.RandomState(9931)
+
+    shard_files = []
+    npsf = 0
+    for ishard in range(3):
+        fname = os.path.join(str(tmpdir), 'shard%d.fits' % ishard)
+        obj_data = _make_shard(fname, rng, 5, 3, psf_pad=100)
+        npsf += 25*obj_data['ncutout'].sum()
+        shard_files.append(fname)
+
+    output = os.path.join(str(tmpdir), 'merged.fits')
+    merge_meds_files(shard_files, output)
+
+    with fitsio.FITS(output) as fits:
+        psf = fits['psf'].read()
+
+    assert psf.size == npsf
+    assert np.all(psf >= 0)
+    _check_cutouts(output, 'psf', 'psf_box_size', 'psf_start_row')
+
+
+def test_checkpoint(tmpdir):
+    rng = np.random.RandomState(5512)
+
+    fname = os.path.join(str(tmpdir), 'test-meds.fits')
+    ids = np.arange(21)
+
+    ckpt = ChunkCheckpoint(fname, ids, 7)
+    assert len(ckpt.get_todo()) == 3
+
+    for ichunk, (start, end), chunk_file in ckpt.get_todo()[:2]:
+        _make_shard(chunk_file, rng, end-start, 3)
+        ckpt.set_completed(ichunk)
+
+    # resuming skips the completed chunks
+    ckpt = ChunkCheckpoint(fname, ids, 7)
+    assert [todo[0] for todo in ckpt.get_todo()] == [2]
+
+    # a missing chunk file is written again
+    os.remove(ckpt.chunk_files[1])
+    ckpt = ChunkCheckpoint(fname, ids, 7)
+    assert [todo[0] for todo in ckpt.get_todo()] == [1, 2]
+
+    for ichunk, (start, end), chunk_file in ckpt.get_todo():
+        _make_shard(chunk_file, rng, end-start, 3)
+        ckpt.set_completed(ichunk)
+
+    output = os.path.join(str(tmpdir), 'merged.fits')
+    ckpt.merge(output)
+    assert fitsio.read(output, ext='object_data').size == 21
+
+    # a checkpoint for different objects is discarded
+    ckpt = ChunkCheckpoint(fname, ids + 1, 7)
+    assert len(ckpt.get_todo()) == 3
+    assert not os.path.exists(ckpt.chunk_files[0])
@@ -0,0 +1,306 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('fitsio')
+pytest.importorskip('esutil')
+
+from .. import srctable  # noqa
+from ..coaddsrc import CoaddSrc  # noqa
+from ..defaults import default_config  # noqa
+from ..desdm_maker import DESMEDSMakerDESDM  # noqa
+from ..maker import DESMEDSMaker  # noqa
+
+DESDATA = '/data/des'
+
+SE_TYPES = ['image', 'weight', 'bmask', 'bkg', 'seg']
+
+
+def _make_srclist(nsrc=5):
+    """
+    a source table as returned by _get_srclist; some paths are under
+    DESDATA and some are not
+    """
+    paths = []
+    for i in range(nsrc):
+        if i % 2 == 0:
+            front = '%s/OPS/finalcut/r%d' % (DESDATA, i)
+        else:
+            front = '/other/r%d' % i
+        paths.append('%s/D%08d_r_c%02d_immasked.fits.fz' % (front, i, i+1))
+
+    paths = np.array(paths)
+    return srctable.make_src_table({
+        'id': np.arange(nsrc) + 10,
+        'flags': np.arange(nsrc, dtype='i4') % 3,
+        'red_image': paths,
+        'red_bkg': np.char.replace(paths, 'immasked', 'bkg'),
+        'red_seg': np.char.replace(paths, 'immasked', 'segmap'),
+        'magzp': 30.0 + 0.1*np.arange(nsrc),
+    })
+
+
+def _make_maker(cls, srclist):
+    """
+    a maker with the config and coadd info needed by _build_image_data,
+    taking the sources from srclist
+    """
+    maker = cls.__new__(cls)
+    maker.update(default_config)
+    maker.DESDATA = DESDATA
+    maker.cf = {
+        'image_url': DESDATA + '/coadd/DES0000+0000_r.fits.fz',
+        'seg_url': DESDATA + '/coadd/DES0000+0000_r_segmap.fits',
+        'image_id': 3,
+        'magzp': 30.0,
+    }
+
+    wcs_json = np.array(['{"n": %d}' % i for i in range(srclist.size+1)])
+
+    maker._get_srclist = lambda: srclist
+    maker._get_wcs_json = lambda srclist: wcs_json
+    maker._get_image_info_struct = (
+        lambda srclist, wcs_json: _get_image_info_struct(
+            maker, srclist, wcs_json,
+        )
+    )
+    return maker
+
+
+def _get_image_info_struct(maker, srclist, wcs_json):
+    """
+    like meds.util.get_image_info_struct, with the path length from the
+    maker
+    """
+    slen = maker._get_path_dtype_len(srclist)
+    dt = [
+        ('image_id', 'i8'),
+        ('image_flags', 'i8'),
+        ('magzp', 'f4'),
+        ('scale', 'f4'),
+        ('position_offset', 'f8'),
+        ('wcs', 'U%d' % max(len(w) for w in wcs_json)),
+    ]
+    for type in SE_TYPES:
+        dt += [('%s_path' % type, 'U%d' % slen), ('%s_ext' % type, 'U10')]
+
+    return np.zeros(srclist.size+1, dtype=dt)
+
+
+def _build_se_image_data_rowwise(maker, srclist, wcs_json, image_info):
+    """
+    the single epoch rows as filled by the original, row by row,
+    _build_image_data
+    """
+    image_info = image_info.copy()
+
+    ind = 1
+    for s in srclist:
+        impath = maker._get_portable_url(s, 'red_image')
+        skypath = maker._get_portable_url(s, 'red_bkg')
+        segpath = maker._get_portable_url(s, 'red_seg')
+
+        image_info['image_id'][ind] = s['id']
+        image_info['image_flags'][ind] = s['flags']
+
+        image_info['image_path'][ind] = impath
+        image_info['image_ext'][ind] = maker['se_image_ext']
+
+        image_info['weight_path'][ind] = impath
+        image_info['weight_ext'][ind] = maker['se_weight_ext']
+
+        image_info['bmask_path'][ind] = impath
+        image_info['bmask_ext'][ind] = maker['se_bmask_ext']
+
+        image_info['bkg_path'][ind] = skypath
+        image_info['bkg_ext'][ind] = maker['se_bkg_ext']
+        image_info['seg_path'][ind] = segpath
+        image_info['seg_ext'][ind] = maker['se_seg_ext']
+
+        image_info['wcs'][ind] = wcs_json[ind]
+        image_info['magzp'][ind] = s['magzp']
+        image_info['scale'][ind] = maker._get_scale(s['magzp'])
+        ind += 1
+
+    return image_info
+
+
+def test_make_src_table():
+    table = srctable.make_src_table({
+        'id': np.arange(3),
+        'path': np.array(['a', 'bb', 'ccc']),
+    })
+    assert table.dtype.names == ('id', 'path')
+    assert table['path'].tolist() == ['a', 'bb', 'ccc']
+
+    with pytest.raises(ValueError):
+        srctable.make_src_table({})
+
+    with pytest.raises(ValueError):
+        srctable.make_src_table({'id': np.arange(3), 'x': np.zeros(2)})
+
+
+def test_add_columns():
+    table = srctable.make_src_table({
+        'id': np.arange(3),
+        'flags': np.zeros(3, dtype='i4'),
+    })
+    new_table = srctable.add_columns(table, {
+        'flags': np.ones(3, dtype='i2'),
+        'path': np.array(['a', 'b', 'c']),
+    })
+
+    assert new_table.dtype.names == ('id', 'flags', 'path')
+    assert new_table['flags'].dtype == np.dtype('i2')
+    assert np.all(new_table['flags'] == 1)
+    assert np.all(new_table['id'] == table['id'])
+
+    # the original is not modified
+    assert np.all(table['flags'] == 0)
+
+
+def test_srclist_round_trip():
+    srclist = [
+        {'id': i,
+         'expname': 'D%08d' % i,
+         'filename': b'D%08d_r.fits' % i,
+         'magzp': 30.0 + i,
+         'used': i % 2 == 0,
+         'wcs_header': None if i == 1 else {'crpix1': float(i)}}
+        for i in range(4)
+    ]
+
+    table = srctable.srclist_to_table(srclist)
+    assert table['id'].dtype == np.dtype('i8')
+    assert table['magzp'].dtype == np.dtype('f8')
+    assert table['used'].dtype == np.dtype(bool)
+    assert table['expname'].dtype.kind == 'U'
+    assert table['wcs_header'].dtype == np.dtype(object)
+
+    # bytes are converted to strings
+    expected = [dict(src, filename=src['filename'].decode('utf-8'))
+                for src in srclist]
+    assert srctable.table_to_srclist(table) == expected
+
+    table = srctable.srclist_to_table(srclist, names=['id', 'magzp'])
+    assert table.dtype.names == ('id', 'magzp')
+
+    with pytest.raises(ValueError):
+        srctable.srclist_to_table([])
+
+
+def test_path_helpers():
+    paths = np.array([
+        '/a/b/D00502664_r_c36_r2378p01_immasked.fits.fz',
+        'D00502665_z_c01_r2378p01_immasked.fits',
+    ])
+
+    assert srctable.basenames(paths).tolist() == [
+        os.path.basename(p) for p in paths
+    ]
+    assert srctable.get_filenames_as_ids(paths).tolist() == [
+        'D00502664_r_c36_r2378p01_immasked.fits',
+        'D00502665_z_c01_r2378p01_immasked.fits',
+    ]
+
+    expstr, bandstr, ccdstr = srctable.get_exp_band_ccd(paths)
+    assert expstr.tolist() == ['D00502664', 'D00502665']
+    assert bandstr.tolist() == ['r', 'z']
+    assert ccdstr.tolist() == ['c36', 'c01']
+
+
+@pytest.mark.parametrize('piff_campaign', ['Y6A1_PIFF', None])
+def test_add_full_paths(piff_campaign):
+    src = CoaddSrc.__new__(CoaddSrc)
+    src['source_dir'] = '/meds/sources-r'
+    src['piff_campaign'] = piff_campaign
+
+    nsrc = 6
+    table = srctable.make_src_table({
+        'filename': np.array([
+            'D%08d_r_c%02d_r1p01_immasked.fits' % (i, i) for i in range(nsrc)
+        ]),
+        'compression': np.array(['.fz', ''] * (nsrc//2)),
+        'path': np.array([
+            'OPS/finalcut/Y6A1/r%d/D%08d/p01/red/immask' % (i % 2, i)
+            for i in range(nsrc)
+        ]),
+        'piff_path': np.array([
+            'OPS/finalcut/Y6A1_PIFF/r1/D%08d/p01/psf/D%08d_piff.fits' % (i, i)
+            for i in range(nsrc)
+        ]),
+    })
+
+    new_table = src._add_full_paths(table)
+
+    # the original row by row version
+    for i, info in enumerate(srctable.table_to_srclist(table)):
+        dirdict = src._get_all_dirs(info)
+
+        expected = {
+            'image_path': os.path.join(
+                dirdict['image']['local_dir'],
+                info['filename']+info['compression'],
+            ),
+            'bkg_path': os.path.join(
+                dirdict['bkg']['local_dir'],
+                info['filename'].replace('immasked.fits', 'bkg.fits')
+                + info['compression'],
+            ),
+            'seg_path': os.path.join(
+                dirdict['seg']['local_dir'],
+                info['filename'].replace('immasked.fits', 'segmap.fits')
+                + info['compression'],
+            ),
+            'psf_path': os.path.join(
+                dirdict['psf']['local_dir'],
+                info['filename'].replace('immasked.fits', 'psfexcat.psf'),
+            ),
+        }
+        if piff_campaign is not None:
+            expected['piff_path'] = os.path.join(
+                dirdict['piff']['local_dir'],
+                os.path.basename(info['piff_path']),
+            )
+        else:
+            expected['piff_path'] = info['piff_path']
+
+        for name, path in expected.items():
+            assert new_table[name][i] == path
+
+
+@pytest.mark.parametrize('cls', [DESMEDSMaker, DESMEDSMakerDESDM])
+def test_build_image_data(cls):
+    srclist = _make_srclist()
+    maker = _make_maker(cls, srclist)
+
+    maker._build_image_data()
+    image_info = maker.image_info
+
+    expected = _build_se_image_data_rowwise(
+        maker, srclist, maker._get_wcs_json(srclist), image_info,
+    )
+    for name in image_info.dtype.names:
+        assert np.all(image_info[name][1:] == expected[name][1:]), name
+
+    if cls is DESMEDSMaker:
+        assert image_info['image_path'][1].startswith('${DESDATA}/')
+    else:
+        # the DESDM maker keeps the paths as they are
+        assert np.all(image_info['image_path'][1:] == srclist['red_image'])
+
+
+def test_portable_urls_policy():
+    """
+    a maker over-riding only _get_portable_url gets the same policy for
+    the columns of the source table
+    """
+    class MyMaker(DESMEDSMaker):
+        def _get_portable_url(self, file_dict, name):
+            return file_dict[name].upper()
+
+    srclist = _make_srclist()
+    maker = _make_maker(MyMaker, srclist)
+
+    paths = maker._get_portable_urls(srclist, 'red_bkg')
+    assert paths.tolist() == [p.upper() for p in srclist['red_bkg']]
@@ -0,0 +1,59 @@
+import os
+import shutil
+import pytest
+
+pytest.importorskip('fitsio')
+pytest.importorskip('esutil')
+
+from ..desdm_maker import Preparator  # noqa
+
+
+def _make_psfmap(tmpdir, nfile=3):
+    source_dir = tmpdir.join('sources')
+    source_dir.mkdir()
+    psf_dir = tmpdir.join('psfs')
+    psf_dir.mkdir()
+
+    psfmap = []
+    for i in range(nfile):
+        bname = 'D%08d_r_c%02d_r1_psfexcat.psf' % (i, i+1)
+        psf_file = source_dir.join(bname)
+        psf_file.write('psf %d' % i)
+        psfmap.append({
+            'psf_file': str(psf_file),
+            'ofile': str(psf_dir.join(bname)),
+        })
+
+    return str(source_dir), psfmap
+
+
+@pytest.mark.parametrize('mode', ['copy', 'hardlink'])
+def test_stage_psfs(tmpdir, mode):
+    """
+    the staged psfs are still there after the sources are removed, as
+    done by clean()
+    """
+    source_dir, psfmap = _make_psfmap(tmpdir)
+
+    # a link left by an older version is replaced
+    os.symlink(psfmap[0]['psf_file'], psfmap[0]['ofile'])
+
+    prep = Preparator.__new__(Preparator)
+    prep['psf_stage_mode'] = mode
+    prep._stage_psfs(psfmap)
+
+    shutil.rmtree(source_dir)
+
+    for i, entry in enumerate(psfmap):
+        assert not os.path.islink(entry['ofile'])
+        with open(entry['ofile']) as fobj:
+            assert fobj.read() == 'psf %d' % i
+
+
+def test_stage_psfs_symlink(tmpdir):
+    _, psfmap = _make_psfmap(tmpdir)
+
+    prep = Preparator.__new__(Preparator)
+    prep['psf_stage_mode'] = 'symlink'
+    with pytest.raises(ValueError):
+        prep._stage_psfs(psfmap)
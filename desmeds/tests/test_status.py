@@ -0,0 +1,118 @@
+import sqlite3
+import pytest
+
+from .. import files
+from .. import status
+
+
+def test_track_job(tmpdir, monkeypatch):
+    monkeypatch.setenv('MEDS_DIR', str(tmpdir.join('meds')))
+    status_file = str(tmpdir.join('status.db'))
+    meds_file = str(tmpdir.join('meds.fits'))
+
+    with status.track_job('test', 'DES0000+0000', 'g',
+                          meds_file=meds_file, status_file=status_file):
+        with open(meds_file, 'w') as fobj:
+            fobj.write('data')
+
+    with pytest.raises(RuntimeError):
+        with status.track_job('test', 'DES0000+0000', 'r',
+                              meds_file=meds_file, status_file=status_file):
+            raise RuntimeError('bad psf')
+
+    db = status.StatusDB(status_file)
+    row = db.get('DES0000+0000', 'g')
+    assert row['state'] == status.DONE
+    assert row['attempts'] == 1
+    assert row['file_bytes'] == 4
+    assert row['checksum'] == status.get_checksum(meds_file)
+    assert row['run_seconds'] >= 0
+
+    row = db.get('DES0000+0000', 'r')
+    assert row['state'] == status.FAILED
+    assert 'RuntimeError: bad psf' in row['error']
+    assert row['file_bytes'] is None
+
+    assert db.get_done() == set([('DES0000+0000', 'g')])
+    db.close()
+
+    assert status.get_done('test', status_file=status_file) == set(
+        [('DES0000+0000', 'g')]
+    )
+
+    # a job that writes no meds file is not done
+    with pytest.raises(IOError):
+        with status.track_job('test', 'DES0001+0000', 'g',
+                              meds_file=str(tmpdir.join('missing.fits')),
+                              status_file=status_file):
+            pass
+
+    db = status.StatusDB(status_file)
+    row = db.get('DES0001+0000', 'g')
+    assert row['state'] == status.FAILED
+    assert 'meds file was not written' in row['error']
+    db.close()
+
+
+def test_get_done(tmpdir, monkeypatch):
+    """
+    meds files made before the status database was created, or without
+    tracking the status, are done
+    """
+    monkeypatch.setenv('MEDS_DIR', str(tmpdir.join('meds')))
+    status_file = str(tmpdir.join('status.db'))
+
+    fname = files.get_meds_file('test', 'DES0000+0000', 'g')
+    files.makedir_fromfile(fname)
+    open(fname, 'w').close()
+
+    expected = set([('DES0000+0000', 'g')])
+    assert status.get_done('test', status_file=status_file) == expected
+
+    db = status.StatusDB(status_file)
+    db.add_jobs([('DES0000+0000', 'r'), ('DES0001+0000', 'r')])
+    db.set_done('DES0000+0000', 'r')
+    db.close()
+
+    expected.add(('DES0000+0000', 'r'))
+    assert status.get_done('test', status_file=status_file) == expected
+
+
+def test_start_claimed(tmpdir):
+    # a job started by a runner is not counted twice
+    db = status.StatusDB(str(tmpdir.join('status.db')))
+    db.add_jobs([('DES0000+0000', 'g')])
+    assert db.claim('DES0000+0000', 'g', 'host1')
+    start_time = db.get('DES0000+0000', 'g')['start_time']
+
+    db.start('DES0000+0000', 'g', 'host1', pid=10)
+    row = db.get('DES0000+0000', 'g')
+    assert row['attempts'] == 1
+    assert row['start_time'] == start_time
+    assert row['pid'] == 10
+    db.close()
+
+
+def test_old_schema(tmpdir):
+    status_file = str(tmpdir.join('status.db'))
+    conn = sqlite3.connect(status_file)
+    conn.execute(
+        'create table jobs (tilename text not null, band text not null, '
+        "state text not null default 'pending', "
+        'attempts integer not null default 0, '
+        'not_before real not null default 0, host text, pid integer, '
+        'start_time real, end_time real, error text, '
+        'primary key (tilename, band))'
+    )
+    conn.execute(
+        "insert into jobs (tilename, band, state) "
+        "values ('DES0000+0000', 'g', 'done')"
+    )
+    conn.commit()
+    conn.close()
+
+    db = status.StatusDB(status_file)
+    row = db.get('DES0000+0000', 'g')
+    assert row['state'] == status.DONE
+    assert row['checksum'] is None
+    db.close()
@@ -0,0 +1,234 @@
+import json
+import numpy as np
+import pytest
+
+fitsio = pytest.importorskip('fitsio')
+pytest.importorskip('esutil')
+
+from .. import desdm_maker  # noqa
+from .. import synthetic  # noqa
+from ..benchmark import SyntheticMEDSMaker  # noqa
+from ..desdm_maker import DESMEDSMakerDESDM  # noqa
+
+MEDSCONF = {
+    'medsconf': 'test',
+    'source_type': 'nullwt',
+    'psf': {'coadd': {'type': 'psfex'}, 'se': {'type': 'piff'}},
+}
+
+FILECONF = {
+    'band': 'r',
+    'meds_url': '/meds/DES0000+0000_r_meds.fits.fz',
+}
+
+NFILE = 4
+
+
+class FakePSF(dict):
+    def __init__(self, path, ccdnum, band):
+        self['path'] = path
+        self['ccdnum'] = ccdnum
+        self['band'] = band
+        self.wcs = None
+
+    def set_wcs(self, wcs):
+        self.wcs = wcs
+
+
+def _fake_load_psf_data(self, psf_files):
+    """
+    stands in for _load_psf_data, recording the inputs for each psf
+    """
+    return [
+        FakePSF(path, ccdnum, band) for path, ccdnum, band in zip(
+            psf_files['path'].astype('U'),
+            psf_files['ccdnum'],
+            psf_files['band'].astype('U'),
+        )
+    ]
+
+
+def _get_wcs_header(i):
+    return {
+        'ctype1': 'RA---TAN',
+        'ctype2': 'DEC--TAN',
+        'crval1': 10.0 + i,
+        'crval2': 0.0,
+        'crpix1': 50.0,
+        'crpix2': 50.0,
+        'cd1_1': -7.3e-05,
+        'cd1_2': 0.0,
+        'cd2_1': 0.0,
+        'cd2_2': 7.3e-05,
+        'naxis1': 100,
+        'naxis2': 100,
+    }
+
+
+def _make_maker(rng):
+    """
+    a maker holding the inputs for the MEDSMaker, as built from the
+    catalogs and file lists
+    """
+    maker = DESMEDSMakerDESDM.__new__(DESMEDSMakerDESDM)
+    maker._load_config(MEDSCONF)
+    maker._load_file_config(FILECONF)
+    maker.tmpdir = None
+
+    nobj = 7
+    maker.obj_data = np.zeros(
+        nobj,
+        dtype=[('id', 'i8'), ('number', 'i8'), ('box_size', 'i4'),
+               ('ra', 'f8'), ('dec', 'f8'), ('flux', 'f4'),
+               ('psf_color', 'f4'), ('file_id', 'i4', 3)],
+    )
+    maker.obj_data['id'] = 1000 + rng.permutation(nobj)
+    maker.obj_data['number'] = np.arange(nobj) + 1
+    maker.obj_data['box_size'] = rng.choice([32, 48, 64], size=nobj)
+    maker.obj_data['ra'] = rng.uniform(size=nobj)
+    maker.obj_data['dec'] = rng.uniform(size=nobj)
+    maker.obj_data['flux'] = rng.uniform(size=nobj)
+    maker.obj_data['psf_color'] = rng.uniform(size=nobj)
+    maker.obj_data['file_id'] = rng.randint(-1, NFILE, size=(nobj, 3))
+
+    wcs = [json.dumps(_get_wcs_header(i)) for i in range(NFILE)]
+    maker.image_info = np.zeros(
+        NFILE,
+        dtype=[('image_id', 'i8'), ('image_path', 'U60'),
+               ('image_ext', 'U10'), ('magzp', 'f4'),
+               ('wcs', 'U%d' % max(len(w) for w in wcs))],
+    )
+    maker.image_info['image_id'] = np.arange(NFILE)
+    maker.image_info['image_path'] = [
+        '/data/D%08d_r_c%02d_immasked.fits.fz' % (i, i) for i in range(NFILE)
+    ]
+    maker.image_info['image_ext'] = 'sci'
+    maker.image_info['magzp'] = 30.0
+    maker.image_info['wcs'] = wcs
+
+    maker.meta_data = np.zeros(1, dtype=[('magzp_ref', 'f8'),
+                                         ('medsconf', 'U10')])
+    maker.meta_data['magzp_ref'] = 30.0
+    maker.meta_data['medsconf'] = 'test'
+
+    maker.psf_files = np.zeros(
+        NFILE,
+        dtype=[('path', 'U60'), ('ccdnum', 'i4'), ('band', 'U1'),
+               ('wcs_file_id', 'i4')],
+    )
+    maker.psf_files['path'] = ['/data/DES0000+0000_r_psfcat.psf'] + [
+        '/data/D%08d_r_c%02d_piff-model.fits' % (i, i)
+        for i in range(1, NFILE)
+    ]
+    maker.psf_files['ccdnum'] = [-1] + list(range(1, NFILE))
+    maker.psf_files['band'] = [''] + ['r']*(NFILE-1)
+
+    # astrometry refined for all but the last single epoch psf
+    maker.psf_files['wcs_file_id'] = [-1] + list(range(1, NFILE-1)) + [-1]
+
+    maker.psf_info = None
+    maker.box_size_report = None
+    return maker
+
+
+def _check_equal(arr1, arr2):
+    assert arr1.dtype.names == arr2.dtype.names
+    for name in arr1.dtype.names:
+        if arr1[name].dtype.kind in ['S', 'U']:
+            assert np.all(
+                arr1[name].astype('U') == arr2[name].astype('U')
+            ), name
+        else:
+            assert np.all(arr1[name] == arr2[name]), name
+
+
+def test_stubby_round_trip(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        DESMEDSMakerDESDM, '_load_psf_data', _fake_load_psf_data,
+    )
+
+    rng = np.random.RandomState(5512)
+    maker = _make_maker(rng)
+
+    fname = str(tmpdir.join('DES0000+0000_r_meds-stubby.fits'))
+    maker.write_stubby(fname)
+
+    new_maker = DESMEDSMakerDESDM(MEDSCONF, FILECONF, stubby=fname)
+
+    _check_equal(new_maker.obj_data, maker.obj_data)
+    _check_equal(new_maker.image_info, maker.image_info)
+    _check_equal(new_maker.meta_data, maker.meta_data)
+    _check_equal(new_maker.psf_files, maker.psf_files)
+    assert new_maker.psf_info is None
+    assert new_maker.box_size_report is None
+
+    # the psfs are loaded from the psf files when the MEDS file is
+    # written, with the refined astrometry restored from the image info
+    assert new_maker.psf_data is None
+    new_maker._load_psfs()
+
+    assert len(new_maker.psf_data) == NFILE
+    for i, psf in enumerate(new_maker.psf_data):
+        assert psf['path'] == maker.psf_files['path'][i]
+        assert psf['ccdnum'] == maker.psf_files['ccdnum'][i]
+        assert psf['band'] == maker.psf_files['band'][i]
+
+        file_id = maker.psf_files['wcs_file_id'][i]
+        if file_id < 0:
+            assert psf.wcs is None
+        else:
+            assert psf.wcs['crval1'] == 10.0 + file_id
+
+
+def test_stubby_no_psfs(tmpdir):
+    rng = np.random.RandomState(981)
+    maker = _make_maker(rng)
+    maker.psf_files = None
+
+    fname = str(tmpdir.join('DES0000+0000_r_meds-stubby.fits'))
+    maker.write_stubby(fname)
+
+    new_maker = DESMEDSMakerDESDM(MEDSCONF, FILECONF, stubby=fname)
+    _check_equal(new_maker.obj_data, maker.obj_data)
+    assert new_maker.psf_files is None
+    assert new_maker.psf_data is None
+
+
+def test_psfs_not_loaded(tmpdir, monkeypatch):
+    """
+    the psfs are not loaded when the inputs are read, so writing only the
+    stubby file does not load them, but the astrometry for each psf is
+    still found
+    """
+    def _load_psf_data(self, psf_files):
+        raise RuntimeError('psfs should not be loaded')
+
+    monkeypatch.setattr(
+        SyntheticMEDSMaker, '_load_psf_data', _load_psf_data,
+    )
+
+    nepoch = 3
+    fileconf = synthetic.make_tile(
+        str(tmpdir),
+        nobj=10,
+        nepoch=nepoch,
+        psf_type='piff',
+        coadd_dims=(300, 300),
+        se_dims=(200, 100),
+        seed=8,
+    )
+    config = synthetic.get_medsconf(psf_type='piff')
+    config['use_astro_refine'] = True
+
+    maker = SyntheticMEDSMaker.__new__(SyntheticMEDSMaker)
+    maker._load_config(config)
+    maker._load_file_config(fileconf)
+    maker._set_extra_config('none', fileconf['band'])
+    maker._load_coadd_info()
+
+    assert maker.psf_data is None
+    assert maker.psf_files.size == nepoch + 1
+
+    # the coadd psf is psfex, which does not use the refined astrometry;
+    # the single epoch images are in the same order as their psfs
+    assert list(maker.psf_files['wcs_file_id']) == [-1, 1, 2, 3]
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import fitsio
+import esutil as eu
+
+from .. import synthetic
+
+
+@pytest.mark.parametrize('psf_type', ['psfex', 'piff'])
+def test_synthetic_tile(tmpdir, psf_type):
+    nobj = 100
+    nepoch = 3
+    fileconf = synthetic.make_tile(
+        str(tmpdir),
+        nobj=nobj,
+        nepoch=nepoch,
+        psf_type=psf_type,
+        coadd_dims=(500, 500),
+        se_dims=(200, 100),
+        seed=5,
+    )
+
+    cat = fitsio.read(fileconf['coadd_cat_url'], lower=True)
+    objmap = fitsio.read(fileconf['coadd_object_map'], lower=True)
+    assert cat.size == nobj
+    assert np.array_equal(objmap['object_number'], cat['number'])
+
+    list_key = 'piff_flist' if psf_type == 'piff' else 'psf_flist'
+    for key in ['finalcut_flist', 'seg_flist', 'bkg_flist', list_key]:
+        with open(fileconf[key]) as fobj:
+            assert len(fobj.readlines()) == nepoch
+
+    coadd_hdr = fitsio.read_header(fileconf['coadd_image_url'], ext=1)
+    ra, dec = eu.wcsutil.WCS(coadd_hdr).image2sky(
+        cat['x_image'], cat['y_image'],
+    )
+
+    # the single epoch wcs is a shifted version of the coadd wcs
+    with open(fileconf['finalcut_flist']) as fobj:
+        for line in fobj:
+            image_path, head_path, _ = line.split()
+
+            img_hdr = fitsio.read_header(image_path, ext=1)
+            wcs_hdr = fitsio.read_scamp_head(head_path)
+            wcs = {k.lower(): wcs_hdr[k] for k in wcs_hdr.keys()}
+            wcs['naxis1'] = img_hdr['naxis1']
+            wcs['naxis2'] = img_hdr['naxis2']
+
+            x, y = eu.wcsutil.WCS(wcs).sky2image(ra, dec)
+            dx = x - cat['x_image']
+            dy = y - cat['y_image']
+            assert np.allclose(dx, np.round(dx[0]), atol=1.0e-4)
+            assert np.allclose(dy, np.round(dy[0]), atol=1.0e-4)
+
+
+@pytest.mark.parametrize('stamp_size', [24, 25])
+def test_gaussian_psf(tmpdir, stamp_size):
+    fname = str(tmpdir.join('psf.fits'))
+    synthetic.write_psf(fname, 2.0, [1.0e-4, 0.0], stamp_size=stamp_size)
+
+    psf = synthetic.GaussianPiffPSF(fname, stamp_size=stamp_size)
+    row, col = 100.3, 200.8
+
+    im = psf.get_rec(row, col, color=1.5)
+    assert im.shape == (stamp_size, stamp_size)
+    assert np.allclose(im.sum(), 1.0)
+
+    rows, cols = np.mgrid[0:stamp_size, 0:stamp_size]
+    cen = psf.get_center(row, col)
+    assert np.allclose((im*rows).sum(), cen[0], atol=1.0e-3)
+    assert np.allclose((im*cols).sum(), cen[1], atol=1.0e-3)
@@ -0,0 +1,135 @@
+import pytest
+
+from .. import tuning
+from .. import status
+
+
+def test_choose_threads():
+    # no cost, use all cores for loading psfs; the maker uses no OpenMP
+    choice = tuning.choose_threads(8)
+    assert choice['omp_num_threads'] == 1
+    assert choice['workers'] == 1
+    assert choice['psf_load_threads'] == 16
+    assert 'parallel_fraction' not in choice
+
+    # cheap jobs get few threads, expensive ones all cores
+    choice = tuning.choose_threads(8, cost_seconds=1000, nepoch=1)
+    assert choice['psf_load_threads'] == 1
+
+    choice = tuning.choose_threads(8, cost_seconds=3*1800)
+    assert choice['psf_load_threads'] == 6
+
+    choice = tuning.choose_threads(8, cost_seconds=100*1800)
+    assert choice['psf_load_threads'] == 16
+    assert choice['omp_num_threads'] == 1
+
+    # coadding uses processes with one thread each
+    choice = tuning.choose_threads(4, coadd=True)
+    assert choice['omp_num_threads'] == 1
+    assert choice['workers'] == 4
+
+    # only the parallel part of the work gets workers
+    choice = tuning.choose_threads(
+        8, cost_seconds=5*1800, coadd=True, parallel_fraction=0.6,
+    )
+    assert choice['workers'] == 3
+    assert choice['parallel_fraction'] == 0.6
+
+    choice = tuning.choose_threads(
+        8, cost_seconds=100*1800, coadd=True, parallel_fraction=0.0,
+    )
+    assert choice['workers'] == 1
+
+    with pytest.raises(ValueError):
+        tuning.choose_threads(8, coadd=True, parallel_fraction=1.5)
+
+
+def test_get_ncores(monkeypatch):
+    monkeypatch.delenv('DESMEDS_NCORES', raising=False)
+    monkeypatch.setenv('LSB_DJOB_NUMPROC', '6')
+    assert tuning.get_ncores() == 6
+
+    monkeypatch.setenv('DESMEDS_NCORES', '3')
+    assert tuning.get_ncores() == 3
+
+
+def test_tune_job(tmpdir):
+    status_file = str(tmpdir.join('status.db'))
+
+    # no history
+    choice = tuning.tune_job(
+        'test', 'DES0000+0000', 'g', ncores=8, status_file=status_file,
+        coadd=True,
+    )
+    assert choice['cost_source'] == 'none'
+    assert choice['workers'] == 8
+
+    # tuning does not add the job to the queue
+    db = status.StatusDB(status_file)
+    assert db.get('DES0000+0000', 'g') is None
+    assert db.get_counts()[status.PENDING] == 0
+    db.close()
+
+    # past runs: DES0000+0000 g took 1000 seconds with 4 workers, half
+    # the work in the workers, the other r band jobs took 100 seconds
+    db = status.StatusDB(status_file)
+    db.set_tuning('DES0000+0000', 'g', {
+        'omp_num_threads': 1, 'workers': 4, 'parallel_fraction': 0.5,
+    })
+    rows = [
+        ('DES0000+0000', 'g', 1000.0),
+        ('DES0001+0000', 'r', 100.0),
+        ('DES0002+0000', 'r', 100.0),
+    ]
+    for tilename, band, seconds in rows:
+        db.add_jobs([(tilename, band)])
+        db.conn.execute(
+            'update jobs set state = ?, run_seconds = ? '
+            'where tilename = ? and band = ?',
+            (status.DONE, seconds, tilename, band),
+        )
+    db.set_tuning('DES0001+0000', 'r', {
+        'omp_num_threads': 1, 'workers': 1,
+    })
+    db.close()
+
+    choice = tuning.tune_job(
+        'test', 'DES0000+0000', 'g', ncores=8, status_file=status_file,
+        seconds_per_thread=200, coadd=True, parallel_fraction=0.5,
+    )
+    assert choice['cost_source'] == 'history'
+
+    # 1000 = serial*(0.5 + 0.5/4)
+    assert choice['cost_seconds'] == pytest.approx(1600.0)
+    assert choice['workers'] == 4
+    assert choice['psf_load_threads'] == 16
+
+    # the median over the band
+    choice = tuning.tune_job(
+        'test', 'DES0003+0000', 'r', ncores=8, status_file=status_file,
+    )
+    assert choice['cost_seconds'] == 100.0
+    assert choice['psf_load_threads'] == 2
+
+    # an estimate takes precedence
+    estimates = [{
+        'tilename': 'DES0003+0000', 'band': 'r',
+        'wall_time_seconds': 3*1800.0, 'nepoch': 2,
+    }]
+    choice = tuning.tune_job(
+        'test', 'DES0003+0000', 'r', ncores=8, status_file=status_file,
+        estimates=estimates,
+    )
+    assert choice['cost_source'] == 'estimate'
+    assert choice['cost_seconds'] == 3*1800.0
+    assert choice['psf_load_threads'] == 2
+
+    # the choice is recorded
+    db = status.StatusDB(status_file)
+    assert db.get_tunings()[('DES0003+0000', 'r')] == choice
+    assert db.get('DES0003+0000', 'r') is None
+    db.close()
+
+    exports = tuning.get_shell_exports(choice)
+    assert 'export OMP_NUM_THREADS=1' in exports
+    assert 'export DESMEDS_PSF_LOAD_THREADS=2' in exports
@@ -0,0 +1,271 @@
+"""
+choose the threads and workers for a MEDS job
+
+The choice is made from the cores available to the job and the predicted
+cost of the tile-band.  The cost is taken from a cost estimate written by
+desmeds-estimate if one is sent, otherwise from the run times of past jobs
+recorded in the status database.  Cheap jobs get few threads, so packed or
+shared nodes are not oversubscribed, while expensive jobs use all the cores
+they have.
+
+Only the coadd worker processes and the psf loading threads run in parallel.
+The DESDM maker does not use OpenMP, so OMP_NUM_THREADS is always 1, and
+only the parallel fraction of a coadd job's time is divided among the
+workers.  Compression is not tuned: the MEDS file is compressed after it is
+written by a single fpack process, which has no option for threads.
+
+The choice is recorded in the status database, without adding the job to
+the queue
+"""
+from __future__ import print_function
+import os
+
+from . import files
+from .status import StatusDB
+
+# seconds of single thread work that justify adding a thread
+DEFAULT_SECONDS_PER_THREAD = 1800.0
+
+# fraction of the single thread time of a coadd job spent in the worker
+# processes; reading the inputs, loading the psfs, merging the shards and
+# compressing run in the main process
+DEFAULT_PARALLEL_FRACTION = 0.8
+
+# psf loading is mostly I/O, so we use more threads than cores
+PSF_LOAD_THREADS_PER_THREAD = 2
+MAX_PSF_LOAD_THREADS = 16
+
+
+def get_ncores():
+    """
+    get the number of cores available to this job
+
+    $DESMEDS_NCORES is used if set, e.g. by desmeds-run-tileset, then the
+    number of slots allocated by lsf, then the cores this process may run on
+    """
+    for name in ['DESMEDS_NCORES', 'LSB_DJOB_NUMPROC']:
+        if name in os.environ:
+            return max(1, int(os.environ[name]))
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count()
+
+
+def choose_threads(ncores,
+                   cost_seconds=None,
+                   nepoch=None,
+                   coadd=False,
+                   seconds_per_thread=DEFAULT_SECONDS_PER_THREAD,
+                   parallel_fraction=DEFAULT_PARALLEL_FRACTION):
+    """
+    choose the threads for a job
+
+    parameters
+    ----------
+    ncores: int
+        Cores available to the job
+    cost_seconds: float, optional
+        Predicted single thread run time.  If not sent, all cores are used
+    nepoch: int, optional
+        Number of single epoch images, limiting the psf loading threads
+    coadd: bool, optional
+        If True the job is coadding, which runs in worker processes that
+        each use a single thread
+    seconds_per_thread: float, optional
+        Seconds of work that justify adding a thread.  Default 1800
+    parallel_fraction: float, optional
+        Fraction of the cost of a coadd job that runs in the workers.
+        Default 0.8
+
+    returns
+    -------
+    choice: dict
+        omp_num_threads, psf_load_threads, workers and, for coadd jobs,
+        parallel_fraction, along with the inputs
+    """
+    ncores = max(1, int(ncores))
+
+    if parallel_fraction < 0 or parallel_fraction > 1:
+        raise ValueError("parallel_fraction must be in [0, 1], "
+                         "got %g" % parallel_fraction)
+
+    nthreads = _get_nthreads(ncores, cost_seconds, seconds_per_thread)
+
+    psf_load_threads = min(
+        PSF_LOAD_THREADS_PER_THREAD*nthreads, MAX_PSF_LOAD_THREADS,
+    )
+    if nepoch is not None:
+        psf_load_threads = max(1, min(psf_load_threads, nepoch))
+
+    choice = {
+        'ncores': ncores,
+        'cost_seconds': cost_seconds,
+        'omp_num_threads': 1,
+        'psf_load_threads': psf_load_threads,
+        'workers': 1,
+    }
+
+    if coadd:
+        # only the work done in the workers is divided among them
+        if cost_seconds is not None:
+            cost_seconds = parallel_fraction*cost_seconds
+
+        choice['workers'] = _get_nthreads(
+            ncores, cost_seconds, seconds_per_thread,
+        )
+        choice['parallel_fraction'] = parallel_fraction
+
+    return choice
+
+
+def tune_job(medsconf,
+             tilename,
+             band,
+             ncores=None,
+             estimates=None,
+             coadd=False,
+             status_file=None,
+             seconds_per_thread=DEFAULT_SECONDS_PER_THREAD,
+             parallel_fraction=DEFAULT_PARALLEL_FRACTION):
+    """
+    choose the threads for a tile-band and record the choice in the status
+    database.  The job is not added to the queue of pending jobs
+
+    parameters
+    ----------
+    medsconf: string
+        The meds config name
+    tilename: string
+        e.g. 'DES0417-5914'
+    band: string
+        e.g. 'i'
+    ncores: int, optional
+        Cores available, default from get_ncores
+    estimates: list of dicts, optional
+        Cost estimates as written by desmeds-estimate.  If the tile-band is
+        present its predicted wall time is used as the cost
+    coadd: bool, optional
+        If True the job is coadding
+    status_file: string, optional
+        The status database, default files.get_status_file(medsconf).  Past
+        run times are read from it when there is no estimate
+    seconds_per_thread: float, optional
+        See choose_threads
+    parallel_fraction: float, optional
+        See choose_threads
+
+    returns
+    -------
+    choice: dict
+        As returned by choose_threads, with the source of the cost added
+    """
+    if ncores is None:
+        ncores = get_ncores()
+    if status_file is None:
+        status_file = files.get_status_file(medsconf)
+
+    cost_seconds, nepoch, source = None, None, 'none'
+
+    if estimates is not None:
+        for est in estimates:
+            if est['tilename'] == tilename and est['band'] == band:
+                cost_seconds = est['wall_time_seconds']
+                nepoch = est.get('nepoch', None)
+                source = 'estimate'
+                break
+
+    db = StatusDB(status_file)
+    try:
+        if cost_seconds is None:
+            cost_seconds = get_history_seconds(db, tilename, band)
+            if cost_seconds is not None:
+                source = 'history'
+
+        choice = choose_threads(
+            ncores,
+            cost_seconds=cost_seconds,
+            nepoch=nepoch,
+            coadd=coadd,
+            seconds_per_thread=seconds_per_thread,
+            parallel_fraction=parallel_fraction,
+        )
+        choice['cost_source'] = source
+
+        db.set_tuning(tilename, band, choice)
+    finally:
+        db.close()
+
+    return choice
+
+
+def get_history_seconds(db, tilename, band):
+    """
+    get the single thread run time for the tile-band from past jobs
+
+    The last successful run of the tile-band is used if there was one,
+    otherwise the median over done jobs in the same band, otherwise the
+    median over all done jobs.  Run times of coadd jobs are converted to
+    single thread times using the workers and parallel fraction recorded
+    for the job, if any
+
+    returns
+    -------
+    seconds, or None if there are no past jobs
+    """
+    import numpy as np
+
+    tunings = db.get_tunings()
+    done = [
+        row for row in db.get_jobs(state='done')
+        if row['run_seconds'] is not None
+    ]
+
+    def get_work_seconds(row):
+        key = (row['tilename'], row['band'])
+        return _get_work_seconds(row['run_seconds'], tunings.get(key))
+
+    for row in done:
+        if row['tilename'] == tilename and row['band'] == band:
+            return get_work_seconds(row)
+
+    for rows in [[row for row in done if row['band'] == band], done]:
+        if len(rows) > 0:
+            return float(np.median([get_work_seconds(row) for row in rows]))
+
+    return None
+
+
+def get_shell_exports(choice):
+    """
+    get shell commands exporting the choice as environment variables
+    """
+    return '\n'.join([
+        'export OMP_NUM_THREADS=%d' % choice['omp_num_threads'],
+        'export DESMEDS_PSF_LOAD_THREADS=%d' % choice['psf_load_threads'],
+        'export DESMEDS_WORKERS=%d' % choice['workers'],
+    ])
+
+
+def _get_nthreads(ncores, cost_seconds, seconds_per_thread):
+    """
+    a thread for each seconds_per_thread of work, up to the cores
+    """
+    if cost_seconds is None:
+        return ncores
+
+    nthreads = int(-(-cost_seconds // seconds_per_thread))
+    return max(1, min(nthreads, ncores))
+
+
+def _get_work_seconds(run_seconds, tuning):
+    """
+    the single thread time for a run; only the parallel fraction of the
+    time was divided among the workers
+    """
+    if tuning is None or tuning.get('workers', 1) <= 1:
+        return run_seconds
+
+    frac = tuning.get('parallel_fraction', DEFAULT_PARALLEL_FRACTION)
+    return run_seconds/(1 - frac + frac/tuning['workers'])
@@ -2,6 +2,8 @@
 from __future__ import print_function
 import os
 import subprocess
+from collections import OrderedDict
+from collections.abc import Mapping
 
 DEFVAL = -9999
 IMAGE_INFO_TYPES = ['image','weight','seg','bmask','bkg']
@@ -59,30 +61,157 @@ def fpack_file(fname, fpack_kwargs=""):
     subprocess.check_call(cmd,shell=True)
 
 
-def load_psfmap(fname):
-    import psfex
+def load_psfmap(fname, max_loaded=None, config=None):
+    """
+    get a PSFMap for the psf map file; see PSFMap for details
+
+    parameters
+    ----------
+    fname: string
+        The psf map file
+    max_loaded: int, optional
+        Maximum number of models held in memory, default no limit
+    config: dict, optional
+        The meds config.  The piff stamp size and whether piff models use
+        colors are taken from the single epoch psf config, config['psf']['se']
+    """
+    kwargs = {}
+    if config is not None and 'psf' in config:
+        se_conf = config['psf'].get('se', config['psf'])
+        if 'stamp_size' in se_conf:
+            kwargs['piff_stamp_size'] = se_conf['stamp_size']
+        kwargs['piff_use_color'] = se_conf.get('use_color', False)
 
-    fname = os.path.expandvars(fname)
-    pmap={}
-    with open(fname) as fobj:
-        for line in fobj:
-            ls=line.split()
-            if ls[0]=='-9999':
-                continue
+    return PSFMap(fname, max_loaded=max_loaded, **kwargs)
 
-            expname=ls[0]
-            ccdstr=ls[1]
-            path=os.path.expandvars(ls[2])
 
-            key = '%s-%s' % (expname, ccdstr)
+def get_piff_color_name(band):
+    """
+    get the name of the color used by color dependent piff models for
+    the band
+    """
+    if band in ['g', 'r', 'i']:
+        return 'GI_COLOR'
+    else:
+        return 'IZ_COLOR'
 
-            if 'psfexcat' in path or 'psfcat' in path:
-                print("loading psfex:",path)
-                p=psfex.PSFEx(path)
-            else:
-                raise ValueError("only psfex for now")
 
-            pmap[key] = p
+class PSFMap(Mapping):
+    """
+    map from 'expname-ccd' keys to psf models, read from a psf map file
+    holding lines
+
+        expname ccd path
+
+    Each model is loaded on first use.  Paths containing psfexcat or
+    psfcat are loaded as psfex models and paths containing piff are loaded
+    with the PIFFWrapper.  Lines with expname -9999, for the coadd psf, are
+    skipped
+
+    The file names are expected to be of the form
+
+        D00502664_r_c36_r2378p01_piff-model.fits
+
+    from which the band is taken for color dependent piff models
+
+    parameters
+    ----------
+    fname: string
+        The psf map file
+    max_loaded: int, optional
+        Maximum number of models held in memory.  Once reached, the least
+        recently used model is released, to be loaded again if needed.
+        Default is no limit
+    piff_stamp_size: int, optional
+        Stamp size for piff models, default 25
+    piff_use_color: bool, optional
+        If True, piff models are drawn using the color for the band, see
+        get_piff_color_name.  Default False
+    """
+    def __init__(self,
+                 fname,
+                 max_loaded=None,
+                 piff_stamp_size=25,
+                 piff_use_color=False):
+        self.fname = os.path.expandvars(fname)
+        self.max_loaded = max_loaded
+        self.piff_stamp_size = piff_stamp_size
+        self.piff_use_color = piff_use_color
+
+        self.paths = self._read_paths()
+        self._loaded = OrderedDict()
+
+    def __getitem__(self, key):
+        if key in self._loaded:
+            self._loaded.move_to_end(key)
+            return self._loaded[key]
+
+        psf = self._load_psf(key, self.paths[key])
+        self._loaded[key] = psf
+
+        if self.max_loaded is not None:
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+
+        return psf
+
+    def __contains__(self, key):
+        return key in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get_nloaded(self):
+        """
+        get the number of models currently held in memory
+        """
+        return len(self._loaded)
+
+    def _read_paths(self):
+        paths = OrderedDict()
+        with open(self.fname) as fobj:
+            for line in fobj:
+                ls=line.split()
+                if len(ls) == 0 or ls[0]=='-9999':
+                    continue
+
+                expname=ls[0]
+                ccdstr=ls[1]
+                path=os.path.expandvars(ls[2])
+
+                key = '%s-%s' % (expname, ccdstr)
+                paths[key] = path
+
+        return paths
+
+    def _load_psf(self, key, path):
+        bname = os.path.basename(path)
+
+        if 'psfexcat' in bname or 'psfcat' in bname:
+            import psfex
+            print("loading psfex:",path)
+            return psfex.PSFEx(path)
+
+        elif 'piff' in bname:
+            from .desdm_maker import PIFFWrapper
+            print("loading piff:",path)
+            ccdnum = int(key.split('-')[1])
+
+            if self.piff_use_color:
+                band = bname.split('_')[1]
+                color_name = get_piff_color_name(band)
+            else:
+                color_name = None
 
-    return pmap
+            return PIFFWrapper(
+                path,
+                ccdnum=ccdnum,
+                stamp_size=self.piff_stamp_size,
+                color_name=color_name,
+            )
 
+        else:
+            raise ValueError("psf file should be psfex or piff: %s" % path)
@@ -9,6 +9,11 @@ scripts=[
     'desmeds-make-meds-desdm',
     'desmeds-make-meds',
     'desmeds-coadd',
+    'desmeds-run-pipeline',
+    'desmeds-run-tileset',
+    'desmeds-tune-job',
+    'desmeds-estimate',
+    'desmeds-benchmark',
 
     'desmeds-rsync-meds-srcs',
     'desmeds-prep-tile',